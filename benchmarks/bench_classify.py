@@ -0,0 +1,388 @@
+'''
+Benchmark suite for the classify plugin.
+
+Times each stage of the classification pipeline on synthetic datasets
+and writes the results as JSON so that runs on different commits can be
+compared.  Runs headless - contouring, WKB encoding and file writing use
+the QGIS independent ClassifyEngine.  Building QgsGeometry objects and
+writing to a memory layer are only timed if qgis.core can be imported,
+and are otherwise recorded as skipped.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_classify run --sizes 1e4,1e5,1e6 -o results.json
+    python -m benchmarks.bench_classify compare base.json results.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from . import datasets
+
+Stages=['dedup','grid','triangulation','levels','contour','geometry','write']
+
+_qgisApp=None
+
+def _initQgis():
+    '''
+    Start a headless QGIS application if qgis is installed.  Returns
+    true if QGIS is available.
+    '''
+    global _qgisApp
+    if _qgisApp is not None:
+        return _qgisApp is not False
+    try:
+        os.environ.setdefault('QT_QPA_PLATFORM','offscreen')
+        from qgis.core import QgsApplication
+        _qgisApp=QgsApplication([],False)
+        _qgisApp.initQgis()
+    except ImportError:
+        _qgisApp=False
+    return _qgisApp is not False
+
+def _gitCommit():
+    try:
+        root=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.check_output(
+            ['git','rev-parse','HEAD'],cwd=root,stderr=subprocess.DEVNULL
+            ).decode().strip()
+    except Exception:
+        return None
+
+def _environment():
+    import matplotlib
+    return {
+        'commit': _gitCommit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'matplotlib': matplotlib.__version__,
+        'qgis': _qgisVersion(),
+        }
+
+def _qgisVersion():
+    if not _initQgis():
+        return None
+    from qgis.core import Qgis
+    return Qgis.QGIS_VERSION
+
+def _timeit( func, repeat ):
+    '''
+    Run func repeat times, returning the last result and a dictionary
+    of the wall and cpu times.
+    '''
+    wall=[]
+    cpu=[]
+    result=None
+    for i in range(repeat):
+        w0=time.perf_counter()
+        c0=time.process_time()
+        result=func()
+        cpu.append(time.process_time()-c0)
+        wall.append(time.perf_counter()-w0)
+    timing={
+        'wall_min': min(wall),
+        'wall_median': float(np.median(wall)),
+        'cpu_min': min(cpu),
+        'repeat': repeat,
+        }
+    return result,timing
+
+def _buildQgsGeometries( results ):
+    from qgis.core import QgsGeometry
+    geoms=[]
+    for result in results:
+        geom=QgsGeometry()
+        geom.fromWkb(result.geometry.wkb())
+        if result.geometry.type == result.geometry.polygon:
+            geom=geom.makeValid()
+        geoms.append(geom)
+    return geoms
+
+def _writeQgsGeometries( geoms, ctype ):
+    from qgis.core import (QgsVectorLayer, QgsFeature, QgsField,
+                           QgsFeatureSink)
+    from PyQt5.QtCore import QVariant
+    gtype='MultiLineString' if ctype == 'line' else 'MultiPolygon'
+    layer=QgsVectorLayer(gtype+'?crs=EPSG:3857','bench','memory')
+    provider=layer.dataProvider()
+    provider.addAttributes([QgsField('index',QVariant.Int)])
+    layer.updateFields()
+    features=[]
+    for i,geom in enumerate(geoms):
+        feat=QgsFeature(layer.fields())
+        feat.setGeometry(geom)
+        feat['index']=i
+        features.append(feat)
+    for feat in features:
+        provider.addFeature(feat,QgsFeatureSink.FastInsert)
+    return layer.featureCount()
+
+def _writeFile( engine, results, extension ):
+    from classify import ClassifyWriters
+    writer=ClassifyWriters.writerForFile('bench'+extension)
+    fd,filename=tempfile.mkstemp(extension,'bench_classify')
+    os.close(fd)
+    try:
+        records=((engine.featureAttributes(r),r.geometry) for r in results)
+        return writer(filename,records,engine.fieldDefs())
+    finally:
+        os.remove(filename)
+
+def _levelParams( method, z, nlevels ):
+    zmin=float(np.min(z))
+    zmax=float(np.max(z))
+    if method == 'interval':
+        return {'interval': (zmax-zmin)/nlevels}
+    if method == 'manual':
+        return {'levels': list(np.linspace(zmin,zmax,nlevels+1))}
+    return {'ncontour': nlevels}
+
+def benchmarkDataset( name, npoints, options, record ):
+    '''
+    Run each requested stage for a single dataset, calling record for
+    each timing.
+    '''
+    from classify import ClassifyUtils, ClassifyMethod
+    from classify.ClassifyEngine import ClassifyEngine
+    from classify.DataGridder import DataGridder
+
+    stages=options.stages
+    repeat=options.repeat
+    x,y,z=datasets.makeDataset(name,npoints,options.seed)
+    npt=x.shape[0]
+
+    def save( stage, variant, timing, **counts ):
+        entry={'dataset': name,'npoints': npt,'stage': stage,'variant': variant}
+        entry.update(timing)
+        entry.update(counts)
+        record(entry)
+
+    def skip( stage, variant, reason ):
+        record({'dataset': name,'npoints': npt,'stage': stage,
+                'variant': variant,'skipped': reason})
+
+    if 'dedup' in stages:
+        index,timing=_timeit(lambda: ClassifyUtils.discardDuplicatePoints(
+            x,y,options.tolerance),repeat)
+        save('dedup','',timing,retained=int(len(index)))
+
+    gridded=False
+    shape=None
+    order=None
+    if 'grid' in stages or 'contour' in stages:
+        (shape,order),timing=_timeit(lambda: DataGridder(x,y).calcGrid(),repeat)
+        gridded=shape is not None
+        if 'grid' in stages:
+            save('grid','',timing,gridded=gridded)
+
+    engine=None
+    needtrig=('triangulation' in stages
+              or (('contour' in stages) and not gridded))
+    if needtrig:
+        def triangulate():
+            engine=ClassifyEngine(x,y,z)
+            engine.triangulation()
+            return engine
+        engine,timing=_timeit(triangulate,repeat)
+        save('triangulation','',timing,
+             triangles=int(engine.triangulation().triangles.shape[0]))
+
+    levels=None
+    if 'levels' in stages or 'contour' in stages:
+        # Methods using the point locations reuse the engine triangulation
+        if engine is None:
+            engine=ClassifyEngine(x,y,z)
+        engine.setUseGrid(gridded)
+        for method in ClassifyMethod.methods:
+            params=_levelParams(method.id,z,options.levels)
+            try:
+                result,timing=_timeit(
+                    lambda: ClassifyMethod.calculateLevels(z,method.id,data=engine,**params),
+                    repeat)
+            except Exception as ex:
+                skip('levels',method.id,str(ex))
+                continue
+            if method.id == 'equal':
+                levels=result
+            if 'levels' in stages:
+                save('levels',method.id,timing,nlevels=int(len(result)))
+        if levels is None:
+            levels=np.linspace(np.min(z),np.max(z),options.levels+1)
+
+    if 'contour' not in stages:
+        return
+
+    if engine is None:
+        engine=ClassifyEngine(x,y,z)
+    engine.setUseGrid(gridded)
+    engine.setClassifyLevels(levels)
+    variant='grid' if gridded else 'triangulation'
+
+    haveQgis=('geometry' in stages or 'write' in stages) and _initQgis()
+    for ctype in options.types:
+        engine.setClassifyType(ctype)
+        if ctype == 'raster':
+            def rasterize():
+                raster=engine.rasterDefinition()
+                for row,block in engine.rasterBlocks(raster):
+                    pass
+                return raster
+            raster,timing=_timeit(rasterize,repeat)
+            save('contour',ctype+':'+variant,timing,cells=raster.nrows*raster.ncols)
+            continue
+        results,timing=_timeit(lambda: list(engine.features()),repeat)
+        nvertex=int(sum(r.geometry.nVertices() for r in results))
+        save('contour',ctype+':'+variant,timing,
+             features=len(results),vertices=nvertex)
+        if 'geometry' in stages:
+            wkb,timing=_timeit(lambda: [r.geometry.wkb() for r in results],repeat)
+            save('geometry',ctype+':wkb',timing,features=len(wkb))
+        if 'write' in stages:
+            for extension in options.formats:
+                count,timing=_timeit(lambda: _writeFile(engine,results,extension),repeat)
+                save('write',ctype+':'+extension.lstrip('.'),timing,features=int(count))
+        if not ('geometry' in stages or 'write' in stages):
+            continue
+        if not haveQgis:
+            skip('geometry',ctype+':qgis','qgis not available')
+            skip('write',ctype+':memory','qgis not available')
+            continue
+        geoms,timing=_timeit(lambda: _buildQgsGeometries(results),repeat)
+        if 'geometry' in stages:
+            save('geometry',ctype+':qgis',timing,features=len(geoms))
+        if 'write' in stages:
+            count,timing=_timeit(lambda: _writeQgsGeometries(geoms,ctype),repeat)
+            save('write',ctype+':memory',timing,features=int(count))
+
+def _parseList( value, func=str ):
+    return [func(v) for v in value.split(',') if v.strip() != '']
+
+def _parseSize( value ):
+    return int(float(value))
+
+def runBenchmarks( options ):
+    results=[]
+    def record( entry ):
+        results.append(entry)
+        if not options.quiet:
+            if 'skipped' in entry:
+                timing='skipped: '+entry['skipped']
+            else:
+                timing='{0:10.4f}s wall {1:10.4f}s cpu'.format(
+                    entry['wall_min'],entry['cpu_min'])
+            sys.stderr.write('{dataset:>10} {npoints:>9} {stage:>13} {variant:<24}'
+                             .format(**entry)+timing+'\n')
+    for npoints in options.sizes:
+        for name in options.datasets:
+            benchmarkDataset(name,npoints,options,record)
+    return {'environment': _environment(),
+            'options': {
+                'sizes': options.sizes,
+                'datasets': options.datasets,
+                'stages': options.stages,
+                'types': options.types,
+                'formats': options.formats,
+                'levels': options.levels,
+                'tolerance': options.tolerance,
+                'repeat': options.repeat,
+                'seed': options.seed,
+                },
+            'results': results}
+
+def _resultKey( entry ):
+    return (entry['dataset'],entry['npoints'],entry['stage'],entry['variant'])
+
+def compareResults( base, current, threshold ):
+    '''
+    Compare two result sets, returning a list of (key, base, current,
+    ratio) for each timing present in both, and a flag indicating if any
+    ratio exceeds the threshold.
+    '''
+    basetimes={_resultKey(e): e['wall_min'] for e in base['results'] if 'wall_min' in e}
+    comparison=[]
+    regressed=False
+    for e in current['results']:
+        key=_resultKey(e)
+        if 'wall_min' not in e or key not in basetimes:
+            continue
+        t0=basetimes[key]
+        t1=e['wall_min']
+        ratio=t1/t0 if t0 > 0 else float('inf')
+        if ratio > threshold:
+            regressed=True
+        comparison.append((key,t0,t1,ratio))
+    return comparison,regressed
+
+def main( argv=None ):
+    parser=argparse.ArgumentParser(description='Benchmark the classify plugin pipeline')
+    commands=parser.add_subparsers(dest='command')
+    run=commands.add_parser('run',help='Run the benchmarks')
+    run.add_argument('--sizes',type=lambda v: _parseList(v,_parseSize),
+                     default=[10000,100000,1000000],
+                     help='Comma separated numbers of points, eg 1e4,1e5,1e6,1e7')
+    run.add_argument('--datasets',type=_parseList,default=list(datasets.generators),
+                     help='Comma separated datasets from '+','.join(datasets.generators))
+    run.add_argument('--stages',type=_parseList,default=Stages,
+                     help='Comma separated stages from '+','.join(Stages))
+    run.add_argument('--types',type=_parseList,default=['line','filled','layer'],
+                     help='Contour types to generate (line, filled, layer, raster)')
+    run.add_argument('--formats',type=_parseList,default=['.geojson'],
+                     help='Comma separated file extensions for the write stage')
+    run.add_argument('--levels',type=int,default=10,help='Number of levels')
+    run.add_argument('--tolerance',type=float,default=0.1,
+                     help='Duplicate point tolerance')
+    run.add_argument('--repeat',type=int,default=3,help='Repeats of each timing')
+    run.add_argument('--seed',type=int,default=0,help='Random seed for datasets')
+    run.add_argument('-o','--output',help='JSON file for results (default stdout)')
+    run.add_argument('-q','--quiet',action='store_true',help='No progress output')
+    compare=commands.add_parser('compare',help='Compare two result files')
+    compare.add_argument('base',help='Baseline results JSON')
+    compare.add_argument('current',help='Current results JSON')
+    compare.add_argument('--threshold',type=float,default=1.2,
+                         help='Ratio of times counted as a regression')
+    options=parser.parse_args(argv)
+
+    if options.command == 'run':
+        for name in options.datasets:
+            if name not in datasets.generators:
+                parser.error('Invalid dataset {0}'.format(name))
+        for stage in options.stages:
+            if stage not in Stages:
+                parser.error('Invalid stage {0}'.format(stage))
+        results=runBenchmarks(options)
+        text=json.dumps(results,indent=2)
+        if options.output:
+            with open(options.output,'w') as rf:
+                rf.write(text)
+        else:
+            print(text)
+        return 0
+
+    if options.command == 'compare':
+        with open(options.base) as bf:
+            base=json.load(bf)
+        with open(options.current) as cf:
+            current=json.load(cf)
+        comparison,regressed=compareResults(base,current,options.threshold)
+        for key,t0,t1,ratio in comparison:
+            flag=' <<<' if ratio > options.threshold else ''
+            print('{0:>10} {1:>9} {2:>13} {3:<24} {4:10.4f} {5:10.4f} {6:6.2f}{7}'
+                  .format(*key,t0,t1,ratio,flag))
+        return 1 if regressed else 0
+
+    parser.print_help()
+    return 2
+
+if __name__ == '__main__':
+    sys.exit(main())
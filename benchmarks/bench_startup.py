@@ -0,0 +1,134 @@
+'''
+Startup time benchmark for the classify plugin.
+
+Each measurement is made in a fresh python process so that modules
+already imported by an earlier measurement do not hide their cost.
+Measures the time for QGIS to load the plugin (classFactory plus
+initGui, using an offscreen QgsApplication and a minimal iface), and the
+time to import the headless engine and command line tool.  Also reports
+which of numpy and matplotlib were imported.  The processing algorithm
+imports them when it is first run, and the dialog when it is first
+opened.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_startup --repeat 5 -o startup.json
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+_root=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_heavyModules=['numpy','matplotlib','matplotlib.pyplot','matplotlib.tri','contourpy']
+
+_loadedScript='''
+def _loaded():
+    return {name: name in sys.modules for name in HEAVY}
+'''
+
+_pluginScript='''
+import json, os, sys, time
+os.environ.setdefault('QT_QPA_PLATFORM','offscreen')
+try:
+    from qgis.core import QgsApplication
+except ImportError:
+    print(json.dumps({'skipped': 'qgis not available'}))
+    sys.exit(0)
+from PyQt5.QtWidgets import QMainWindow, QMenu
+LOADED
+app=QgsApplication([],True)
+app.initQgis()
+
+class Iface:
+    def __init__(self):
+        self._mainWindow=QMainWindow()
+        self._rasterMenu=QMenu()
+    def mainWindow(self):
+        return self._mainWindow
+    def rasterMenu(self):
+        return self._rasterMenu
+    def addToolBarIcon(self,action):
+        pass
+    def removeToolBarIcon(self,action):
+        pass
+    def removePluginMenu(self,name,action):
+        pass
+
+iface=Iface()
+t0=time.perf_counter()
+import classify
+plugin=classify.classFactory(iface)
+t1=time.perf_counter()
+plugin.initGui()
+t2=time.perf_counter()
+loaded=_loaded()
+plugin.unload()
+print(json.dumps({
+    'classFactory': t1-t0,
+    'initGui': t2-t1,
+    'total': t2-t0,
+    'loaded': loaded,
+    }))
+'''
+
+_importScript='''
+import json, sys, time
+LOADED
+t0=time.perf_counter()
+import MODULE
+t1=time.perf_counter()
+print(json.dumps({'total': t1-t0, 'loaded': _loaded()}))
+'''
+
+def _runScript( script ):
+    script=script.replace('LOADED',_loadedScript.replace('HEAVY',repr(_heavyModules)))
+    output=subprocess.check_output([sys.executable,'-c',script],cwd=_root)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def _measure( name, script, repeat ):
+    '''
+    Run the script repeat times and record the minimum of each timing
+    '''
+    runs=[_runScript(script) for i in range(repeat)]
+    if 'skipped' in runs[0]:
+        return {'name': name, 'skipped': runs[0]['skipped']}
+    result={'name': name, 'repeat': repeat, 'loaded': runs[-1]['loaded']}
+    for key in runs[0]:
+        if key != 'loaded':
+            result[key]=min(run[key] for run in runs)
+    return result
+
+def runBenchmarks( repeat ):
+    results=[_measure('plugin',_pluginScript,repeat)]
+    for module in ('classify.ClassifyEngine','classify.ClassifyCli'):
+        results.append(_measure(module,_importScript.replace('MODULE',module),repeat))
+    return results
+
+def _report( results ):
+    for result in results:
+        if 'skipped' in result:
+            print('{0}: skipped ({1})'.format(result['name'],result['skipped']))
+            continue
+        times=', '.join('{0} {1:.1f}ms'.format(k,v*1000.0) for k,v in result.items()
+                        if k not in ('name','repeat','loaded'))
+        loaded=[name for name,isloaded in result['loaded'].items() if isloaded]
+        print('{0}: {1}; loaded: {2}'.format(result['name'],times,', '.join(loaded) or 'none'))
+
+def main( argv=None ):
+    parser=argparse.ArgumentParser(description='Classify plugin startup benchmark')
+    parser.add_argument('--repeat',type=int,default=3,help='Number of runs of each measurement')
+    parser.add_argument('-o','--output',help='JSON file to write results to')
+    options=parser.parse_args(argv)
+    results=runBenchmarks(options.repeat)
+    _report(results)
+    if options.output:
+        with open(options.output,'w') as rf:
+            json.dump({'results': results},rf,indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
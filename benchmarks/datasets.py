@@ -0,0 +1,124 @@
+'''
+Synthetic point datasets for benchmarking the classify plugin.
+
+Each generator returns x, y, z numpy arrays of (approximately) npoints
+points.  Coordinates are in a projected CRS like range (metres, with a
+large false origin) so that precision effects are representative of
+real data.  All generators are deterministic for a given seed.
+'''
+
+import numpy as np
+
+X0=500000.0
+Y0=6000000.0
+EXTENT=10000.0
+
+def surface( x, y ):
+    '''
+    Smooth test surface with a few bumps and a trend, evaluated at
+    x, y relative to the dataset origin.
+    '''
+    u=(x-X0)/EXTENT
+    v=(y-Y0)/EXTENT
+    z=(100.0*u+50.0*v
+       +40.0*np.sin(6.0*u)*np.cos(4.0*v)
+       +80.0*np.exp(-((u-0.3)**2+(v-0.6)**2)/0.02)
+       -60.0*np.exp(-((u-0.7)**2+(v-0.3)**2)/0.05))
+    return z
+
+def _gridShape( npoints ):
+    ncol=max(int(np.sqrt(npoints)),2)
+    nrow=max(npoints//ncol,2)
+    return nrow,ncol
+
+def regularGrid( npoints, seed=0 ):
+    '''
+    Axis aligned regular grid ordered by row
+    '''
+    nrow,ncol=_gridShape(npoints)
+    gx,gy=np.meshgrid(
+        np.linspace(X0,X0+EXTENT,ncol),
+        np.linspace(Y0,Y0+EXTENT,nrow))
+    x=gx.ravel()
+    y=gy.ravel()
+    return x, y, surface(x,y)
+
+def rotatedGrid( npoints, seed=0, angle=30.0, shuffle=True ):
+    '''
+    Regular grid rotated by angle degrees.  If shuffle is true the
+    points are randomly ordered so that grid detection has to reorder
+    them.
+    '''
+    nrow,ncol=_gridShape(npoints)
+    gu,gv=np.meshgrid(
+        np.linspace(0.0,EXTENT,ncol),
+        np.linspace(0.0,EXTENT,nrow))
+    gu=gu.ravel()
+    gv=gv.ravel()
+    a=np.radians(angle)
+    x=X0+gu*np.cos(a)-gv*np.sin(a)
+    y=Y0+gu*np.sin(a)+gv*np.cos(a)
+    if shuffle:
+        order=np.random.default_rng(seed).permutation(x.shape[0])
+        x=x[order]
+        y=y[order]
+    return x, y, surface(x,y)
+
+def scatteredUniform( npoints, seed=0 ):
+    '''
+    Points uniformly distributed over the extent
+    '''
+    rng=np.random.default_rng(seed)
+    x=X0+rng.random(npoints)*EXTENT
+    y=Y0+rng.random(npoints)*EXTENT
+    return x, y, surface(x,y)
+
+def clustered( npoints, seed=0, nclusters=20, lineFraction=0.5 ):
+    '''
+    Clustered sampling typical of survey data - dense survey lines
+    plus gaussian clusters of points, leaving sparse gaps between.
+    '''
+    rng=np.random.default_rng(seed)
+    nline=int(npoints*lineFraction)
+    nclust=npoints-nline
+    nlines=max(int(np.sqrt(nline)/10),1)
+    lineid=rng.integers(0,nlines,nline)
+    lx=X0+rng.random(nline)*EXTENT
+    ly=Y0+(lineid+0.5)*EXTENT/nlines+rng.normal(0.0,EXTENT*0.001,nline)
+    centres=rng.random((nclusters,2))*EXTENT
+    cid=rng.integers(0,nclusters,nclust)
+    cx=X0+centres[cid,0]+rng.normal(0.0,EXTENT*0.02,nclust)
+    cy=Y0+centres[cid,1]+rng.normal(0.0,EXTENT*0.02,nclust)
+    x=np.concatenate((lx,cx))
+    y=np.concatenate((ly,cy))
+    return x, y, surface(x,y)
+
+def nearDuplicates( npoints, seed=0, duplicateFraction=0.5, jitter=0.01 ):
+    '''
+    Scattered points where duplicateFraction of the points are near
+    duplicates (within jitter) of other points.
+    '''
+    rng=np.random.default_rng(seed)
+    nbase=max(int(npoints*(1.0-duplicateFraction)),3)
+    x,y,z=scatteredUniform(nbase,seed)
+    ndup=npoints-nbase
+    src=rng.integers(0,nbase,ndup)
+    dx=x[src]+rng.normal(0.0,jitter,ndup)
+    dy=y[src]+rng.normal(0.0,jitter,ndup)
+    x=np.concatenate((x,dx))
+    y=np.concatenate((y,dy))
+    return x, y, surface(x,y)
+
+generators={
+    'grid': regularGrid,
+    'rotated': rotatedGrid,
+    'uniform': scatteredUniform,
+    'clustered': clustered,
+    'duplicates': nearDuplicates,
+    }
+
+def makeDataset( name, npoints, seed=0 ):
+    if name not in generators:
+        raise ValueError("Invalid dataset {0} - must be one of {1}"
+                         .format(name,', '.join(generators)))
+    return generators[name](int(npoints),seed=seed)
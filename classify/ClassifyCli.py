@@ -0,0 +1,215 @@
+'''
+Command line interface to the QGIS independent classification engine.
+Classifies x, y, z points in an input file and writes the result to an
+output file, for example
+
+    python -m classify points.csv contours.geojson --method equal --ncontour 10
+
+The input can be a CSV file with a header row, a .npy file with an
+(n,3) array of x, y, z, or a .npz file with x, y and z arrays.  The
+output format is determined by the output file extension.
+'''
+
+import argparse
+import csv
+import os
+import sys
+
+import numpy as np
+
+from .ClassifyEngine import (
+    ClassifyEngine,
+    ClassifyError,
+    ClassifyType,
+    ClassifyExtendOption,
+    ClassifyInterpolation,
+    ClassifyPath,
+    relativeCoordinates
+    )
+from .ClassifyMethod import ClassifyMethodError
+from . import ClassifyMethod
+from . import ClassifyWriters
+
+def readPoints( filename, xField='x', yField='y', zField='z', delimiter=',' ):
+    '''
+    Read x, y, z arrays from a CSV, .npy, or .npz file
+    '''
+    ext=os.path.splitext(filename)[1].lower()
+    if ext == '.npy':
+        data=np.load(filename)
+        if data.ndim != 2 or data.shape[1] < 3:
+            raise ClassifyError("{0} must contain an (n,3) array".format(filename))
+        return data[:,0],data[:,1],data[:,2]
+    if ext == '.npz':
+        with np.load(filename) as data:
+            return data[xField],data[yField],data[zField]
+    with open(filename,newline='') as cf:
+        header=next(csv.reader(cf,delimiter=delimiter))
+    header=[h.strip() for h in header]
+    columns=[]
+    for field in (xField,yField,zField):
+        if field not in header:
+            raise ClassifyError("Field {0} not in {1}".format(field,filename))
+        columns.append(header.index(field))
+    data=np.loadtxt(filename,delimiter=delimiter,skiprows=1,usecols=columns,ndmin=2)
+    return data[:,0],data[:,1],data[:,2]
+
+def _parser():
+    parser=argparse.ArgumentParser(
+        prog='classify',
+        description='Classify point data into contour lines or polygons')
+    parser.add_argument('input',help='Input points file (.csv, .npy, .npz)')
+    parser.add_argument('output',help='Output file ({0})'
+                        .format(', '.join(list(ClassifyWriters.writers)+
+                                          list(ClassifyWriters.rasterWriters))))
+    parser.add_argument('--x-field',default='x',help='Name of x field')
+    parser.add_argument('--y-field',default='y',help='Name of y field')
+    parser.add_argument('--z-field',default='z',help='Name of value field')
+    parser.add_argument('--delimiter',default=',',help='CSV delimiter')
+    parser.add_argument('--crs',help='Authority id of the coordinate system, eg EPSG:28355')
+    parser.add_argument('--lonlat',action='store_true',
+                        help='Coordinates are longitude/latitude (for duplicate tolerance)')
+    parser.add_argument('--tolerance',type=float,default=0.0,
+                        help='Duplicate point tolerance')
+    parser.add_argument('--float32',action='store_true',
+                        help='Store coordinates relative to the data centre in single precision')
+    parser.add_argument('--type',default=ClassifyType.line,choices=ClassifyType.types(),
+                        help='Output type')
+    parser.add_argument('--extend',default=ClassifyExtendOption.both,
+                        choices=ClassifyExtendOption.options(),
+                        help='Extend option for filled output')
+    parser.add_argument('--method',default='equal',
+                        choices=[m.id for m in ClassifyMethod.methods],
+                        help='Level calculation method')
+    parser.add_argument('--ncontour',type=int,default=10,
+                        help='Number (or maximum number) of levels')
+    parser.add_argument('--min',type=float,help='Minimum level')
+    parser.add_argument('--max',type=float,help='Maximum level')
+    parser.add_argument('--interval',type=float,help='Level interval')
+    parser.add_argument('--offset',type=float,help='Level offset for interval method')
+    parser.add_argument('--levels',help='Space separated levels for manual method')
+    parser.add_argument('--mantissa',help='Space separated mantissa for log method')
+    parser.add_argument('--sample',type=int,
+                        help='Sample size for natural breaks method')
+    parser.add_argument('--resolution',type=float,
+                        help='Pixel size for raster output of data not on a grid')
+    parser.add_argument('--interpolate',default=ClassifyInterpolation.none,
+                        choices=ClassifyInterpolation.options(),
+                        help='Interpolate scattered data to a grid before contouring')
+    parser.add_argument('--cell-size',type=float,
+                        help='Interpolation grid cell size (default mean point spacing)')
+    parser.add_argument('--idw-power',type=float,default=2.0,
+                        help='Inverse distance weighting power')
+    parser.add_argument('--idw-neighbours',type=int,default=8,
+                        help='Number of neighbours used for inverse distance weighting')
+    parser.add_argument('--path',default=ClassifyPath.auto,choices=ClassifyPath.options(),
+                        help='Calculation path (auto chooses by estimated cost)')
+    parser.add_argument('--path-tolerance',type=float,
+                        help='Largest interpolation cell size the auto path may use')
+    parser.add_argument('--lod',type=int,default=1,
+                        help='Number of levels of detail written with a lod field')
+    parser.add_argument('--lod-tolerance',type=float,
+                        help='Simplification tolerance of the first level of detail')
+    parser.add_argument('--drop-minor',action='store_true',
+                        help='Drop minor levels at coarser levels of detail')
+    parser.add_argument('--memory-budget',type=float,
+                        help='Memory budget in MB, met by cheaper strategies where possible')
+    parser.add_argument('--workers',type=int,default=0,
+                        help='Number of threads contouring while the output is written')
+    parser.add_argument('--no-grid',action='store_true',
+                        help='Triangulate even if the data are on a regular grid')
+    parser.add_argument('--label-ndp',type=int,default=-1,
+                        help='Label decimal places (-1 for auto)')
+    parser.add_argument('--trim-zeros',action='store_true',
+                        help='Trim trailing zeros from labels')
+    parser.add_argument('--units',default='',help='Units appended to labels')
+    parser.add_argument('--stats',action='store_true',
+                        help='Write timing statistics to stderr')
+    return parser
+
+class _StderrFeedback:
+
+    def __init__( self, verbose ):
+        self._verbose=verbose
+
+    def isCanceled( self ):
+        return False
+
+    def setProgress( self, percent ):
+        pass
+
+    def pushInfo( self, info ):
+        if self._verbose:
+            sys.stderr.write(info+'\n')
+
+    def reportError( self, message, fatal=False ):
+        raise ClassifyError( message )
+
+def run( options ):
+    '''
+    Run the classification defined by the parsed command line options.
+    Returns the number of features (or raster rows) written.
+    '''
+    engine=ClassifyEngine(feedback=_StderrFeedback(options.stats))
+    stats=engine.statistics()
+    with stats.stage('load'):
+        x,y,z=readPoints(options.input,options.x_field,options.y_field,
+                         options.z_field,options.delimiter)
+    if len(x) < 3:
+        raise ClassifyError("Too few points to Classify")
+    stats.setCount('points',len(x))
+    x,y,origin=relativeCoordinates(x,y,options.float32,options.tolerance or None)
+    engine.setData(x,y,z,origin)
+    if options.memory_budget:
+        engine.setMemoryBudget(options.memory_budget*1048576)
+    engine.discardDuplicatePoints(options.tolerance,options.lonlat)
+    engine.setUseGrid(not options.no_grid)
+    engine.setInterpolation(options.interpolate,options.cell_size,
+                            options.idw_power,options.idw_neighbours)
+    engine.setCalculationPath(options.path,options.path_tolerance)
+    params={
+        'ncontour': options.ncontour,
+        'maxcontour': options.ncontour,
+        'min': options.min,
+        'max': options.max,
+        'interval': options.interval,
+        'offset': options.offset,
+        'levels': options.levels,
+        'mantissa': options.mantissa,
+        'sample': options.sample,
+        }
+    engine.setClassifyMethod(options.method,params)
+    engine.setClassifyType(options.type)
+    engine.setClassifyExtendOption(options.extend)
+    engine.setLabelFormat(options.label_ndp,options.trim_zeros,options.units)
+    engine.setLevelsOfDetail(options.lod,options.lod_tolerance,dropMinor=options.drop_minor)
+
+    if ClassifyType.isRaster(options.type):
+        writer=ClassifyWriters.rasterWriterForFile(options.output)
+        raster=engine.rasterDefinition(options.resolution)
+        with stats.stage('write'):
+            count=writer(options.output,raster,engine.rasterBlocks(raster),
+                         engine.classLabels(),options.crs)
+    else:
+        writer=ClassifyWriters.writerForFile(options.output)
+        fieldDefs=engine.fieldDefs(options.z_field)
+        features=engine.pipelinedFeatures(options.workers) if options.workers > 0 else engine.features()
+        # The write stage only times the writer, not contouring the features
+        records=((engine.featureAttributes(f),f.geometry) for f in stats.excluding(features))
+        with stats.stage('write'):
+            count=writer(options.output,records,fieldDefs,options.crs)
+    if options.stats:
+        sys.stderr.write(stats.summary()+'\n')
+    return count
+
+def main( argv=None ):
+    options=_parser().parse_args(argv)
+    try:
+        run(options)
+    except (ClassifyError, ClassifyMethodError, ClassifyWriters.ClassifyWriterError) as ex:
+        sys.stderr.write('Error: {0}\n'.format(ex.message()))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
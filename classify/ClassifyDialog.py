@@ -9,6 +9,7 @@ from . import ClassifyMethod
 from .ClassifyMethod import ClassifyMethodError
 from .ClassifyGenerator import ClassifyGenerator, ClassifyType, ClassifyExtendOption
 from .ClassifyGenerator import ClassifyError, ClassifyGenerationError
+from .ClassifyPreview import ClassifyPreview
 
 import sys
 import os.path
@@ -17,14 +18,10 @@ import math
 import re
 import inspect
 
-mplAvailable = True
-try:
-    import numpy as np
-    import matplotlib as mpl
-    import matplotlib.pyplot as plt
-    from matplotlib.mlab import griddata
-except ImportError:
-    mplAvailable = False
+from . import ClassifyUtils
+from .ClassifyDialogPlugin import ClassifyDialogPlugin
+
+import numpy as np
 
 from .ClassifyDialogUi import Ui_ClassifyDialog
 
@@ -33,57 +30,110 @@ LINES = "lines"
 FILLED = "filled"
 BOTH = "both"
 LAYERS = "layer"
+COLOR_FIELD = "color"
 
 
 def tr(string):
     return QCoreApplication.translate("Processing", string)
 
 
-class ClassifyDialogPlugin:
-    def __init__(self, iface):
-        self._iface = iface
-
-    def initGui(self):
-        if not mplAvailable:
-            QMessageBox.warning(
-                self._iface.mainWindow(),
-                tr("Classify error"),
-                tr(
-                    "The Classify plugin is disabled as it requires python modules"
-                    " numpy and matplotlib which are not both installed"
-                ),
-            )
+class ClassifyLayerIndex:
+    """
+    Index of the Classify layers in a project by ClassifyId and by source
+    layer and attribute, so that finding the layers of a set does not
+    read the properties of every layer in the project.  Built once and
+    kept up to date from the project layersAdded and layersRemoved
+    signals.  getProperties returns the Classify properties of a layer,
+    or None if it is not a Classify layer.
+    """
+
+    def __init__(self, project, getProperties):
+        self._project = project
+        self._getProperties = getProperties
+        self._properties = {}
+        self._byClassifyId = {}
+        self._bySource = {}
+        for layer in list(project.mapLayers().values()):
+            self._add(layer)
+        project.layersAdded.connect(self.layersAdded)
+        project.layersRemoved.connect(self.layersRemoved)
+        self._connected = True
+
+    def close(self, *args):
+        if self._connected:
+            self._project.layersAdded.disconnect(self.layersAdded)
+            self._project.layersRemoved.disconnect(self.layersRemoved)
+            self._connected = False
+
+    def _add(self, layer):
+        properties = self._getProperties(layer)
+        if not properties:
+            return
+        layerId = layer.id()
+        self._properties[layerId] = (layer, properties)
+        self._byClassifyId.setdefault(properties.get("ClassifyId"), {})[layerId] = layer
+        source = (properties.get("SourceLayerId"), properties.get("SourceLayerAttr"))
+        self._bySource.setdefault(source, {})[layerId] = layer
+
+    def _remove(self, layerId):
+        entry = self._properties.pop(layerId, None)
+        if entry is None:
             return
+        properties = entry[1]
+        source = (properties.get("SourceLayerId"), properties.get("SourceLayerAttr"))
+        for index, key in (
+            (self._byClassifyId, properties.get("ClassifyId")),
+            (self._bySource, source),
+        ):
+            layers = index.get(key, {})
+            layers.pop(layerId, None)
+            if not layers:
+                index.pop(key, None)
 
-        self.action = QAction(
-            QIcon(":/plugins/classify/classify.png"),
-            "Classify",
-            self._iface.mainWindow(),
-        )
-        self.action.setWhatsThis(tr("Generate Classifys based on point vector data"))
-        self.action.triggered.connect(self.run)
-        self._iface.addToolBarIcon(self.action)
-        self._iface.rasterMenu().addAction(self.action)
+    def layersAdded(self, layers):
+        for layer in layers:
+            self._remove(layer.id())
+            self._add(layer)
+
+    def layersRemoved(self, layerIds):
+        for layerId in layerIds:
+            self._remove(layerId)
+
+    def update(self, layer):
+        """
+        Reindex a layer after its Classify properties are changed
+        """
+        self._remove(layer.id())
+        if self._project.mapLayer(layer.id()) is not None:
+            self._add(layer)
+
+    def properties(self, layer):
+        entry = self._properties.get(layer.id())
+        return entry[1] if entry is not None else None
+
+    def layers(self, ClassifyId=None, source=None):
+        """
+        The indexed layers, optionally only those with ClassifyId and
+        those with source, a (SourceLayerId, SourceLayerAttr) tuple
+        """
+        if ClassifyId is not None:
+            layers = self._byClassifyId.get(ClassifyId, {})
+        elif source is not None:
+            layers = self._bySource.get(source, {})
+        else:
+            layers = {layerId: entry[0] for layerId, entry in self._properties.items()}
+        if ClassifyId is not None and source is not None:
+            bySource = self._bySource.get(source, {})
+            layers = {layerId: l for layerId, l in layers.items() if layerId in bySource}
+        return list(layers.values())
 
-    def unload(self):
-        try:
-            self._iface.removePluginMenu("&Classify", self.action)
-            self._iface.rasterMenu().removeAction(self.action)
-            self._iface.removeToolBarIcon(self.action)
-        except:
-            pass
 
-    def run(self):
-        try:
-            dlg = ClassifyDialog(self._iface)
-            dlg.exec_()
-        except ClassifyError:
-            QMessageBox.warning(
-                self._iface.mainWindow(), tr("Classify error"), str(sys.exc_info()[1])
-            )
+class ClassifyDialog(QDialog, Ui_ClassifyDialog):
 
+    # Layers with more levels than this are coloured from a colour
+    # attribute by a single symbol rather than by a category per level
+    MaxCategorizedLevels = 50
 
-class ClassifyDialog(QDialog, Ui_ClassifyDialog):
     class Feedback:
         def __init__(self, messagebar, progress):
             self._messageBar = messagebar
@@ -136,17 +186,32 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
         for option in ClassifyExtendOption.options():
             self.uExtend.addItem(ClassifyExtendOption.description(option), option)
 
+        self._layerIndex = ClassifyLayerIndex(
+            QgsProject.instance(), self.getClassifyProperties
+        )
+        self.finished.connect(self._layerIndex.close)
+
         self._feedback = ClassifyDialog.Feedback(self.uMessageBar, self.progressBar)
         self._generator = ClassifyGenerator(feedback=self._feedback)
 
         self.loadSettings()
 
         mapCanvas = self._iface.mapCanvas()
+
+        # Preview updates are delayed until the parameters stop changing
+        self._preview = ClassifyPreview(mapCanvas)
+        self._preview.failed.connect(self.previewFailed)
+        self._previewTimer = QTimer(self)
+        self._previewTimer.setSingleShot(True)
+        self._previewTimer.setInterval(ClassifyPreview.Delay)
+        self._previewTimer.timeout.connect(self.updatePreview)
+
         self.enableClassifyParams()
         self.enableOkButton()
 
         # Signals
         self.uSourceLayer.layerChanged.connect(self.uSourceLayerChanged)
+        self.uLimitToExtent.toggled[bool].connect(self.reloadData)
         self.uSetMinimum.toggled[bool].connect(self.toggleSetMinimum)
         self.uSetMaximum.toggled[bool].connect(self.toggleSetMaximum)
         self.uPrecision.valueChanged[int].connect(self.updatePrecision)
@@ -154,6 +219,18 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
         self.uAddButton.clicked.connect(self.addClassifys)
         self.uCloseButton.clicked.connect(self.closeDialog)
         self.uMethod.currentIndexChanged[int].connect(self.enableClassifyParams)
+        self.uMethod.currentIndexChanged[int].connect(self.schedulePreview)
+        self.uNClassify.valueChanged[int].connect(self.schedulePreview)
+        self.uMinClassify.valueChanged[float].connect(self.schedulePreview)
+        self.uMaxClassify.valueChanged[float].connect(self.schedulePreview)
+        self.uClassifyInterval.valueChanged[float].connect(self.schedulePreview)
+        self.uSetMinimum.toggled[bool].connect(self.schedulePreview)
+        self.uSetMaximum.toggled[bool].connect(self.schedulePreview)
+        self.uExtend.currentIndexChanged[int].connect(self.schedulePreview)
+        self.uLayerClassifys.toggled[bool].connect(self.schedulePreview)
+        self.uApplyColors.toggled[bool].connect(self.schedulePreview)
+        self.uReverseRamp.toggled[bool].connect(self.schedulePreview)
+        self.uColorRamp.colorRampChanged.connect(self.schedulePreview)
 
         # populate layer list
         if self.uSourceLayer.count() <= 0:
@@ -173,6 +250,55 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
         self.saveSettings()
         self.close()
 
+    def closeEvent(self, event):
+        self._previewTimer.stop()
+        self._preview.close()
+        self._layerIndex.close()
+        QDialog.closeEvent(self, event)
+
+    def previewFailed(self, message):
+        self.warnUser(tr("Preview failed: {0}").format(message))
+
+    def schedulePreview(self, *args):
+        self._previewTimer.start()
+
+    def updatePreview(self):
+        """
+        Contour a decimated copy of the data in the background and show
+        it on the map canvas
+        """
+        x, y, z = self._generator.data()
+        if z is None:
+            self._preview.clear()
+            return
+        methodcode, params = self.ClassifyLevelParams()
+        self._generator.setClassifyMethod(methodcode, params)
+        ctype = (
+            ClassifyType.layer if self.uLayerClassifys.isChecked() else ClassifyType.line
+        )
+        extend = self.uExtend.itemData(self.uExtend.currentIndex())
+        self._preview.update(
+            self._generator.engine(),
+            ctype,
+            extend,
+            self._generator.crs(),
+            self.previewColors(),
+        )
+
+    def previewColors(self):
+        ramp = self.uColorRamp.colorRamp()
+        if not self.uApplyColors.isChecked() or ramp is None:
+            return None
+        reversed = self.uReverseRamp.isChecked()
+
+        def color(i, n):
+            rampvalue = float(i) / (n - 1) if n > 1 else 0.0
+            if reversed:
+                rampvalue = 1.0 - rampvalue
+            return ramp.color(rampvalue)
+
+        return color
+
     def updatePrecision(self, ndp):
         self.setLabelFormat()
         ndp = self.uPrecision.value()
@@ -201,7 +327,7 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
     def setupCurrentLayer(self, layer):
         if not layer:
             return
-        properties = self.getClassifyProperties(layer)
+        properties = self._layerIndex.properties(layer)
         ClassifyId = ""
         sourceLayer = None
         if properties:
@@ -307,11 +433,19 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
         try:
             fids = None
             self._generator.setDataSource(self._layer, self._zField, fids)
+            if self.uLimitToExtent.isChecked():
+                mapSettings = self._iface.mapCanvas().mapSettings()
+                self._generator.setAreaOfInterest(
+                    mapSettings.visibleExtent(), crs=mapSettings.destinationCrs()
+                )
+            else:
+                self._generator.setAreaOfInterest(None)
             duptol = 0.0
             self._generator.setDuplicatePointTolerance(duptol)
             self.dataChanged()
         finally:
             self._loadingLayer = False
+        self.schedulePreview()
         self._replaceLayerSet = None
         if not self._layer or not self._zField:
             self.enableOkButton()
@@ -396,9 +530,10 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
             "min": zmin,
             "max": zmax,
             "interval": interval,
-            "nClassify": nClassify,
-            "maxClassify": nClassify,
+            "ncontour": nClassify,
+            "maxcontour": nClassify,
             "mantissa": None,
+            "sample": None,
             "levels": levels,
         }
         return method.id, params
@@ -410,7 +545,7 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
             params = list(method.required)
             params.extend(method.optional)
         self.uClassifyInterval.setEnabled("interval" in params)
-        self.uNClassify.setEnabled("nClassify" in params or "maxClassify" in params)
+        self.uNClassify.setEnabled("ncontour" in params or "maxcontour" in params)
         self.uSetMinimum.setEnabled("min" in params)
         self.uMinClassify.setEnabled("min" in params and self.uSetMinimum.isChecked())
         self.uSetMaximum.setEnabled("max" in params)
@@ -449,8 +584,8 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
                 if z is not None:
                     nClassify = self.uNClassify.value()
                     try:
-                        levels = ClassifyMethod.calculateLevels(
-                            z, "equal", nClassify=nClassify
+                        levels = self._generator.calculateLevels(
+                            "equal", {"ncontour": nClassify}
                         )
                     except:
                         levels = [0.0]
@@ -515,6 +650,7 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
                     for layer in list(oldLayerSet.values()):
                         QgsProject.instance().removeMapLayer(layer.id())
                 self._replaceLayerSet = self.ClassifyLayerSet(self._ClassifyId)
+                self._preview.clear()
             finally:
                 QApplication.restoreOverrideCursor()
 
@@ -622,6 +758,7 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
     def setClassifyProperties(self, layer, properties):
         for key in list(properties.keys()):
             layer.setCustomProperty("ClassifyPlugin." + key, properties[key])
+        self._layerIndex.update(layer)
 
     def getClassifyProperties(self, layer):
         if layer.type() != layer.RasterLayer or layer.dataProvider().name() != "memory":
@@ -648,10 +785,13 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
         return properties
 
     def ClassifyLayers(self, wanted={}):
-        for layer in list(QgsProject.instance().mapLayers().values()):
-            properties = self.getClassifyProperties(layer)
-            if not properties:
-                continue
+        # Narrow the search with the layer index, then check any other
+        # wanted properties
+        source = None
+        if "SourceLayerId" in wanted and "SourceLayerAttr" in wanted:
+            source = (wanted["SourceLayerId"], wanted["SourceLayerAttr"])
+        for layer in self._layerIndex.layers(wanted.get("ClassifyId"), source):
+            properties = self._layerIndex.properties(layer)
             ok = True
             for key in list(wanted.keys()):
                 if properties.get(key) != wanted[key]:
@@ -664,13 +804,13 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
         layers = self.ClassifyLayers({"ClassifyId": ClassifyId})
         layerSet = {}
         for layer in layers:
-            properties = self.getClassifyProperties(layer)
+            properties = self._layerIndex.properties(layer)
             layerSet[properties.get("Mode")] = layer
         return layerSet
 
     def layerSetClassifyId(self, layerSet):
         if layerSet:
-            return self.getClassifyProperties(list(layerSet.values())[0]).get(
+            return self._layerIndex.properties(list(layerSet.values())[0]).get(
                 "ClassifyId"
             )
         return None
@@ -689,7 +829,7 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
         for layer in self.ClassifyLayers(
             {"SourceLayerId": self._layer.id(), "SourceLayerAttr": self._zField}
         ):
-            id = self.getClassifyProperties(layer).get("ClassifyId")
+            id = self._layerIndex.properties(layer).get("ClassifyId")
             if id in ids:
                 continue
             ids.append(id)
@@ -712,13 +852,21 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
                 levels.append((feature["index"], feature["label"]))
             vl.updateExtents()
             vl.commitChanges()
+            colors = self.levelColors(levels)
+            if colors is not None:
+                self.addColorField(vl, colors)
+            # Index all the features at once rather than as each is added
+            vl.dataProvider().createSpatialIndex()
         except (ClassifyError, ClassifyMethodError) as ex:
             self.warnUser(ex.message())
             return
         try:
             if len(levels) > 0:
                 rendtype = "line" if ctype == ClassifyType.line else "polygon"
-                self.applyRenderer(vl, rendtype, levels)
+                if colors is not None:
+                    self.applyColorFieldRenderer(vl, rendtype)
+                else:
+                    self.applyRenderer(vl, rendtype, levels)
         except:
             self.warnUser("Error rendering Classify layer")
         self.addLayer(vl)
@@ -793,6 +941,64 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
             renderer.addCategory(category)
         layer.setRenderer(renderer)
 
+    def levelColors(self, levels):
+        """
+        Colours for a colour attribute, as a dictionary from level index
+        to encoded colour, or None if the layer is not coloured or has
+        few enough levels to render each as a category
+        """
+        if not self.uApplyColors.isChecked():
+            return None
+        ramp = self.uColorRamp.colorRamp()
+        if ramp is None:
+            return None
+        indices = sorted(set(index for index, label in levels))
+        if len(indices) <= self.MaxCategorizedLevels:
+            return None
+        colors = ClassifyGenerator.rampColors(
+            ramp, len(indices), self.uReverseRamp.isChecked()
+        )
+        return {
+            index: QgsSymbolLayerUtils.encodeColor(color)
+            for index, color in zip(indices, colors)
+        }
+
+    def addColorField(self, layer, colors):
+        """
+        Add the colour attribute to a layer, setting the colour of each
+        feature from its level index
+        """
+        pr = layer.dataProvider()
+        pr.addAttributes([QgsField(COLOR_FIELD, QVariant.String, "String")])
+        layer.updateFields()
+        fields = pr.fields()
+        icolor = fields.indexOf(COLOR_FIELD)
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(["index"], fields)
+        values = {
+            feature.id(): {icolor: colors[feature["index"]]}
+            for feature in pr.getFeatures(request)
+        }
+        pr.changeAttributeValues(values)
+
+    def applyColorFieldRenderer(self, layer, type):
+        """
+        Single symbol renderer taking the colour of each feature from the
+        colour attribute, which is much quicker to build and draw than a
+        category per level
+        """
+        if type == "line":
+            symbol = QgsLineSymbol.createSimple({})
+            colorProperty = QgsSymbolLayer.PropertyStrokeColor
+        else:
+            symbol = QgsFillSymbol.createSimple({"outline_style": "no"})
+            colorProperty = QgsSymbolLayer.PropertyFillColor
+        symbol.symbolLayer(0).setDataDefinedProperty(
+            colorProperty, QgsProperty.fromField(COLOR_FIELD)
+        )
+        layer.setRenderer(QgsSingleSymbolRenderer(symbol))
+
     def colorRampToString(self, ramp):
         if ramp is None:
             return ""
@@ -849,6 +1055,9 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
         settings.setValue(
             base + "reverseRamp", "yes" if self.uReverseRamp.isChecked() else "no"
         )
+        settings.setValue(
+            base + "limitToExtent", "yes" if self.uLimitToExtent.isChecked() else "no"
+        )
         settings.setValue(base + "dialogWidth", str(self.width()))
         settings.setValue(base + "dialogHeight", str(self.height()))
 
@@ -923,6 +1132,9 @@ class ClassifyDialog(QDialog, Ui_ClassifyDialog):
             trimZeros = settings.value(base + "trimZeros")
             self.uTrimZeros.setChecked(trimZeros == "yes")
 
+            limitToExtent = settings.value(base + "limitToExtent")
+            self.uLimitToExtent.setChecked(limitToExtent == "yes")
+
             width = settings.value(base + "dialogWidth")
             height = settings.value(base + "dialogHeight")
             if width is not None and height is not None:
@@ -0,0 +1,68 @@
+"""
+Toolbar and menu entry for the Classify dialog.  This is loaded when the
+plugin starts, so it must not import the dialog itself, numpy, or
+matplotlib - these are imported when the dialog is first opened.
+"""
+
+from PyQt5.QtCore import QCoreApplication
+from PyQt5.QtWidgets import QAction, QMessageBox
+from PyQt5.QtGui import QIcon
+from . import resources
+from . import ClassifyOptions
+
+import sys
+
+
+def tr(string):
+    return QCoreApplication.translate("Processing", string)
+
+
+def mplAvailable():
+    return all(ClassifyOptions.moduleAvailable(name) for name in ("numpy", "matplotlib"))
+
+
+class ClassifyDialogPlugin:
+    def __init__(self, iface):
+        self._iface = iface
+
+    def initGui(self):
+        if not mplAvailable():
+            QMessageBox.warning(
+                self._iface.mainWindow(),
+                tr("Classify error"),
+                tr(
+                    "The Classify plugin is disabled as it requires python modules"
+                    " numpy and matplotlib which are not both installed"
+                ),
+            )
+            return
+
+        self.action = QAction(
+            QIcon(":/plugins/classify/classify.png"),
+            "Classify",
+            self._iface.mainWindow(),
+        )
+        self.action.setWhatsThis(tr("Generate Classifys based on point vector data"))
+        self.action.triggered.connect(self.run)
+        self._iface.addToolBarIcon(self.action)
+        self._iface.rasterMenu().addAction(self.action)
+
+    def unload(self):
+        try:
+            self._iface.removePluginMenu("&Classify", self.action)
+            self._iface.rasterMenu().removeAction(self.action)
+            self._iface.removeToolBarIcon(self.action)
+        except:
+            pass
+
+    def run(self):
+        from .ClassifyDialog import ClassifyDialog
+        from .ClassifyGenerator import ClassifyError
+
+        try:
+            dlg = ClassifyDialog(self._iface)
+            dlg.exec_()
+        except ClassifyError:
+            QMessageBox.warning(
+                self._iface.mainWindow(), tr("Classify error"), str(sys.exc_info()[1])
+            )
@@ -40,6 +40,9 @@ class Ui_ClassifyDialog(object):
         self.uSourceLayer = gui.QgsMapLayerComboBox(self.groupBox_2)
         self.uSourceLayer.setObjectName("uSourceLayer")
         self.formLayout_2.setWidget(1, QtWidgets.QFormLayout.FieldRole, self.uSourceLayer)
+        self.uLimitToExtent = QtWidgets.QCheckBox(self.groupBox_2)
+        self.uLimitToExtent.setObjectName("uLimitToExtent")
+        self.formLayout_2.setWidget(2, QtWidgets.QFormLayout.FieldRole, self.uLimitToExtent)
         self.gridLayout.addLayout(self.formLayout_2, 1, 0, 1, 1)
         self.verticalLayout_2.addWidget(self.groupBox_2)
         self.groupBox = QtWidgets.QGroupBox(self.scrollAreaWidgetContents_2)
@@ -312,6 +315,7 @@ class Ui_ClassifyDialog(object):
         _translate = QtCore.QCoreApplication.translate
         ClassifyDialog.setWindowTitle(_translate("ClassifyDialog", "Classify"))
         self.groupBox_2.setTitle(_translate("ClassifyDialog", "Input"))
+        self.uLimitToExtent.setText(_translate("ClassifyDialog", "Only use points in the current map extent"))
         self.label_3.setText(_translate("ClassifyDialog", "Raster layer"))
         self.groupBox.setTitle(_translate("ClassifyDialog", "Settings"))
         self.uBoth.setText(_translate("ClassifyDialog", "both"))
@@ -0,0 +1,2053 @@
+'''
+ClassifyEngine implements the classification of x, y, z point data
+without depending on QGIS or Qt.  It handles discarding duplicate
+points, grid detection, triangulation, level calculation and contouring,
+and returns the results as vertex buffers that can be encoded as WKB.
+
+ClassifyGenerator is the QGIS adapter which loads the data from a
+feature source and converts the results to QgsFeatures.
+'''
+
+import re
+import struct
+import sys
+import traceback
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+import matplotlib
+from matplotlib.tri import Triangulation, TriAnalyzer
+
+from .DataGridder import DataGridder
+from . import ClassifyUtils
+from . import ClassifyMethod
+from . import ClassifyOptions
+from .ClassifyMethod import ClassifyMethodError
+from .ClassifyStats import ClassifyStats
+
+# Need to use QObject.tr on descriptions in the QGIS adapter
+
+tr=lambda x: x
+
+class ClassifyError( RuntimeError ):
+
+    def message(self):
+        return self.args[0] if len(self.args) > 0 else "Exception"
+
+class ClassifyGenerationError( ClassifyError ):
+
+    @staticmethod
+    def fromException( excinfo ):
+        message=traceback.format_exception_only(excinfo[0],excinfo[1])
+        return ClassifyGenerationError(message)
+
+class ClassifyExtendOption:
+
+    both='both'
+    below='min'
+    above='max'
+    neither='neither'
+
+    _options=[both,below,above,neither]
+    _above=[both,above]
+    _below=[both,below]
+
+    _description={
+        both: tr('Fill below minimum and above maximum Classify'),
+        below: tr('Fill below minimum Classify'),
+        above: tr('Fill above maximum Classify'),
+        neither: tr('Don\'t fill below or above maximum Classify')
+        }
+
+    def options():
+        return ClassifyExtendOption._options
+
+    def valid( option ):
+        return option in ClassifyExtendOption._options
+
+    def description( option ):
+        return ClassifyExtendOption._description.get(option,tr('Invalid Classify option {0}').format(option))
+
+    def extendBelow( option ):
+        return option in ClassifyExtendOption._below
+
+    def extendAbove( option ):
+        return option in ClassifyExtendOption._above
+
+class ClassifyInterpolation:
+
+    none='none'
+    idw='idw'
+    linear='linear'
+
+    _options=[none,idw,linear]
+
+    _description={
+        none: tr('Triangulate scattered data'),
+        idw: tr('Inverse distance weighted interpolation to a grid'),
+        linear: tr('Linear interpolation to a grid'),
+        }
+
+    def options():
+        return ClassifyInterpolation._options
+
+    def valid( option ):
+        return option in ClassifyInterpolation._options
+
+    def description( option ):
+        return ClassifyInterpolation._description.get(option,tr('Invalid interpolation option {0}').format(option))
+
+def idwAvailable():
+    '''
+    True if scipy, which IDW interpolation requires, is installed
+    '''
+    return ClassifyOptions.moduleAvailable('scipy')
+
+class ClassifyPath:
+    '''
+    The calculation path used to contour the data, chosen by the
+    planner for auto
+    '''
+
+    auto='auto'
+    grid='grid'
+    triangulation='triangulation'
+    interpolation='interpolation'
+
+    _options=[auto,grid,triangulation,interpolation]
+
+    _description={
+        auto: tr('Choose the path with the lowest estimated cost'),
+        grid: tr('Contour data on a regular grid directly'),
+        triangulation: tr('Contour the triangulation of the points'),
+        interpolation: tr('Interpolate the points to a grid and contour the grid'),
+        }
+
+    def options():
+        return ClassifyPath._options
+
+    def valid( option ):
+        return option in ClassifyPath._options
+
+    def description( option ):
+        return ClassifyPath._description.get(option,tr('Invalid calculation path {0}').format(option))
+
+ClassifyPlan=namedtuple('ClassifyPlan','path interpolation costs reason')
+ClassifyPlan.__doc__='''
+The calculation path chosen for the data, the interpolation method it
+uses (none unless the path is interpolation), the estimated time in
+seconds of each path considered (None if it cannot be used), and the
+reason for the choice.
+'''
+
+class ClassifyType:
+    line='line'
+    filled='filled'
+    layer='layer'
+    raster='raster'
+
+    _types=[line, filled, layer, raster]
+
+    _description={
+        line: tr('Classify lines'),
+        filled: tr('Filled Classify polygons'),
+        layer: tr('Layer Classify polygons'),
+        raster: tr('Classified raster'),
+        }
+
+    _geometryType={
+        line: 'MultiLineString',
+        filled: 'MultiPolygon',
+        layer: 'MultiPolygon',
+        }
+
+    def types():
+        return ClassifyType._types
+
+    def valid( type ):
+        return type in ClassifyType._types
+
+    def description( type ):
+        return ClassifyType._description.get(type,tr('Invalid Classify type {0}').format(type))
+
+    def geometryType( type ):
+        return ClassifyType._geometryType.get(type)
+
+    def isRaster( type ):
+        return type == ClassifyType.raster
+
+class _DummyFeedback:
+
+    def isCanceled( self ):
+        return False
+
+    def setProgress( self, percent ):
+        pass
+
+    def pushInfo( self, info ):
+        pass
+
+    def reportError( self, message, fatal=False ):
+        raise ClassifyError( message )
+
+class ClassifyGeometry:
+    '''
+    A multi line string or multi polygon geometry held as vertex buffers.
+
+    vertices is an (n,2) array of all the vertices, ringOffsets is the
+    index of the first vertex of each line or ring, followed by n, and
+    for polygons polygonOffsets is the index of the first ring of each
+    polygon, followed by the number of rings.  Each polygon is an outer
+    ring followed by its holes.  Rings are closed.
+    '''
+
+    line='MultiLineString'
+    polygon='MultiPolygon'
+
+    def __init__( self, geomtype, vertices, ringOffsets, polygonOffsets=None ):
+        self.type=geomtype
+        self.vertices=vertices
+        self.ringOffsets=ringOffsets
+        self.polygonOffsets=polygonOffsets
+
+    @staticmethod
+    def fromLines( lines ):
+        '''
+        Build from a list of vertex arrays, ignoring lines with less than
+        two vertices
+        '''
+        lines=[l for l in lines if len(l) > 1]
+        return ClassifyGeometry(ClassifyGeometry.line,*_concatenate(lines))
+
+    @staticmethod
+    def fromPolygons( polygons ):
+        '''
+        Build from a list of polygons, each a list of rings (outer first)
+        '''
+        rings=[]
+        polyOffsets=[0]
+        for polygon in polygons:
+            rings.extend(polygon)
+            polyOffsets.append(len(rings))
+        vertices,ringOffsets=_concatenate(rings)
+        return ClassifyGeometry(ClassifyGeometry.polygon,vertices,ringOffsets,
+                                np.array(polyOffsets,dtype=np.int64))
+
+    def isEmpty( self ):
+        return len(self.ringOffsets) < 2
+
+    def nVertices( self ):
+        return self.vertices.shape[0]
+
+    def nParts( self ):
+        offsets=self.polygonOffsets if self.type == self.polygon else self.ringOffsets
+        return len(offsets)-1
+
+    def translate( self, dx, dy ):
+        '''
+        Offset the vertices, in place if the vertex buffer is a writeable
+        float64 array
+        '''
+        if dx != 0.0 or dy != 0.0:
+            offset=np.array([dx,dy])
+            if self.vertices.dtype == np.float64 and self.vertices.flags.writeable:
+                self.vertices += offset
+            else:
+                self.vertices=self.vertices+offset
+
+    def simplified( self, tolerance ):
+        '''
+        Geometry with each line or ring simplified with the Douglas-Peucker
+        algorithm.  Polygon rings reduced to less than four vertices are
+        dropped, as are polygons whose outer ring is dropped.
+        '''
+        if tolerance <= 0 or self.isEmpty():
+            return self
+        offsets=self.ringOffsets
+        keep=_simplifyKeep(self.vertices,offsets,tolerance)
+        counts=np.add.reduceat(keep.astype(np.int64),offsets[:-1])
+        polyOffsets=None
+        if self.type == self.polygon:
+            ringValid=counts >= 4
+            ringsPerPoly=np.diff(self.polygonOffsets)
+            polyValid=ringValid[self.polygonOffsets[:-1]]
+            ringValid &= np.repeat(polyValid,ringsPerPoly)
+            keep &= np.repeat(ringValid,np.diff(offsets))
+            counts=counts[ringValid]
+            nrings=np.add.reduceat(ringValid.astype(np.int64),self.polygonOffsets[:-1])
+            polyOffsets=np.concatenate(([0],np.cumsum(nrings[polyValid])))
+        ringOffsets=np.concatenate(([0],np.cumsum(counts)))
+        return ClassifyGeometry(self.type,self.vertices[keep],ringOffsets,polyOffsets)
+
+    def bounds( self ):
+        '''
+        Returns xmin, ymin, xmax, ymax of the geometry, or None if empty
+        '''
+        if self.nVertices() == 0:
+            return None
+        vmin=self.vertices.min(axis=0)
+        vmax=self.vertices.max(axis=0)
+        return float(vmin[0]),float(vmin[1]),float(vmax[0]),float(vmax[1])
+
+    def rings( self ):
+        offsets=self.ringOffsets
+        return [self.vertices[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)]
+
+    def parts( self ):
+        '''
+        List of lines, or of polygons each as a list of rings
+        '''
+        rings=self.rings()
+        if self.type == self.line:
+            return rings
+        offsets=self.polygonOffsets
+        return [rings[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)]
+
+    def wkb( self ):
+        '''
+        Little endian WKB encoding of the geometry
+        '''
+        vertices=np.ascontiguousarray(self.vertices,dtype='<f8')
+        offsets=self.ringOffsets
+        nring=len(offsets)-1
+        if self.type == self.line:
+            parts=[struct.pack('<BII',1,5,nring)]
+            for i in range(nring):
+                r0,r1=offsets[i],offsets[i+1]
+                parts.append(struct.pack('<BII',1,2,r1-r0))
+                parts.append(vertices[r0:r1].tobytes())
+            return b''.join(parts)
+        polyOffsets=self.polygonOffsets
+        npoly=len(polyOffsets)-1
+        parts=[struct.pack('<BII',1,6,npoly)]
+        for p in range(npoly):
+            p0,p1=polyOffsets[p],polyOffsets[p+1]
+            parts.append(struct.pack('<BII',1,3,p1-p0))
+            for i in range(p0,p1):
+                r0,r1=offsets[i],offsets[i+1]
+                parts.append(struct.pack('<I',r1-r0))
+                parts.append(vertices[r0:r1].tobytes())
+        return b''.join(parts)
+
+def _concatenate( arrays ):
+    if len(arrays) == 0:
+        return np.zeros((0,2)),np.zeros((1,),dtype=np.int64)
+    offsets=np.zeros((len(arrays)+1,),dtype=np.int64)
+    offsets[1:]=np.cumsum([len(a) for a in arrays])
+    return np.concatenate(arrays),offsets
+
+def _splitPaths( vertices, codes ):
+    '''
+    Split matplotlib path vertices into separate lines or rings at
+    each MOVETO code
+    '''
+    paths=[]
+    for v,c in zip(vertices,codes):
+        starts=np.flatnonzero(c == 1)
+        if len(starts) < 2:
+            paths.append(v)
+        else:
+            paths.extend(np.split(v,starts[1:]))
+    return paths
+
+# The private matplotlib TriContourGenerator contours a triangulation
+# directly, without building a ContourSet for each level.  Its
+# create_contour and create_filled_contour have returned lists of vertex
+# and code arrays since matplotlib 3.6.  Earlier versions, or any in
+# which it cannot be created, use the public tricontour API instead.
+PrivateTriContourMinVersion=(3,6)
+
+def _matplotlibVersion():
+    match=re.match(r'(\d+)\.(\d+)',matplotlib.__version__)
+    return tuple(int(v) for v in match.groups()) if match else (0,0)
+
+def _privateTriContourGenerator( trig, z ):
+    '''
+    matplotlib's private TriContourGenerator for trig and z, or None if
+    it is not available in the expected form
+    '''
+    if _matplotlibVersion() < PrivateTriContourMinVersion:
+        return None
+    try:
+        from matplotlib import _tri
+        generator=_tri.TriContourGenerator(trig.get_cpp_triangulation(),z)
+    except (ImportError, AttributeError, TypeError):
+        return None
+    if not (hasattr(generator,'create_contour') and hasattr(generator,'create_filled_contour')):
+        return None
+    return generator
+
+class _PublicTriContourGenerator:
+    '''
+    Same interface as the private TriContourGenerator, implemented with
+    the public tricontour and tricontourf of a matplotlib Axes (which is
+    never drawn)
+    '''
+
+    def __init__( self, trig, z ):
+        from matplotlib.figure import Figure
+        self._axes=Figure().add_subplot()
+        self._trig=trig
+        self._z=z
+
+    @staticmethod
+    def _paths( contourSet ):
+        # From matplotlib 3.8 a ContourSet is a collection of one path per
+        # level, before that it held a collection of paths for each level
+        from matplotlib.collections import Collection
+        if isinstance(contourSet,Collection):
+            paths=contourSet.get_paths()
+        else:
+            paths=[p for c in contourSet.collections for p in c.get_paths()]
+        vertices=[]
+        codes=[]
+        for path in paths:
+            if len(path.vertices) == 0:
+                continue
+            vertices.append(path.vertices)
+            if path.codes is None:
+                pathCodes=np.full(len(path.vertices),2,dtype=np.uint8)
+                pathCodes[0]=1
+                codes.append(pathCodes)
+            else:
+                codes.append(path.codes)
+        return vertices,codes
+
+    def create_contour( self, level ):
+        contourSet=self._axes.tricontour(self._trig,self._z,levels=[level])
+        self._axes.cla()
+        return self._paths(contourSet)
+
+    def create_filled_contour( self, lower, upper ):
+        contourSet=self._axes.tricontourf(self._trig,self._z,levels=[lower,upper])
+        self._axes.cla()
+        return self._paths(contourSet)
+
+def triContourGenerator( trig, z, usePrivate=True ):
+    '''
+    Contour generator for z on the matplotlib Triangulation trig, with
+    create_contour(level) and create_filled_contour(lower, upper) each
+    returning lists of path vertices and codes.  Uses the private
+    matplotlib generator if usePrivate and it is available, otherwise
+    the public tricontour API.
+    '''
+    generator=_privateTriContourGenerator(trig,z) if usePrivate else None
+    return generator or _PublicTriContourGenerator(trig,z)
+
+def _simplifyKeep( vertices, offsets, tolerance ):
+    '''
+    Douglas-Peucker simplification of each line between offsets,
+    returning a mask of the vertices kept.  All the lines are processed
+    together, each pass splitting every segment whose furthest vertex is
+    more than tolerance from it.
+    '''
+    x=vertices[:,0]
+    y=vertices[:,1]
+    keep=np.zeros(len(vertices),dtype=bool)
+    start=np.asarray(offsets[:-1],dtype=np.int64)
+    end=np.asarray(offsets[1:],dtype=np.int64)-1
+    keep[start]=True
+    keep[end]=True
+    tol2=tolerance*tolerance
+    while True:
+        count=end-start-1
+        select=count > 0
+        start,end,count=start[select],end[select],count[select]
+        if len(start) == 0:
+            break
+        segment=np.repeat(np.arange(len(start)),count)
+        first=np.cumsum(count)-count
+        index=np.arange(int(count.sum()))-first[segment]+start[segment]+1
+        x0,y0=x[start][segment],y[start][segment]
+        dx=x[end][segment]-x0
+        dy=y[end][segment]-y0
+        px=x[index]-x0
+        py=y[index]-y0
+        len2=dx*dx+dy*dy
+        with np.errstate(invalid='ignore',divide='ignore'):
+            t=np.where(len2 > 0,(px*dx+py*dy)/len2,0.0)
+        t=np.clip(t,0.0,1.0)
+        dist2=(px-t*dx)**2+(py-t*dy)**2
+        maxd=np.maximum.reduceat(dist2,first)
+        split=maxd > tol2
+        if not split.any():
+            break
+        # Split at the first vertex at the maximum distance
+        candidates=np.flatnonzero(split[segment] & (dist2 == maxd[segment]))
+        segs,firsts=np.unique(segment[candidates],return_index=True)
+        mid=index[candidates[firsts]]
+        keep[mid]=True
+        start,end=np.concatenate((start[segs],mid)),np.concatenate((mid,end[segs]))
+    return keep
+
+def _signedArea( ring ):
+    x=ring[:,0]
+    y=ring[:,1]
+    return 0.5*np.sum(x[:-1]*y[1:]-x[1:]*y[:-1])
+
+def _pointInRing( x, y, ring ):
+    x0=ring[:-1,0]
+    y0=ring[:-1,1]
+    x1=ring[1:,0]
+    y1=ring[1:,1]
+    crosses=(y0 > y) != (y1 > y)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        xc=x0+(y-y0)*(x1-x0)/(y1-y0)
+    return np.count_nonzero(crosses & (x < xc)) % 2 == 1
+
+def _assemblePolygons( rings ):
+    '''
+    Group closed rings into polygons.  Outer rings are anticlockwise and
+    holes clockwise (as generated by matplotlib).  Each hole is assigned
+    to the smallest outer ring containing it.
+    '''
+    rings=[r for r in rings if len(r) > 3]
+    areas=np.array([_signedArea(r) for r in rings])
+    outers=[i for i in range(len(rings)) if areas[i] > 0]
+    holes=[i for i in range(len(rings)) if areas[i] < 0]
+    polygons=[[rings[i]] for i in outers]
+    if len(holes) == 0 or len(outers) == 0:
+        return polygons
+    outerBounds=np.array([np.hstack((rings[i].min(axis=0),rings[i].max(axis=0)))
+                          for i in outers])
+    outerAreas=areas[outers]
+    for h in holes:
+        x,y=rings[h][0]
+        candidates=np.flatnonzero(
+            (outerBounds[:,0] <= x) & (outerBounds[:,2] >= x) &
+            (outerBounds[:,1] <= y) & (outerBounds[:,3] >= y))
+        best=None
+        for c in candidates[np.argsort(outerAreas[candidates])]:
+            if _pointInRing(x,y,rings[outers[c]]):
+                best=c
+                break
+        if best is not None:
+            polygons[best].append(rings[h])
+    return polygons
+
+ClassifyFeature=namedtuple('ClassifyFeature','index level levelMax label geometry lod',
+                           defaults=(0,))
+ClassifyFeature.__doc__='''
+Classification result for one level.  level is the contour level (or
+lower bound of a filled contour range), levelMax is the upper bound of a
+filled contour range, otherwise None.  geometry is a ClassifyGeometry.
+lod is the level of detail of the geometry, 0 being full resolution.
+'''
+
+class _TriangleRasterizer:
+    '''
+    Linearly interpolates z over triangles at the pixel centres of a
+    ClassifyRaster, a block of rows at a time.  Each triangle is scanned
+    over the pixels in its bounding box, with all the triangles touching
+    a block processed together as flat arrays, so the cost is
+    proportional to the number of triangles plus the number of pixels.
+    '''
+
+    # Maximum number of candidate pixels evaluated at once
+    ChunkSize=4000000
+
+    def __init__( self, raster, x, y, z, triangles ):
+        self._ncols=raster.ncols
+        x0,dxcol,dxrow,y0,dycol,dyrow=raster.geotransform
+        # Vertex coordinates in pixel units
+        det=dxcol*dyrow-dxrow*dycol
+        dx=x-x0
+        dy=y-y0
+        c=((dyrow*dx-dxrow*dy)/det)[triangles]
+        r=((dxcol*dy-dycol*dx)/det)[triangles]
+        self._c=c
+        self._r=r
+        self._z=z[triangles]
+        self._colStart=np.maximum(np.ceil(c.min(axis=1)-0.5),0).astype(np.int64)
+        self._colEnd=np.minimum(np.floor(c.max(axis=1)-0.5),raster.ncols-1).astype(np.int64)
+        self._rowStart=np.maximum(np.ceil(r.min(axis=1)-0.5),0).astype(np.int64)
+        self._rowEnd=np.minimum(np.floor(r.max(axis=1)-0.5),raster.nrows-1).astype(np.int64)
+        self._den=(r[:,1]-r[:,2])*(c[:,0]-c[:,2])+(c[:,2]-c[:,1])*(r[:,0]-r[:,2])
+        self._valid=((self._colEnd >= self._colStart) & (self._rowEnd >= self._rowStart)
+                     & (self._den != 0))
+
+    def values( self, row0, row1 ):
+        '''
+        Interpolated values for rows row0 to row1-1, nan outside the
+        triangles
+        '''
+        block=np.full((row1-row0,self._ncols),np.nan)
+        select=np.flatnonzero(self._valid & (self._rowStart < row1) & (self._rowEnd >= row0))
+        rs=np.maximum(self._rowStart[select],row0)
+        nr=np.minimum(self._rowEnd[select],row1-1)-rs+1
+        nc=self._colEnd[select]-self._colStart[select]+1
+        npixel=np.cumsum(nr*nc)
+        start=0
+        while start < len(select):
+            done=npixel[start-1] if start > 0 else 0
+            end=max(np.searchsorted(npixel,done+self.ChunkSize,side='right'),start+1)
+            self._fill(block,row0,select[start:end],rs[start:end],
+                       nr[start:end]*nc[start:end],nc[start:end])
+            start=end
+        return block
+
+    def _fill( self, block, row0, select, rs, npixel, nc ):
+        offset=np.cumsum(npixel)-npixel
+        tri=np.repeat(np.arange(len(select)),npixel)
+        k=np.arange(tri.shape[0])-offset[tri]
+        ncol=nc[tri]
+        pr=rs[tri]+k//ncol
+        pc=self._colStart[select][tri]+k%ncol
+        t=select[tri]
+        c=self._c[t]
+        r=self._r[t]
+        den=self._den[t]
+        dc=pc+0.5-c[:,2]
+        dr=pr+0.5-r[:,2]
+        w0=((r[:,1]-r[:,2])*dc+(c[:,2]-c[:,1])*dr)/den
+        w1=((r[:,2]-r[:,0])*dc+(c[:,0]-c[:,2])*dr)/den
+        w2=1.0-w0-w1
+        eps=-1.0e-9
+        inside=(w0 >= eps) & (w1 >= eps) & (w2 >= eps)
+        z=self._z[t[inside]]
+        value=w0[inside]*z[:,0]+w1[inside]*z[:,1]+w2[inside]*z[:,2]
+        block[pr[inside]-row0,pc[inside]]=value
+
+class _TriangleLocator:
+    '''
+    Finds the triangle containing each of a set of query points and
+    linearly interpolates z.  The triangles are indexed by a bucket grid
+    of about four cells per triangle, each triangle being listed in every
+    cell its bounding box overlaps, so a query only tests the few
+    triangles in its cell.  Building and querying are vectorized.
+    '''
+
+    # Maximum number of candidate triangles tested at once
+    ChunkSize=4000000
+
+    def __init__( self, x, y, z, triangles ):
+        self._z=z[triangles]
+        tx=x[triangles]
+        ty=y[triangles]
+        self._x0=tx[:,0]
+        self._y0=ty[:,0]
+        # Inverse of the matrix mapping barycentric coordinates l1, l2 to
+        # x-x0, y-y0 for each triangle
+        a=tx[:,1]-tx[:,0]
+        b=tx[:,2]-tx[:,0]
+        c=ty[:,1]-ty[:,0]
+        d=ty[:,2]-ty[:,0]
+        det=a*d-b*c
+        valid=det != 0
+        det[~valid]=1.0
+        self._inverse=np.column_stack((d/det,-b/det,-c/det,a/det))
+        xmin,xmax=tx.min(axis=1),tx.max(axis=1)
+        ymin,ymax=ty.min(axis=1),ty.max(axis=1)
+        self._origin=(xmin.min(),ymin.min())
+        width=max(xmax.max()-self._origin[0],ymax.max()-self._origin[1])
+        ncell=max(int(np.sqrt(4*len(triangles))),1)
+        self._cellSize=(width/ncell) if width > 0 else 1.0
+        self._ncell=ncell
+        c0=self._cell(xmin,self._origin[0])
+        c1=self._cell(xmax,self._origin[0])
+        r0=self._cell(ymin,self._origin[1])
+        r1=self._cell(ymax,self._origin[1])
+        nc=np.where(valid,c1-c0+1,0)
+        nr=np.where(valid,r1-r0+1,0)
+        count=nc*nr
+        tri=np.repeat(np.arange(len(triangles)),count)
+        k=np.arange(tri.shape[0])-np.repeat(np.cumsum(count)-count,count)
+        cell=(r0[tri]+k//nc[tri])*ncell+c0[tri]+k%nc[tri]
+        order=np.argsort(cell,kind='stable')
+        self._cellTriangles=tri[order]
+        self._cellStart=np.searchsorted(cell[order],np.arange(ncell*ncell+1))
+
+    def _cell( self, v, v0 ):
+        return np.clip(((v-v0)/self._cellSize).astype(np.int64),0,self._ncell-1)
+
+    def values( self, qx, qy ):
+        '''
+        Interpolated z at each query point, nan outside the triangles
+        '''
+        qx=np.asarray(qx,dtype=np.float64).ravel()
+        qy=np.asarray(qy,dtype=np.float64).ravel()
+        result=np.full(qx.shape,np.nan)
+        x0,y0=self._origin
+        extent=self._ncell*self._cellSize
+        inside=((qx >= x0) & (qx <= x0+extent) & (qy >= y0) & (qy <= y0+extent))
+        query=np.flatnonzero(inside)
+        cell=self._cell(qy[query],y0)*self._ncell+self._cell(qx[query],x0)
+        start=self._cellStart[cell]
+        ncand=self._cellStart[cell+1]-start
+        total=np.cumsum(ncand)
+        first=0
+        while first < len(query):
+            done=total[first-1] if first > 0 else 0
+            last=max(np.searchsorted(total,done+self.ChunkSize,side='right'),first+1)
+            n=ncand[first:last]
+            q=np.repeat(query[first:last],n)
+            k=np.arange(q.shape[0])-np.repeat(np.cumsum(n)-n,n)
+            tri=self._cellTriangles[np.repeat(start[first:last],n)+k]
+            dx=qx[q]-self._x0[tri]
+            dy=qy[q]-self._y0[tri]
+            inv=self._inverse[tri]
+            l1=inv[:,0]*dx+inv[:,1]*dy
+            l2=inv[:,2]*dx+inv[:,3]*dy
+            l0=1.0-l1-l2
+            eps=-1.0e-9
+            hit=(l0 >= eps) & (l1 >= eps) & (l2 >= eps)
+            z=self._z[tri[hit]]
+            result[q[hit]]=l0[hit]*z[:,0]+l1[hit]*z[:,1]+l2[hit]*z[:,2]
+            first=last
+        return result
+
+class _GridLocator:
+    '''
+    Bilinearly interpolates z on a regular (possibly rotated) grid of
+    nodes at arbitrary query points
+    '''
+
+    def __init__( self, gx, gy, gz ):
+        nrows,ncols=gz.shape
+        self._gz=gz
+        self._x0=gx[0,0]
+        self._y0=gy[0,0]
+        dxcol=(gx[0,-1]-gx[0,0])/(ncols-1)
+        dycol=(gy[0,-1]-gy[0,0])/(ncols-1)
+        dxrow=(gx[-1,0]-gx[0,0])/(nrows-1)
+        dyrow=(gy[-1,0]-gy[0,0])/(nrows-1)
+        det=dxcol*dyrow-dxrow*dycol
+        self._inverse=(dyrow/det,-dxrow/det,-dycol/det,dxcol/det)
+
+    def values( self, qx, qy ):
+        qx=np.asarray(qx,dtype=np.float64).ravel()-self._x0
+        qy=np.asarray(qy,dtype=np.float64).ravel()-self._y0
+        gz=self._gz
+        nrows,ncols=gz.shape
+        a,b,c,d=self._inverse
+        col=a*qx+b*qy
+        row=c*qx+d*qy
+        eps=1.0e-9
+        outside=(col < -eps) | (col > ncols-1+eps) | (row < -eps) | (row > nrows-1+eps)
+        i=np.clip(np.floor(row).astype(np.int64),0,nrows-2)
+        j=np.clip(np.floor(col).astype(np.int64),0,ncols-2)
+        u=np.clip(col-j,0.0,1.0)
+        v=np.clip(row-i,0.0,1.0)
+        result=((gz[i,j]*(1.0-u)+gz[i,j+1]*u)*(1.0-v)
+                +(gz[i+1,j]*(1.0-u)+gz[i+1,j+1]*u)*v)
+        result[outside]=np.nan
+        return result
+
+ClassifyRaster=namedtuple('ClassifyRaster','geotransform nrows ncols')
+ClassifyRaster.__doc__='''
+Definition of a classified raster.  geotransform is the GDAL affine
+transform (x0, dxcol, dxrow, y0, dycol, dyrow) of the top left corner
+of the raster, nrows and ncols the raster size.
+'''
+
+def _coordinateArray( v ):
+    if v is None:
+        return None
+    v=np.asarray(v)
+    return v if v.dtype == np.float32 else v.astype(np.float64,copy=False)
+
+def relativeCoordinates( x, y, float32=False, tolerance=None ):
+    '''
+    Coordinates relative to an origin at the centre of their extent,
+    returned as x, y, origin.  If float32 is true the relative
+    coordinates are stored as float32, halving their memory, provided
+    the rounding error at the edge of the extent is within tolerance (by
+    default a thousandth of the mean point spacing).  Otherwise a
+    ClassifyError is raised.
+    '''
+    x=np.asarray(x,dtype=np.float64)
+    y=np.asarray(y,dtype=np.float64)
+    if len(x) == 0:
+        return x,y,(0.0,0.0)
+    xmin,xmax=float(np.min(x)),float(np.max(x))
+    ymin,ymax=float(np.min(y)),float(np.max(y))
+    origin=(0.5*(xmin+xmax),0.5*(ymin+ymax))
+    dtype=np.float64
+    if float32:
+        if tolerance is None or tolerance <= 0:
+            tolerance=0.001*np.sqrt((xmax-xmin)*(ymax-ymin)/len(x))
+        extent=max(xmax-xmin,ymax-ymin)
+        error=0.5*float(np.spacing(np.float32(0.5*extent)))
+        if not error <= tolerance:
+            raise ClassifyError(tr("Extent {0} is too large for single precision coordinates with tolerance {1}")
+                                .format(extent,tolerance))
+        dtype=np.float32
+    x=np.subtract(x,origin[0],out=np.empty(x.shape,dtype=dtype))
+    y=np.subtract(y,origin[1],out=np.empty(y.shape,dtype=dtype))
+    return x,y,origin
+
+class ClassifyEngine:
+    '''
+    Classify x, y, z point data.  feedback is optional and should support
+    isCanceled(), setProgress(percent), pushInfo(message) and
+    reportError(message).  stats is an optional ClassifyStats object used
+    to record the time spent in each stage.
+    '''
+
+    # Number of level calculations remembered
+    LevelCacheSize=16
+
+    # Approximate peak memory in bytes used per point by each stage,
+    # measured on large scattered data sets, and per grid cell and per
+    # IDW neighbour of each grid node queried at once
+    MemoryPerPoint={
+        'grid': 100,
+        'triangulation': 620,
+        'contour': 20,
+        'kd-tree': 70,
+        'quantile': 16,
+        'jenks': 60,
+        }
+    MemoryPerCell=48
+    MemoryPerNeighbour=30
+
+    # Fewest values levels are calculated from, and the largest factor
+    # the interpolation cell size is increased by, to fit the memory budget
+    MinLevelSample=10000
+    MaxCellSizeFactor=4.0
+
+    def __init__( self, x=None, y=None, z=None, feedback=None, stats=None, origin=None ):
+        self._feedback=feedback or _DummyFeedback()
+        self._stats=stats or ClassifyStats()
+        self._dataVersion=0
+        self._dedupTolerance=0
+        self._levelCache=OrderedDict()
+        self._methodKey=None
+        self._useGrid=True
+        self._useQhullWorkaround=False
+        self._ClassifyMethod=None
+        self._ClassifyMethodParams=None
+        self._ClassifyType=ClassifyType.line
+        self._extendFilled=ClassifyExtendOption.both
+        self._labelNdp=-1
+        self._labelTrimZeros=False
+        self._labelUnits=''
+        self._interpolation=ClassifyInterpolation.none
+        self._cellSize=None
+        self._idwPower=2.0
+        self._idwNeighbours=8
+        self._lodCount=1
+        self._lodTolerance=None
+        self._lodFactor=4.0
+        self._lodDropMinor=False
+        self._memoryBudget=None
+        self._path=ClassifyPath.auto
+        self._pathTolerance=None
+        self._plan=None
+        self._plannedPath=None
+        self.setData(x,y,z,origin)
+
+    def setData( self, x, y, z, origin=None ):
+        '''
+        Set the point data.  x and y are relative to origin (by default
+        0,0), which is added to the output geometries and raster, and
+        subtracted from point queries.  float32 x and y (for example from
+        relativeCoordinates) are kept as float32, anything else is
+        converted to float64.
+        '''
+        self._x=_coordinateArray(x)
+        self._y=_coordinateArray(y)
+        self._z=None if z is None else np.asarray(z,dtype=np.float64)
+        self._origin=(0.0,0.0) if origin is None else (float(origin[0]),float(origin[1]))
+        self._dataVersion += 1
+        self._dedupTolerance=0
+        self._resetData()
+
+    def _resetData( self ):
+        self._gridTested=False
+        self._gridShape=None
+        self._gridOrder=None
+        self._trig=None
+        self._interpolatedGrid=None
+        self._locator=None
+        self._levels=None
+        self._defaultLabelNdp=None
+        self._plan=None
+
+    def data( self ):
+        '''
+        The x, y, z data arrays, with x and y relative to the origin
+        '''
+        return self._x, self._y, self._z
+
+    def origin( self ):
+        return self._origin
+
+    def dataVersion( self ):
+        '''
+        Number incremented each time the data are changed
+        '''
+        return self._dataVersion
+
+    def statistics( self ):
+        return self._stats
+
+    def discardDuplicatePoints( self, tolerance, isLonLat=False ):
+        '''
+        Discard points within tolerance of each other.  Returns the number
+        of points discarded.
+        '''
+        x,y,z=self.data()
+        if x is None or tolerance <= 0:
+            return 0
+        npt=len(x)
+        with self._stats.stage('dedup'):
+            # The longitude/latitude scaling depends on the absolute latitude
+            ylat=y+self._origin[1] if isLonLat else y
+            index=ClassifyUtils.discardDuplicatePoints(x,ylat,tolerance,isLonLat)
+        npt1=len(index)
+        if npt1 < npt:
+            self.setData(x[index],y[index],z[index],self._origin)
+        self._dedupTolerance=(tolerance,isLonLat)
+        self._stats.setCount('duplicate points',npt-npt1)
+        self._stats.setCount('points',npt1)
+        return npt-npt1
+
+    def decimatedEngine( self, maxPoints, feedback=None ):
+        '''
+        A new engine with about maxPoints of the data and the same
+        settings and levels, for quickly previewing the classification.
+        Gridded data are reduced to a coarser grid by taking every nth row
+        and column, otherwise a random subset of the points is used.
+        '''
+        x,y,z=self.data()
+        if z is None:
+            raise ClassifyError(tr("Classify data not defined"))
+        levels=self.levels()
+        npt=len(z)
+        if npt > maxPoints:
+            if self._useGrid and self.isGridded():
+                step=int(np.ceil(np.sqrt(npt/maxPoints)))
+                index=np.arange(npt)
+                if self._gridOrder is not None:
+                    index=index[self._gridOrder]
+                index=index.reshape(self._gridShape)[::step,::step].ravel()
+            else:
+                rng=np.random.default_rng(0)
+                index=np.unique(rng.integers(0,npt,maxPoints))
+            x,y,z=x[index],y[index],z[index]
+        engine=ClassifyEngine(x,y,z,feedback=feedback,origin=self._origin)
+        engine.setUseGrid(self._useGrid)
+        engine.setCalculationPath(self.plan().path)
+        engine.setQhullWorkaround(self._useQhullWorkaround)
+        engine.setInterpolation(self._interpolation,None,self._idwPower,self._idwNeighbours)
+        engine.setClassifyLevels(levels)
+        engine.setClassifyType(self._ClassifyType)
+        engine.setClassifyExtendOption(self._extendFilled)
+        engine.setLabelFormat(self._labelNdp,self._labelTrimZeros,self._labelUnits)
+        return engine
+
+    def setUseGrid( self, usegrid ):
+        if usegrid != self._useGrid:
+            self._levels=None
+            self._locator=None
+            self._resetPlan()
+        self._useGrid=usegrid
+
+    def setInterpolation( self, method, cellSize=None, power=2.0, neighbours=8 ):
+        '''
+        Interpolate data not on a grid onto a grid with the given cell
+        size (by default about the mean point spacing) and contour the
+        grid rather than the triangulation.  method is one of the
+        ClassifyInterpolation options - idw is inverse distance weighted
+        interpolation from the nearest neighbours (requires scipy), and
+        linear is linear interpolation on the triangulation.
+        '''
+        method=(method or ClassifyInterpolation.none).lower()
+        if not ClassifyInterpolation.valid(method):
+            raise ClassifyError(tr("Invalid interpolation method {0}").format(method))
+        if cellSize is not None and cellSize <= 0:
+            cellSize=None
+        setting=(method,cellSize,power,neighbours)
+        if setting != (self._interpolation,self._cellSize,self._idwPower,self._idwNeighbours):
+            self._interpolation,self._cellSize,self._idwPower,self._idwNeighbours=setting
+            self._interpolatedGrid=None
+            self._locator=None
+            self._levels=None
+            self._resetPlan()
+
+    def interpolates( self ):
+        '''
+        True if the data are interpolated to a grid for contouring
+        '''
+        return self.plan().path == ClassifyPath.interpolation
+
+    def interpolationMethod( self ):
+        '''
+        The interpolation method used for the data, which is none unless
+        the calculation path is interpolation
+        '''
+        return self.plan().interpolation
+
+    def setCalculationPath( self, path, tolerance=None ):
+        '''
+        Set the calculation path, one of the ClassifyPath options.  auto
+        uses the grid for gridded data and the interpolation method if
+        one is set, otherwise chooses the cheaper of triangulation and
+        IDW interpolation.  Interpolation is only chosen if the
+        interpolation cell size is no more than tolerance, as it
+        approximates the surface through the points, or if the
+        triangulation would exceed the memory budget.
+        '''
+        path=(path or ClassifyPath.auto).lower()
+        if not ClassifyPath.valid(path):
+            raise ClassifyError(tr("Invalid calculation path {0}").format(path))
+        if tolerance is not None and tolerance <= 0:
+            tolerance=None
+        if (path,tolerance) != (self._path,self._pathTolerance):
+            self._path,self._pathTolerance=path,tolerance
+            self._resetPlan()
+
+    def calculationPath( self ):
+        return self._path
+
+    def _resetPlan( self ):
+        self._plan=None
+
+    # Approximate time in seconds of each step of the calculation paths,
+    # per point (times log2 of the number of points where marked), grid
+    # cell, or IDW neighbour of each grid cell, and per level contoured
+    PathCosts={
+        'triangulation': 1.0e-6,        # x log2(n)
+        'triangle contour setup': 2.0e-7,  # x log2(n)
+        'triangle contour': 8.0e-8,     # per level
+        'triangle raster': 1.4e-6,
+        'kd-tree': 5.0e-8,              # x log2(n)
+        'idw': 3.0e-7,                  # per neighbour
+        'grid contour': 6.0e-9,         # per level
+        'grid raster': 2.0e-8,
+        }
+
+    def plan( self ):
+        '''
+        The ClassifyPlan for the current data and settings, calculated on
+        first use and reported through the feedback.  Raises a
+        ClassifyError if the selected path cannot be used or no path fits
+        the memory budget.
+        '''
+        if self._plan is None:
+            plan=self._makePlan()
+            # Levels and point queries depend on the path
+            path=plan.path,plan.interpolation
+            if self._plannedPath is not None and self._plannedPath != path:
+                self._levels=None
+                self._locator=None
+            self._plannedPath=path
+            self._plan=plan
+            costs=', '.join('{0} {1}'.format(p,'-' if c is None else '{0:.2g}s'.format(c))
+                            for p,c in plan.costs.items())
+            message="Calculation path {0} ({1})".format(plan.path,plan.reason)
+            if costs:
+                message += " - estimated "+costs
+            self._feedback.pushInfo(message)
+        return self._plan
+
+    def _makePlan( self ):
+        none=ClassifyInterpolation.none
+        x,y,z=self.data()
+        costs=OrderedDict()
+        path=self._path
+        if z is None:
+            return ClassifyPlan(ClassifyPath.triangulation,none,costs,'no data')
+        if path == ClassifyPath.grid:
+            if not self.isGridded():
+                raise ClassifyError(tr("The data are not on a regular grid"))
+            return ClassifyPlan(path,none,costs,'selected')
+        if path == ClassifyPath.triangulation:
+            return ClassifyPlan(path,none,costs,'selected')
+        if path == ClassifyPath.interpolation:
+            method=self._interpolation if self._interpolation != none else ClassifyInterpolation.idw
+            self._checkInterpolation(method)
+            return ClassifyPlan(path,method,costs,'selected')
+        if self._useGrid and self.isGridded():
+            return ClassifyPlan(ClassifyPath.grid,none,costs,'data on a regular grid')
+        if self._interpolation != none:
+            self._checkInterpolation(self._interpolation)
+            return ClassifyPlan(ClassifyPath.interpolation,self._interpolation,costs,
+                                'interpolation method set')
+
+        # Choose the cheaper of triangulation and IDW interpolation
+        trigCost=self._triangulationCost()
+        trigFits=self._fitsBudget(self._stageMemory('triangulation'))
+        costs[ClassifyPath.triangulation]=trigCost if trigFits else None
+        idw=ClassifyInterpolation.idw
+        idwCost=None
+        cellSize=None
+        if idwAvailable():
+            try:
+                xmin,ymin,cellSize,nrows,ncols=self._interpolationShape(idw)
+                idwCost=self._interpolationCost(nrows*ncols)
+            except ClassifyError:
+                pass
+        costs[ClassifyPath.interpolation]=idwCost
+        accurate=self._pathTolerance is not None and cellSize is not None and cellSize <= self._pathTolerance
+        if not trigFits:
+            if idwCost is None:
+                # No path fits the memory budget
+                self._checkMemory('triangulation',self._stageMemory('triangulation'))
+            return ClassifyPlan(ClassifyPath.interpolation,idw,costs,'triangulation exceeds the memory budget')
+        if idwCost is not None and accurate and idwCost < trigCost:
+            return ClassifyPlan(ClassifyPath.interpolation,idw,costs,'lowest estimated cost')
+        if idwCost is None or accurate:
+            reason='lowest estimated cost'
+        elif self._pathTolerance is None:
+            reason='no interpolation tolerance set'
+        else:
+            reason='interpolation cell size exceeds tolerance'
+        return ClassifyPlan(ClassifyPath.triangulation,none,costs,reason)
+
+    def _checkInterpolation( self, method ):
+        '''
+        Raise a ClassifyError if the modules interpolation method requires
+        are not installed
+        '''
+        if method == ClassifyInterpolation.idw and not idwAvailable():
+            raise ClassifyError(tr("IDW interpolation requires the python scipy module"))
+
+    def _plannedLevelCount( self ):
+        if self._levels is not None:
+            return len(self._levels)
+        params=self._ClassifyMethodParams or {}
+        levels=params.get('levels')
+        if self._ClassifyMethod == 'manual' and levels is not None:
+            return max(len(levels if not isinstance(levels,str) else levels.split()),1)
+        return max(int(params.get('ncontour') or params.get('maxcontour') or 10),1)
+
+    def _triangulationCost( self ):
+        npt=len(self._z)
+        logn=np.log2(max(npt,2))
+        costs=self.PathCosts
+        # Work already done is not counted
+        cost=npt*logn*costs['triangulation'] if self._trig is None else 0.0
+        if ClassifyType.isRaster(self._ClassifyType):
+            return cost+npt*costs['triangle raster']
+        cost += npt*logn*costs['triangle contour setup']
+        return cost+self._plannedLevelCount()*2*npt*costs['triangle contour']
+
+    def _interpolationCost( self, ncell ):
+        npt=len(self._z)
+        costs=self.PathCosts
+        cost=0.0
+        if self._interpolatedGrid is None or self._plannedPath != (ClassifyPath.interpolation,ClassifyInterpolation.idw):
+            cost += npt*np.log2(max(npt,2))*costs['kd-tree']
+            cost += ncell*min(self._idwNeighbours,npt)*costs['idw']
+        if ClassifyType.isRaster(self._ClassifyType):
+            return cost+ncell*costs['grid raster']
+        return cost+self._plannedLevelCount()*ncell*costs['grid contour']
+
+    def setMemoryBudget( self, budget ):
+        '''
+        Limit the memory used to classify the data to about budget bytes,
+        or None for no limit.  The memory each stage needs is estimated
+        before it is run, and if it exceeds the budget a cheaper strategy
+        is used where possible - levels are calculated from a sample of
+        the values, scattered data are interpolated to a grid rather than
+        triangulated, and the interpolation grid is coarsened and queried
+        in smaller batches.  Otherwise the stage fails with a
+        ClassifyError.
+        '''
+        budget=int(budget) if budget is not None and budget > 0 else None
+        if budget != self._memoryBudget:
+            self._memoryBudget=budget
+            self._interpolatedGrid=None
+            self._locator=None
+            self._levels=None
+            self._resetPlan()
+
+    def memoryBudget( self ):
+        return self._memoryBudget
+
+    def dataMemory( self ):
+        '''
+        Memory in bytes used by the x, y, z data
+        '''
+        return sum(v.nbytes for v in self.data() if v is not None)
+
+    def memoryEstimate( self ):
+        '''
+        Estimated peak memory in bytes of each stage of the classification
+        with the current data and settings, including the data, as an
+        OrderedDict keyed on stage name
+        '''
+        x,y,z=self.data()
+        if z is None:
+            raise ClassifyError(tr("Classify data not defined"))
+        data=self.dataMemory()
+        estimate=OrderedDict()
+        estimate['data']=data
+        estimate['grid']=data+self._stageMemory('grid')
+        method=self._ClassifyMethod
+        if method in self.MemoryPerPoint:
+            estimate['levels']=data+self._stageMemory(method)
+        if self.interpolates():
+            method=self.interpolationMethod()
+            nrows,ncols=self._interpolationShape(method)[3:]
+            estimate['interpolation']=data+self._interpolationMemory(
+                nrows,ncols,method,self._interpolationBatchSize(nrows,ncols,method))
+        elif not self.usesGrid():
+            estimate['triangulation']=data+self._stageMemory('triangulation')
+        estimate['contour']=data+self._stageMemory('contour')
+        return estimate
+
+    def _stageMemory( self, stage, npt=None ):
+        if npt is None:
+            npt=len(self._z)
+        return npt*self.MemoryPerPoint[stage]
+
+    def _interpolationMemory( self, nrows, ncols, method, batchSize=None ):
+        ncell=nrows*ncols
+        memory=ncell*self.MemoryPerCell
+        if method == ClassifyInterpolation.idw:
+            batchSize=min(batchSize or self.InterpolationBatchSize,ncell)
+            memory += self._stageMemory('kd-tree')
+            memory += batchSize*min(self._idwNeighbours,len(self._z))*self.MemoryPerNeighbour
+        else:
+            memory += self._stageMemory('triangulation')
+        return memory
+
+    def _fitsBudget( self, memory ):
+        return self._memoryBudget is None or self.dataMemory()+memory <= self._memoryBudget
+
+    def _checkMemory( self, stage, memory ):
+        '''
+        Raise a ClassifyError if stage needs more memory than the budget
+        '''
+        if not self._fitsBudget(memory):
+            raise ClassifyError(tr("{0} needs about {1:.0f}MB, more than the memory budget of {2:.0f}MB")
+                .format(stage.capitalize(),(self.dataMemory()+memory)/1048576.0,
+                        self._memoryBudget/1048576.0))
+
+    def setQhullWorkaround( self, useWorkaround ):
+        '''
+        Build triangulations in a separate process - required as qhull
+        fails when called from within QGIS python on some platforms.
+        '''
+        self._useQhullWorkaround=useWorkaround
+
+    def setClassifyLevels( self, levels ):
+        self.setClassifyMethod('manual',{'levels':levels})
+
+    def _paramsKey( self, method, params ):
+        try:
+            return ClassifyMethod.paramsKey(method,params or {})
+        except ClassifyMethodError:
+            return None
+
+    def setClassifyMethod( self, method, params ):
+        key=self._paramsKey(method,params)
+        self._ClassifyMethod=method
+        self._ClassifyMethodParams=params
+        if key is not None and key == self._methodKey:
+            return
+        self._methodKey=key
+        self._levels=None
+        self._defaultLabelNdp=None
+        # The cost of each path depends on the number of levels
+        self._resetPlan()
+
+    def setClassifyType( self, classifyType ):
+        classifyType=classifyType.lower()
+        if not ClassifyType.valid(classifyType):
+            raise ClassifyError(tr("Invalid Classify type {0}").format(classifyType))
+        if classifyType != self._ClassifyType:
+            self._resetPlan()
+        self._ClassifyType=classifyType
+
+    def classifyType( self ):
+        return self._ClassifyType
+
+    def setClassifyExtendOption( self, extend ):
+        extend=extend.lower()
+        if not ClassifyExtendOption.valid(extend):
+            raise ClassifyError(tr("Invalid filled Classify extend option {0}").format(extend))
+        self._extendFilled=extend
+
+    def setLevelsOfDetail( self, count, tolerance=None, factor=4.0, dropMinor=False ):
+        '''
+        Generate count levels of detail of each feature.  Level 0 is full
+        resolution, and each further level is simplified from the
+        previous one, level 1 with tolerance (by default the mean point
+        spacing) and each level after with factor times the tolerance of
+        the one before.  If dropMinor is true then level of detail n only
+        includes every 2**n th level (not applied to filled contours, as
+        the ranges between levels cannot be merged).
+        '''
+        self._lodCount=max(int(count),1)
+        self._lodTolerance=tolerance
+        self._lodFactor=factor
+        self._lodDropMinor=dropMinor
+
+    def levelsOfDetail( self ):
+        return self._lodCount
+
+    def lodTolerances( self ):
+        '''
+        Simplification tolerance of each level of detail (0 for the full
+        resolution level)
+        '''
+        tolerance=self._lodTolerance
+        if self._lodCount > 1 and not tolerance:
+            x,y,z=self.data()
+            if z is None:
+                raise ClassifyError(tr("Classify data not defined"))
+            tolerance=float(np.sqrt((np.max(x)-np.min(x))*(np.max(y)-np.min(y))/len(x)))
+        return [0.0]+[tolerance*self._lodFactor**i for i in range(self._lodCount-1)]
+
+    def setLabelFormat( self, ndp, trim=False, units='' ):
+        self._labelNdp = ndp
+        self._labelTrimZeros = trim
+        self._labelUnits = units
+
+    def isGridded( self ):
+        '''
+        Check if points data are on a regular grid
+        '''
+        if not self._gridTested:
+            x,y,z=self.data()
+            if z is not None:
+                self._checkMemory('grid detection',self._stageMemory('grid'))
+            with self._stats.stage('grid'):
+                self._gridShape,self._gridOrder=DataGridder(x,y).calcGrid()
+            self._gridTested=True
+        return self._gridShape is not None
+
+    def gridShape( self ):
+        return self._gridShape if self.isGridded() else None
+
+    def usesGrid( self ):
+        return self.plan().path != ClassifyPath.triangulation
+
+    def levels( self ):
+        if self._levels is None:
+            method=self._ClassifyMethod
+            if method is None:
+                raise ClassifyError(tr("Classifying method not defined"))
+            self._levels=self.calculateLevels(method,self._ClassifyMethodParams)
+            self._defaultLabelNdp = None
+        return self._levels
+
+    def calculateLevels( self, method, params ):
+        '''
+        Calculate levels for the data with a method and parameters.  The
+        results are remembered in an LRU cache keyed on the data version,
+        duplicate point tolerance, and normalized method parameters, so
+        switching between methods does not recalculate over all the data.
+        The returned array is read only.
+        '''
+        x,y,z = self.data()
+        if z is None:
+            raise ClassifyError(tr("Classify data not defined"))
+        params=params or {}
+        key=self._paramsKey(method,params)
+        if key is not None:
+            if ClassifyMethod.getMethod(key[0]).usesData:
+                key += (self.usesGrid(),)
+                if self.interpolates():
+                    key += (self.interpolationMethod(),self._cellSize,self._idwPower,
+                            self._idwNeighbours,self._memoryBudget)
+            elif method in self.MemoryPerPoint:
+                key += (self._memoryBudget,)
+            key=(self._dataVersion,self._dedupTolerance)+key
+            if key in self._levelCache:
+                self._levelCache.move_to_end(key)
+                self._stats.count('level cache hits')
+                return self._levelCache[key]
+        if method in self.MemoryPerPoint:
+            z=self._levelSample(z,method)
+        with self._stats.stage('levels'):
+            levels=ClassifyMethod.calculateLevels(z,method,data=self,**params)
+        levels=np.asarray(levels)
+        levels.flags.writeable=False
+        if key is not None:
+            self._levelCache[key]=levels
+            while len(self._levelCache) > self.LevelCacheSize:
+                self._levelCache.popitem(last=False)
+        return levels
+
+    def _levelSample( self, z, method ):
+        '''
+        z, or a random sample of z including its extremes if calculating
+        levels from all the values would exceed the memory budget
+        '''
+        if self._fitsBudget(self._stageMemory(method,len(z))):
+            return z
+        nsample=(self._memoryBudget-self.dataMemory())//self.MemoryPerPoint[method]
+        if nsample < self.MinLevelSample:
+            self._checkMemory('level calculation',self._stageMemory(method,self.MinLevelSample))
+            nsample=self.MinLevelSample
+        rng=np.random.default_rng(0)
+        index=np.unique(np.concatenate((rng.integers(0,len(z),nsample),
+                                        [np.nanargmin(z),np.nanargmax(z)])))
+        self._feedback.pushInfo("Calculating levels from a sample of {0} values to fit the memory budget"
+            .format(len(index)))
+        self._stats.setCount('level sample',len(index))
+        return z[index]
+
+    def _gridData( self ):
+        if self.interpolates():
+            return self.interpolatedGrid()
+        gx,gy,gz=self.data()
+        order=self._gridOrder
+        shape=self._gridShape
+        if order is not None:
+            gx=gx[order]
+            gy=gy[order]
+            gz=gz[order]
+        gx=gx.reshape(shape)
+        gy=gy.reshape(shape)
+        gz=gz.reshape(shape)
+        return gx, gy, gz
+
+    def gridClassifyData( self ):
+        gx,gy,gz=self._gridData()
+        self._feedback.pushInfo("Classifying {0} by {1} grid"
+            .format(gz.shape[0],gz.shape[1]))
+        return gx, gy, gz
+
+    def interpolatedGrid( self ):
+        '''
+        x, y, z arrays of the data interpolated onto a regular grid
+        covering the data extent, built on first use.  Grid nodes outside
+        the data area are nan.
+        '''
+        if self._interpolatedGrid is None:
+            x,y,z=self.data()
+            if z is None:
+                raise ClassifyError(tr("Classify data not defined"))
+            method=self.interpolationMethod()
+            xmin,ymin,cellSize,nrows,ncols=self._interpolationShape(method)
+            spacing=np.sqrt((np.max(x)-xmin)*(np.max(y)-ymin)/len(x))
+            if cellSize != (self._cellSize or spacing):
+                self._feedback.pushInfo("Interpolation cell size increased to {0:.6g} to fit the memory budget"
+                    .format(cellSize))
+            self._feedback.pushInfo("Interpolating {0} points to {1} by {2} grid"
+                .format(len(x),nrows,ncols))
+            gx=np.broadcast_to(xmin+np.arange(ncols)*cellSize,(nrows,ncols))
+            gy=np.broadcast_to((ymin+np.arange(nrows)*cellSize)[:,None],(nrows,ncols))
+            if method == ClassifyInterpolation.idw:
+                batchSize=self._interpolationBatchSize(nrows,ncols,method)
+                gz=self._idwGrid(gx,gy,max(cellSize,spacing)*2.0,batchSize)
+            else:
+                gz=self._linearGrid(xmin-0.5*cellSize,ymin-0.5*cellSize,cellSize,nrows,ncols)
+            self._stats.setCount('grid cells',nrows*ncols)
+            self._interpolatedGrid=(gx,gy,gz)
+        return self._interpolatedGrid
+
+    def _interpolationShape( self, method ):
+        '''
+        Origin, cell size, and number of rows and columns of the grid
+        interpolated with method.  If the grid would exceed the memory budget
+        and the cell size is not set, the cells are made larger.
+        '''
+        x,y,z=self.data()
+        xmin,xmax=np.min(x),np.max(x)
+        ymin,ymax=np.min(y),np.max(y)
+        spacing=np.sqrt((xmax-xmin)*(ymax-ymin)/len(x))
+        cellSize=self._cellSize or spacing
+        if not cellSize > 0:
+            raise ClassifyError(tr("Cannot determine interpolation cell size"))
+        while True:
+            ncols=int(np.ceil((xmax-xmin)/cellSize))+1
+            nrows=int(np.ceil((ymax-ymin)/cellSize))+1
+            batchSize=self._interpolationBatchSize(nrows,ncols,method)
+            memory=self._interpolationMemory(nrows,ncols,method,batchSize)
+            if self._fitsBudget(memory):
+                break
+            if self._cellSize is not None or cellSize*1.1 > spacing*self.MaxCellSizeFactor:
+                self._checkMemory('interpolation',memory)
+            cellSize *= 1.1
+        return xmin,ymin,cellSize,nrows,ncols
+
+    def _interpolationBatchSize( self, nrows, ncols, method ):
+        '''
+        Number of grid nodes to interpolate at once - reduced from
+        InterpolationBatchSize to a single row to fit the memory budget
+        '''
+        batchSize=self.InterpolationBatchSize
+        if self._memoryBudget is not None and method == ClassifyInterpolation.idw:
+            available=(self._memoryBudget-self.dataMemory()
+                       -self._interpolationMemory(nrows,ncols,method,1))
+            perNode=min(self._idwNeighbours,len(self._z))*self.MemoryPerNeighbour
+            batchSize=min(batchSize,max(available//perNode,ncols))
+        return int(batchSize)
+
+    # Number of grid nodes interpolated in each batch of IDW queries
+    InterpolationBatchSize=1000000
+
+    def _idwGrid( self, gx, gy, maxDistance, batchSize=None ):
+        '''
+        Inverse distance weighted interpolation from the nearest points,
+        queried from a KD-tree in batches of about batchSize grid nodes
+        (by default InterpolationBatchSize).  Nodes with no point within
+        maxDistance are nan.
+        '''
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError:
+            raise ClassifyError(tr("IDW interpolation requires the python scipy module"))
+        x,y,z=self.data()
+        nrows,ncols=gx.shape
+        k=min(self._idwNeighbours,len(x))
+        power=self._idwPower
+        gz=np.empty((nrows,ncols))
+        with self._stats.stage('interpolation'):
+            tree=cKDTree(np.column_stack((x,y)))
+            batchRows=max((batchSize or self.InterpolationBatchSize)//ncols,1)
+            for row in range(0,nrows,batchRows):
+                if self._feedback.isCanceled():
+                    raise ClassifyError(tr('Cancelled by user'))
+                self._feedback.setProgress(int(row*100.0/nrows))
+                qx=gx[row:row+batchRows].ravel()
+                qy=gy[row:row+batchRows].ravel()
+                dist,index=tree.query(np.column_stack((qx,qy)),k=k,workers=-1)
+                if k == 1:
+                    dist=dist[:,None]
+                    index=index[:,None]
+                with np.errstate(divide='ignore'):
+                    weight=1.0/dist**power
+                # Nodes coinciding with a point take its value
+                exact=dist[:,0] == 0.0
+                weight[exact]=0.0
+                weight[exact,0]=1.0
+                value=np.sum(weight*z[index],axis=1)/np.sum(weight,axis=1)
+                value[dist[:,0] > maxDistance]=np.nan
+                gz[row:row+batchRows]=value.reshape((-1,ncols))
+            self._feedback.setProgress(0)
+        return gz
+
+    def _linearGrid( self, x0, y0, cellSize, nrows, ncols ):
+        '''
+        Linear interpolation on the triangulation at the grid nodes
+        '''
+        x,y,z=self.data()
+        trig=self.triangulation()
+        triangles=trig.triangles
+        if trig.mask is not None:
+            triangles=triangles[~trig.mask]
+        raster=ClassifyRaster((x0,cellSize,0.0,y0,0.0,cellSize),nrows,ncols)
+        with self._stats.stage('interpolation'):
+            return _TriangleRasterizer(raster,x,y,z,triangles).values(0,nrows)
+
+    def _buildtrig_workaround( self, x, y ):
+        '''
+        Workaround implemented as qhull fails when called from
+        within QGIS python in ubuntu 17.10, QGIS 3.1 :-(
+        '''
+        import os
+        import subprocess
+        import tempfile
+        tfh,tfname=tempfile.mkstemp('.npy','tmp_Classify_generator')
+        tfh2,tfname2=tempfile.mkstemp('.npy','tmp_Classify_generator')
+        os.close(tfh)
+        os.close(tfh2)
+        trig=None
+        try:
+            np.save(tfname,np.vstack((x,y)))
+            pydir=os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
+            pyscript=os.path.join(pydir,'buildtrig_qhull_workaround.py')
+            python=sys.executable
+            result=subprocess.call([python,pyscript,tfname,tfname2])
+            triangles=np.load(tfname2)
+            trig=Triangulation(x,y,triangles)
+        finally:
+            os.remove(tfname)
+            os.remove(tfname2)
+        return trig
+
+    def buildTriangulation( self, x, y ):
+        trig=None
+        if self._useQhullWorkaround:
+            trig=self._buildtrig_workaround(x,y)
+        else:
+            trig=Triangulation(x,y)
+        analyzer=TriAnalyzer(trig)
+        mask=analyzer.get_flat_tri_mask()
+        trig.set_mask(mask)
+        return trig
+
+    def triangulation( self ):
+        '''
+        Triangulation of the data points, built on first use
+        '''
+        if self._trig is None:
+            x,y,z=self.data()
+            self._checkMemory('triangulation',self._stageMemory('triangulation'))
+            self._feedback.pushInfo("Triangulating {0} points"
+                .format(len(x)))
+            with self._stats.stage('triangulation'):
+                self._trig=self.buildTriangulation(x,y)
+            self._stats.setCount('triangles',self._trig.triangles.shape[0])
+        return self._trig
+
+    def trigClassifyData( self ):
+        x,y,z=self.data()
+        trig=self.triangulation()
+        self._feedback.pushInfo("Classifying {0} triangles"
+            .format(trig.triangles.shape[0]))
+        return trig,z
+
+    def triangleData( self ):
+        '''
+        Returns x, y (relative to the origin), z arrays and an (n,3)
+        array of indices of the vertices of triangles covering the data
+        area.  If the data are
+        contoured as a grid these are the grid cells each split into two
+        triangles, otherwise the unmasked triangles of the triangulation.
+        '''
+        if self.usesGrid():
+            gx,gy,gz=self._gridData()
+            nrow,ncol=gz.shape
+            corner=(np.arange(nrow-1)[:,None]*ncol+np.arange(ncol-1)[None,:]).ravel()
+            triangles=np.concatenate((
+                np.column_stack((corner,corner+1,corner+ncol+1)),
+                np.column_stack((corner,corner+ncol+1,corner+ncol))))
+            z=gz.ravel()
+            triangles=triangles[np.all(np.isfinite(z[triangles]),axis=1)]
+            return gx.ravel(),gy.ravel(),z,triangles
+        x,y,z=self.data()
+        trig=self.triangulation()
+        triangles=trig.triangles
+        if trig.mask is not None:
+            triangles=triangles[~trig.mask]
+        return x,y,z,triangles
+
+    def _contourGenerator( self, lock=None ):
+        '''
+        Returns a function to calculate contour lines for a level and a
+        function to calculate filled contours between two levels, each
+        returning a ClassifyGeometry, and the z values contoured.  The
+        underlying generators keep state while contouring, so if the
+        functions are called from several threads lock must be given,
+        and is held while contouring but not while building geometries.
+        '''
+        if lock is None:
+            import contextlib
+            lock=contextlib.nullcontext()
+        try:
+            if self.usesGrid():
+                import contourpy
+                gx,gy,gz=self.gridClassifyData()
+                if self.interpolates():
+                    gz=np.ma.masked_invalid(gz)
+                generator=contourpy.contour_generator(gx,gy,gz,
+                    line_type=contourpy.LineType.ChunkCombinedOffset,
+                    fill_type=contourpy.FillType.ChunkCombinedOffsetOffset)
+
+                def lines( level ):
+                    with lock:
+                        points,offsets=generator.lines(level)
+                    if points[0] is None:
+                        return ClassifyGeometry.fromLines([])
+                    return ClassifyGeometry(ClassifyGeometry.line,
+                        points[0],offsets[0].astype(np.int64))
+
+                def filled( lower, upper ):
+                    with lock:
+                        points,offsets,outer=generator.filled(lower,upper)
+                    if points[0] is None:
+                        return ClassifyGeometry.fromPolygons([])
+                    return ClassifyGeometry(ClassifyGeometry.polygon,
+                        points[0],offsets[0].astype(np.int64),outer[0].astype(np.int64))
+            else:
+                trig,gz=self.trigClassifyData()
+                generator=triContourGenerator(trig,gz)
+
+                def lines( level ):
+                    with lock:
+                        vertices,codes=generator.create_contour(level)
+                    return ClassifyGeometry.fromLines(_splitPaths(vertices,codes))
+
+                def filled( lower, upper ):
+                    with lock:
+                        vertices,codes=generator.create_filled_contour(lower,upper)
+                    rings=_splitPaths(vertices,codes)
+                    return ClassifyGeometry.fromPolygons(_assemblePolygons(rings))
+        except ClassifyError:
+            raise
+        except:
+            raise ClassifyGenerationError.fromException(sys.exc_info())
+        return lines,filled,gz
+
+    def _contour( self, func, *args ):
+        if self._feedback.isCanceled():
+            raise ClassifyError(tr('Cancelled by user'))
+        try:
+            with self._stats.stage('contour'):
+                geom=func(*args)
+                geom.translate(*self._origin)
+        except:
+            raise ClassifyGenerationError.fromException(sys.exc_info())
+        self._stats.count('vertices',geom.nVertices())
+        return geom
+
+    def calcLabelNdp( self ):
+        if self._labelNdp is not None and self._labelNdp > 0:
+            return self._labelNdp
+        if self._defaultLabelNdp is None:
+            levels=self.levels()
+            ndp=ClassifyUtils.calcDefaultNdp(levels)
+            self._defaultLabelNdp = ndp
+        return self._defaultLabelNdp
+
+    def formatLevel( self, level ):
+        ndp=self.calcLabelNdp()
+        if ndp < 0:
+            return str(level)
+        elif self._labelTrimZeros:
+            level=np.round(level,ndp)
+            return str(level)
+        else:
+            return "{1:.{0}f}".format(ndp,level)
+
+    def levelLabel( self, level ):
+        return self.formatLevel(level)+self._labelUnits
+
+    def rangeLabel( self, min, max ):
+        op=' - '
+        lmin=''
+        lmax=''
+        if np.isfinite(min):
+            lmin=self.formatLevel(min)
+        else:
+            op='< '
+        if np.isfinite(max):
+            lmax=self.formatLevel(max)
+        else:
+            op='> '
+            lmax=lmin
+            lmin=''
+        return lmin+op+lmax+self._labelUnits
+
+    def fieldDefs( self, zFieldName='z' ):
+        '''
+        List of (name, type) of the attributes of each feature, including
+        lod if there is more than one level of detail
+        '''
+        lod=[('lod',int)] if self._lodCount > 1 else []
+        if self._ClassifyType == ClassifyType.filled:
+            return [('index',int),
+                    (zFieldName+"_min",float),
+                    (zFieldName+"_max",float),
+                    ('label',str)
+                    ]+lod
+        return [('index',int),
+                (zFieldName,float),
+                ('label',str)
+                ]+lod
+
+    def featureAttributes( self, feature ):
+        '''
+        Attribute values of a ClassifyFeature in the order of fieldDefs
+        '''
+        lod=[feature.lod] if self._lodCount > 1 else []
+        if self._ClassifyType == ClassifyType.filled:
+            return [feature.index,feature.level,feature.levelMax,feature.label]+lod
+        return [feature.index,feature.level,feature.label]+lod
+
+    def features( self ):
+        '''
+        Generator of ClassifyFeature for the current classify type
+        '''
+        if self._ClassifyType not in (ClassifyType.line,ClassifyType.filled,ClassifyType.layer):
+            return iter([])
+        return self._features()
+
+    def _features( self ):
+        self.levels()
+        lines,filled,gz=self._contourGenerator()
+        tolerances=self.lodTolerances()
+        for spec in self._featureSpecs(gz):
+            for feature in self._makeFeatures((lines,filled),spec,tolerances):
+                yield feature
+
+    # Number of results each pipeline worker may hold ahead of the consumer
+    PipelineQueueSize=4
+
+    def pipelinedFeatures( self, workers=2, queueSize=None, convert=None ):
+        '''
+        Generator of the same features as features(), but contoured by
+        worker threads while the caller consumes them.  Each worker
+        handles every nth feature and can hold at most queueSize results
+        ahead of the caller, which bounds the memory used.  The workers
+        share one contour generator, taking turns to contour while
+        building geometries, simplifying and converting in parallel.  If
+        convert is given it is applied to each feature in the worker (for
+        example to build the output geometry) and its result is returned
+        instead, or skipped if None.  Results are returned in the same
+        order as features().
+        '''
+        if self._ClassifyType not in (ClassifyType.line,ClassifyType.filled,ClassifyType.layer):
+            return iter([])
+        return self._pipelinedFeatures(workers,queueSize or self.PipelineQueueSize,convert)
+
+    def _pipelinedFeatures( self, workers, queueSize, convert ):
+        import queue
+        import threading
+        # The grid or triangulation and levels are built before starting
+        # the workers, which then only read them
+        self.levels()
+        lines,filled,gz=self._contourGenerator(threading.Lock())
+        tolerances=self.lodTolerances()
+        specs=self._featureSpecs(gz)
+        if not specs:
+            return
+        workers=max(1,min(int(workers),len(specs)))
+        queues=[queue.Queue(queueSize) for i in range(workers)]
+        stop=threading.Event()
+
+        def put( q, item ):
+            while not stop.is_set():
+                try:
+                    q.put(item,timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def work( worker ):
+            try:
+                for spec in specs[worker::workers]:
+                    results=self._makeFeatures((lines,filled),spec,tolerances)
+                    if convert is not None:
+                        results=[convert(r) for r in results]
+                    if not put(queues[worker],(True,results)):
+                        return
+            except BaseException as ex:
+                put(queues[worker],(False,ex))
+
+        threads=[threading.Thread(target=work,args=(i,),daemon=True) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            for i in range(len(specs)):
+                ok,results=queues[i % workers].get()
+                if not ok:
+                    raise results
+                for result in results:
+                    if result is not None:
+                        yield result
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _featureSpecs( self, gz ):
+        '''
+        List of (index, level, levelMax, label, args, keepEmpty) defining
+        each feature of the current classify type, where args are the
+        arguments of the contour function, which is the line function
+        for a single level and the filled function for two.
+        '''
+        if self._ClassifyType == ClassifyType.line:
+            levels=[float(level) for level in self.levels()]
+            return [(i,level,None,self.levelLabel(level),(level,),True)
+                    for i,level in enumerate(levels)]
+        if self._ClassifyType == ClassifyType.filled:
+            extend=self._extendFilled
+            levels=self._extendedLevels(extend)
+            # Contouring needs finite limits for extended ranges
+            finite=levels[np.isfinite(levels)]
+            zlow=min(float(np.nanmin(gz)),float(np.min(finite)))
+            zlow -= (1.0+abs(zlow))
+            zhigh=max(float(np.nanmax(gz)),float(np.max(finite)))
+            zhigh += (1.0+abs(zhigh))
+            specs=[]
+            for i in range(len(levels)-1):
+                level_min=levels[i]
+                level_max=levels[i+1]
+                lower=level_min if np.isfinite(level_min) else zlow
+                upper=level_max if np.isfinite(level_max) else zhigh
+                specs.append((i,float(level_min),float(level_max),
+                              self.rangeLabel(level_min,level_max),
+                              (float(lower),float(upper)),False))
+            return specs
+        if self._ClassifyType == ClassifyType.layer:
+            zmax=float(np.nanmax(gz))
+            zmax += (1.0+abs(zmax))
+            zmin=float(np.nanmin(gz))
+            return [(i,float(level),None,self.levelLabel(float(level)),(float(level),zmax),False)
+                    for i,level in enumerate(self.levels()) if level > zmin]
+        return []
+
+    def _makeFeatures( self, contour, spec, tolerances ):
+        '''
+        Contour one feature, returning it followed by its simplified
+        levels of detail (each simplified from the vertex buffer of the
+        one before), or an empty list if it has no geometry
+        '''
+        index,level,levelMax,label,args,keepEmpty=spec
+        func=contour[0] if len(args) == 1 else contour[1]
+        geom=self._contour(func,*args)
+        if geom.isEmpty() and not keepEmpty:
+            return []
+        self._stats.count('features')
+        feature=ClassifyFeature(index,level,levelMax,label,geom)
+        if len(tolerances) < 2:
+            return [feature]
+        dropMinor=self._lodDropMinor and self._ClassifyType != ClassifyType.filled
+        results=[feature]
+        for lod in range(1,len(tolerances)):
+            if dropMinor and index % (2**lod) != 0:
+                break
+            with self._stats.stage('simplify'):
+                geom=geom.simplified(tolerances[lod]-tolerances[lod-1])
+            if geom.isEmpty():
+                break
+            self._stats.count('lod features')
+            results.append(feature._replace(geometry=geom,lod=lod))
+        return results
+
+    def pointValues( self, qx, qy ):
+        '''
+        z interpolated at arbitrary query points (arrays of x and y), or
+        nan for points outside the data.  Gridded data are bilinearly
+        interpolated in the containing grid cell, otherwise z is linearly
+        interpolated in the containing triangle.  The locator used to
+        find the cell or triangle is built on first use.
+        '''
+        if self._locator is None:
+            x,y,z=self.data()
+            if z is None:
+                raise ClassifyError(tr("Classify data not defined"))
+            with self._stats.stage('locator'):
+                if self.usesGrid():
+                    self._locator=_GridLocator(*self._gridData())
+                else:
+                    trig=self.triangulation()
+                    triangles=trig.triangles
+                    if trig.mask is not None:
+                        triangles=triangles[~trig.mask]
+                    self._locator=_TriangleLocator(x,y,z,triangles)
+        x0,y0=self._origin
+        with self._stats.stage('query'):
+            values=self._locator.values(np.asarray(qx,dtype=np.float64)-x0,
+                                        np.asarray(qy,dtype=np.float64)-y0)
+        self._stats.count('query points',len(values))
+        return values
+
+    def classifyPoints( self, qx, qy, nodata=-1 ):
+        '''
+        Class index of arbitrary query points, which is the index of the
+        filled contour range (as in the filled feature index attribute)
+        containing the interpolated value, or nodata for points outside
+        the data or the levels.
+        '''
+        return self.classIndex(self.pointValues(qx,qy),nodata)
+
+    def rasterDefinition( self, resolution=None ):
+        '''
+        Definition of the raster of class indices, in absolute (not
+        origin relative) coordinates.  For gridded data this is the data
+        grid, with its rows and columns ordered to be as near north up as
+        the grid allows, otherwise a north up raster covering the data
+        extent with pixel size resolution (by default about the mean point
+        spacing).
+        '''
+        return self._offsetRaster(self._rasterDefinition(resolution),*self._origin)
+
+    def _offsetRaster( self, raster, dx, dy ):
+        if dx == 0.0 and dy == 0.0:
+            return raster
+        transform=list(raster.geotransform)
+        transform[0] += dx
+        transform[3] += dy
+        return raster._replace(geotransform=tuple(transform))
+
+    def _rasterDefinition( self, resolution ):
+        x,y,z=self.data()
+        if z is None:
+            raise ClassifyError(tr("Classify data not defined"))
+        if self.usesGrid():
+            gx,gy,gz=self._rasterGridData()
+            nrows,ncols=gz.shape
+            dxcol=(gx[0,-1]-gx[0,0])/(ncols-1)
+            dycol=(gy[0,-1]-gy[0,0])/(ncols-1)
+            dxrow=(gx[-1,0]-gx[0,0])/(nrows-1)
+            dyrow=(gy[-1,0]-gy[0,0])/(nrows-1)
+            x0=gx[0,0]-0.5*(dxcol+dxrow)
+            y0=gy[0,0]-0.5*(dycol+dyrow)
+            transform=tuple(float(v) for v in (x0,dxcol,dxrow,y0,dycol,dyrow))
+            return ClassifyRaster(transform,nrows,ncols)
+        xmin,xmax=float(np.min(x)),float(np.max(x))
+        ymin,ymax=float(np.min(y)),float(np.max(y))
+        if resolution is None or resolution <= 0:
+            resolution=np.sqrt((xmax-xmin)*(ymax-ymin)/len(x))
+        if not resolution > 0:
+            raise ClassifyError(tr("Cannot determine raster resolution"))
+        ncols=max(int(np.ceil((xmax-xmin)/resolution)),1)
+        nrows=max(int(np.ceil((ymax-ymin)/resolution)),1)
+        return ClassifyRaster((xmin,resolution,0.0,ymax,0.0,-resolution),nrows,ncols)
+
+    def _rasterGridData( self ):
+        '''
+        The grid x, y, z arrays oriented as a north up raster - rows
+        from north to south and columns from west to east, as near as a
+        rotated grid allows
+        '''
+        gx,gy,gz=self.gridClassifyData()
+        # Rows run along the grid axis closer to north-south
+        if abs(gy[-1,0]-gy[0,0]) < abs(gy[0,-1]-gy[0,0]):
+            gx,gy,gz=gx.T,gy.T,gz.T
+        if gy[-1,0] > gy[0,0]:
+            gx,gy,gz=gx[::-1],gy[::-1],gz[::-1]
+        if gx[0,-1] < gx[0,0]:
+            gx,gy,gz=gx[:,::-1],gy[:,::-1],gz[:,::-1]
+        return gx,gy,gz
+
+    def classLabels( self ):
+        '''
+        Labels of the classes, which are the filled contour ranges
+        '''
+        levels=self._extendedLevels(self._extendFilled)
+        return [self.rangeLabel(levels[i],levels[i+1]) for i in range(len(levels)-1)]
+
+    def classIndex( self, z, nodata=-1 ):
+        '''
+        Class index (the filled feature index) of each value in z, or
+        nodata if not in a class
+        '''
+        return ClassifyUtils.classIndex(self._extendedLevels(self._extendFilled),z,nodata)
+
+    def rasterBlocks( self, raster, blockRows=256, nodata=-1 ):
+        '''
+        Generator of (row, block) giving the class indices of blockRows
+        rows of the raster at a time, where raster is the ClassifyRaster
+        from rasterDefinition.  The class index is the index of the
+        filled contour range (from the extended levels) containing the
+        value, or nodata if none does.  Gridded data are classified
+        directly, otherwise the triangulation is linearly interpolated at
+        the pixel centres.
+        '''
+        levels=self._extendedLevels(self._extendFilled)
+        nrows,ncols=raster.nrows,raster.ncols
+        raster=self._offsetRaster(raster,-self._origin[0],-self._origin[1])
+        if self.usesGrid():
+            gx,gy,gz=self._rasterGridData()
+            for row in range(0,nrows,blockRows):
+                with self._stats.stage('raster'):
+                    block=ClassifyUtils.classIndex(levels,gz[row:row+blockRows],nodata)
+                yield row,block
+            return
+        trig,z=self.trigClassifyData()
+        triangles=trig.triangles
+        if trig.mask is not None:
+            triangles=triangles[~trig.mask]
+        rasterizer=_TriangleRasterizer(raster,trig.x,trig.y,z,triangles)
+        for row in range(0,nrows,blockRows):
+            if self._feedback.isCanceled():
+                raise ClassifyError(tr('Cancelled by user'))
+            self._feedback.setProgress(int(row*100.0/nrows))
+            with self._stats.stage('raster'):
+                pz=rasterizer.values(row,min(row+blockRows,nrows))
+                block=ClassifyUtils.classIndex(levels,pz,nodata)
+            yield row,block
+        self._feedback.setProgress(0)
+
+    def _extendedLevels( self, extend ):
+        levels = np.array([float(l) for l in self.levels()])
+        if ClassifyExtendOption.extendBelow(extend):
+            levels = np.append([-np.inf,], levels)
+        if ClassifyExtendOption.extendAbove(extend):
+            levels = np.append(levels, [np.inf,])
+        return levels
+
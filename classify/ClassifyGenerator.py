@@ -1,137 +1,81 @@
 
 import platform
 import re
+from array import array
 import sys
-import traceback
-from .DataGridder import DataGridder
 from . import ClassifyUtils
 from . import ClassifyMethod
+from . import ClassifyWriters
 from .ClassifyMethod import ClassifyMethodError
+from .ClassifyStats import ClassifyStats
+from . import ClassifyEngine as Engine
+from .ClassifyEngine import (
+    ClassifyEngine,
+    ClassifyError,
+    ClassifyGenerationError,
+    ClassifyExtendOption,
+    ClassifyInterpolation,
+    ClassifyPath,
+    ClassifyGeometry,
+    _DummyFeedback
+    )
 
 qgis_qhull_fails=platform.platform().startswith('Linux')
 
 from qgis.core import (
+    QgsCoordinateTransform,
     QgsExpression,
     QgsExpressionContext,
     QgsFeature,
     QgsFeatureRequest,
     QgsField,
     QgsGeometry,
-    QgsPointXY,
     QgsFields,
+    QgsGradientColorRamp,
+    QgsProject,
+    QgsRectangle,
+    QgsRuleBasedRenderer,
+    QgsUnitTypes,
+    QgsVectorDataProvider,
     QgsWkbTypes
     )
 from PyQt5.QtCore import (
-    QObject,
     QVariant,
     QCoreApplication
     )
+from PyQt5.QtGui import QColor
+import numpy as np
 
-_mplAvailable=False
-try:
-    import numpy as np
-    #from matplotlib.pyplot import Classify, Classifyf, triClassify, triClassifyf
-    from matplotlib.mlab import griddata
-    from matplotlib.tri import Triangulation, TriAnalyzer
-    _mplAvailable=True
-except ImportError:
-    _mplAvailable=False
-    pass
-
+# QCoreApplication.translate is static and reentrant, so messages can be
+# translated in processing worker threads
 def tr(string):
     return QCoreApplication.translate('Processing', string)
 
-class ClassifyError( RuntimeError ):
-
-    def message(self):
-        return self.args[0] if len(self.args) > 0 else "Exception"
-
-class ClassifyGenerationError( ClassifyError ):
-
-    @staticmethod
-    def fromException( excinfo ):
-        message=traceback.format_exception_only(excinfo[0],excinfo[1])
-        return ClassifyGenerationError(message)
-
-class ClassifyExtendOption:
-
-    both='both'
-    below='min'
-    above='max'
-    neither='neither'
-
-    _options=[both,below,above,neither]
-    _above=[both,above]
-    _below=[both,below]
-
-    _description={
-        both: tr('Fill below minimum and above maximum Classify'),
-        below: tr('Fill below minimum Classify'),
-        above: tr('Fill above maximum Classify'),
-        neither: tr('Don\'t fill below or above maximum Classify')
-        }
-
-    def options():
-        return ClassifyExtendOption._options
-
-    def valid( option ):
-        return option in ClassifyExtendOption._options
-
-    def description( option ):
-        return ClassifyExtendOption._description.get(option,tr('Invalid Classify option {0}').format(option))
-
-    def extendBelow( option ):
-        return option in ClassifyExtendOption._below
-
-    def extendAbove( option ):
-        return option in ClassifyExtendOption._above
-
-class ClassifyType:
-    line='line'
-    filled='filled'
-    layer='layer'
-
-    _types=[line, filled, layer]
-
-    _description={
-        line: tr('Classify lines'),
-        filled: tr('Filled Classify polygons'),
-        layer: tr('Layer Classify polygons')
-        }
+class ClassifyType( Engine.ClassifyType ):
 
     _wkbtype={
-        line: QgsWkbTypes.MultiLineString,
-        filled: QgsWkbTypes.MultiPolygon,
-        layer: QgsWkbTypes.MultiPolygon,
+        Engine.ClassifyType.line: QgsWkbTypes.MultiLineString,
+        Engine.ClassifyType.filled: QgsWkbTypes.MultiPolygon,
+        Engine.ClassifyType.layer: QgsWkbTypes.MultiPolygon,
+        Engine.ClassifyType.raster: QgsWkbTypes.NoGeometry,
         }
 
-    def types():
-        return ClassifyType._types
-
-    def valid( type ):
-        return type in ClassifyType._types
-
     def description( type ):
-        return ClassifyType._description.get(type,tr('Invalid Classify type {0}').format(type))
+        return tr(Engine.ClassifyType.description(type))
 
     def wkbtype( type ):
         return ClassifyType._wkbtype.get(type)
 
-class _DummyFeedback:
-
-    def isCanceled( self ):
-        return False
-
-    def setProgress( self, percent ):
-        pass
-
-    def pushInfo( self, info ):
-        pass
+class ClassifyGenerator:
+    '''
+    QGIS adapter for the ClassifyEngine.  Loads the point data from a
+    QGIS feature source and returns the classification as QgsFeatures.
 
-    def reportError( self, message, fatal=False ):
-        raise ClassifyError( message )
-
-class ClassifyGenerator( QObject ):
+    The generator is a plain python object with no thread affinity, so
+    it can be created and used in a processing worker thread.  Each
+    generator holds its own state - separate generators can run in
+    parallel threads.
+    '''
 
     MaxClassifys=100
     translateExtend=lambda self, x: {'none':'neither','below':'min','above':'max'}.get(x.lower(),x.lower())
@@ -147,46 +91,48 @@ class ClassifyGenerator( QObject ):
             fieldback.setProgress(percent_progress)
             ...
         '''
-        QObject.__init__(self)
-        if not _mplAvailable:
-            raise ClassifyError(tr("python matplotlib not available"))
         self._x = None
         self._y = None
         self._z = None
-        self._origin = [0,0] # NOTE: calculate in data()
+        self._pointFids = None
+        self._pointZ = None
+        self._float32 = False
+        self._coordinateTolerance = None
+        self._memoryBudget = None
+        self._area = None
         self._source=None
         self._sourceFids=None
         self._zField = None
         self._zFieldName = None
         self._discardTolerance=0
         self._dataLoaded = False
-        self._gridTested = False
-        self._gridShape = None
-        self._gridOrder = None
-        self._useGrid = True
-        self._ClassifyMethod = None
-        self._ClassifyMethodParams = None
-        self._levels = None
-        self._ClassifyType = ClassifyType.line
-        self._extendFilled = ClassifyExtendOption.both
-        self._labelNdp = -1
-        self._defaultLabelNdp = None
-        self._labelTrimZeros = False
-        self._labelUnits = ''
         self._feedback = feedback or _DummyFeedback()
+        self._stats = ClassifyStats()
+        self._engine = ClassifyEngine(feedback=self._feedback,stats=self._stats)
+        self._engine.setQhullWorkaround(qgis_qhull_fails)
         self.setDataSource( source, zField )
 
     def _dataDef( self ):
         return (
             None if self._source is None else 'source', # self._source.id(),
             self._zField,
-            self._discardTolerance
-            )   
+            self._discardTolerance,
+            self._float32,
+            self._coordinateTolerance,
+            self._memoryBudget
+            )
 
     # Functions to support null feedback
     def isCanceled( self ):
         return None
 
+    def engine( self ):
+        '''
+        The QGIS independent ClassifyEngine doing the classification
+        '''
+        self.data()
+        return self._engine
+
     def setDataSource( self, source, zField=None, sourceFids=None, zFieldName=None ):
         if self._source != source or self._sourceFids != sourceFids:
             self.setReloadData()
@@ -200,6 +146,103 @@ class ClassifyGenerator( QObject ):
             self._discardTolerance=discardTolerance
             self.setReloadData()
 
+    def setFloat32Coordinates( self, float32, tolerance=None ):
+        '''
+        Store the x, y coordinates relative to the origin as float32 to
+        halve their memory.  Loading fails if the rounding error would
+        exceed tolerance (by default the duplicate point tolerance, or a
+        thousandth of the mean point spacing).
+        '''
+        if self._float32 != float32 or self._coordinateTolerance != tolerance:
+            self._float32=float32
+            self._coordinateTolerance=tolerance
+            self.setReloadData()
+
+    # Approximate bytes per point used while loading the data with
+    # float64 and float32 coordinates
+    LoadMemoryPerPoint=48
+    LoadMemoryPerPointFloat32=40
+
+    def setMemoryBudget( self, budget ):
+        '''
+        Limit the memory used to about budget bytes, or None for no
+        limit.  Coordinates are stored as float32 if loading them as
+        float64 would exceed the budget, and the engine falls back to
+        cheaper strategies for each stage (see
+        ClassifyEngine.setMemoryBudget).  Loading fails if the points
+        cannot be held within the budget.
+        '''
+        budget=int(budget) if budget is not None and budget > 0 else None
+        if self._memoryBudget != budget:
+            self._memoryBudget=budget
+            self.setReloadData()
+
+    def memoryBudget( self ):
+        return self._memoryBudget
+
+    def _loadFloat32( self, count ):
+        '''
+        Whether to load count points with float32 coordinates, either
+        because it is set or to fit the memory budget
+        '''
+        budget=self._memoryBudget
+        if self._float32 or budget is None or count < 0:
+            return self._float32
+        if count*self.LoadMemoryPerPoint <= budget:
+            return False
+        memory=count*self.LoadMemoryPerPointFloat32
+        if memory > budget:
+            raise ClassifyError(tr("Loading {0} points needs about {1:.0f}MB, more than the memory budget of {2:.0f}MB")
+                .format(count,memory/1048576.0,budget/1048576.0))
+        self._feedback.pushInfo(tr("Using single precision coordinates to fit the memory budget"))
+        return True
+
+    def setAreaOfInterest( self, area, buffer=None, crs=None, transformContext=None ):
+        '''
+        Only load the points in area, a QgsRectangle or polygon
+        QgsGeometry (in crs, by default the source coordinate system), or
+        None to load all points.  The area is expanded by buffer (by
+        default 5% of its larger dimension) so that contours near its
+        edge are calculated from the points beyond it.  The area is
+        transformed with transformContext, by default that of the current
+        project (which should only be used from the main thread).
+        '''
+        if area is not None:
+            isRect=isinstance(area,QgsRectangle)
+            geom=QgsGeometry.fromRect(area) if isRect else QgsGeometry(area)
+            if crs is not None and self._source is not None and crs != self.crs():
+                if transformContext is None:
+                    transformContext=QgsProject.instance().transformContext()
+                geom.transform(QgsCoordinateTransform(crs,self.crs(),transformContext))
+            extent=geom.boundingBox()
+            if buffer is None:
+                buffer=0.05*max(extent.width(),extent.height())
+            if isRect:
+                area=extent.buffered(buffer)
+            else:
+                area=geom.buffer(buffer,8) if buffer > 0 else geom
+        self._area=area
+        self.setReloadData()
+
+    def areaOfInterest( self ):
+        return self._area
+
+    def _areaRings( self ):
+        '''
+        Vertices of the rings of a polygon area of interest
+        '''
+        geom=self._area
+        polygons=geom.asMultiPolygon() if geom.isMultipart() else [geom.asPolygon()]
+        return [np.array([(p.x(),p.y()) for p in ring])
+                for polygon in polygons for ring in polygon]
+
+    def origin( self ):
+        '''
+        Origin of the x, y data, which is the centre of the data extent
+        '''
+        self.data()
+        return self._engine.origin()
+
     def setZField( self, zField, zFieldName=None ):
         if self._zField != zField:
             self._zField=zField
@@ -207,64 +250,137 @@ class ClassifyGenerator( QObject ):
             self.setReloadData()
 
     def setUseGrid( self, usegrid ):
-        self._useGrid=usegrid
+        self._engine.setUseGrid(usegrid)
+
+    def setInterpolation( self, method, cellSize=None, power=2.0, neighbours=8 ):
+        self._engine.setInterpolation(method,cellSize,power,neighbours)
+
+    def setCalculationPath( self, path, tolerance=None ):
+        self._engine.setCalculationPath(path,tolerance)
+
+    def plan( self ):
+        '''
+        The ClassifyPlan giving the calculation path chosen for the data
+        '''
+        self.data()
+        return self._engine.plan()
 
     def setClassifyLevels( self, levels ):
-        self.setClassifyMethod('manual',{'levels':levels})
+        self._engine.setClassifyLevels(levels)
 
     def setClassifyMethod( self, method, params ):
-        self._ClassifyMethod=method
-        self._ClassifyMethodParams=params
-        self._levels=None
+        self._engine.setClassifyMethod(method,params)
 
     def setClassifyType( self, ClassifyType ):
-        ClassifyType=ClassifyType.lower()
-        if not ClassifyType.valid(ClassifyType):
-            raise ClassifyError(tr("Invalid Classify type {0}").format(ClassifyType))
-        self._ClassifyType=ClassifyType
+        self._engine.setClassifyType(ClassifyType)
 
     def setClassifyExtendOption( self, extend ):
-        extend=extend.lower()
-        if not ClassifyExtendOption.valid(extend):
-            raise ClassifyError(tr("Invalid filled Classify extend option {0}").format(extend))
-        self._extendFilled=extend
+        self._engine.setClassifyExtendOption(extend)
 
     def setLabelFormat( self, ndp, trim=False, units='' ):
-        self._labelNdp = ndp
-        self._labelTrimZeros = trim
-        self._labelUnits = units
+        self._engine.setLabelFormat(ndp,trim,units)
+
+    def setLevelsOfDetail( self, count, tolerance=None, factor=4.0, dropMinor=False ):
+        self._engine.setLevelsOfDetail(count,tolerance,factor,dropMinor)
+
+    def lodScales( self, pixelSize=0.00028 ):
+        '''
+        Scale ranges (maximum scale, minimum scale) in which to display
+        each level of detail, which start at the scale at which its
+        simplification tolerance is a pixel of pixelSize metres.  0 means
+        no limit.
+        '''
+        self.data()
+        tolerances=self._engine.lodTolerances()
+        factor=QgsUnitTypes.fromUnitToUnitFactor(self.crs().mapUnits(),QgsUnitTypes.DistanceMeters)
+        scales=[t*factor/pixelSize for t in tolerances]+[0.0]
+        return [(scales[i],scales[i+1]) for i in range(len(tolerances))]
+
+    @staticmethod
+    def lodRenderer( renderer, scales ):
+        '''
+        Rule based renderer applying the symbology of renderer to each
+        level of detail in its scale range from lodScales
+        '''
+        base=QgsRuleBasedRenderer.convertFromRenderer(renderer)
+        root=QgsRuleBasedRenderer.Rule(None)
+        for lod,(maxScale,minScale) in enumerate(scales):
+            rule=QgsRuleBasedRenderer.Rule(None,maxScale,minScale,
+                                           '"lod" = {0}'.format(lod),
+                                           tr("Level of detail {0}").format(lod))
+            for child in base.rootRule().children():
+                rule.appendChild(child.clone())
+            root.appendChild(rule)
+        return QgsRuleBasedRenderer(root)
+
+    @staticmethod
+    def rampColors( ramp, n, reverse=False ):
+        '''
+        n colours evenly spaced along the QgsColorRamp ramp (reversed if
+        reverse is True).  Continuous RGB gradient ramps are interpolated
+        between their stops for all the colours at once rather than
+        calling ramp.color for each.
+        '''
+        values=np.linspace(0.0,1.0,n) if n > 1 else np.zeros(n)
+        if reverse:
+            values=1.0-values
+        if (not isinstance(ramp,QgsGradientColorRamp) or ramp.isDiscrete()
+                or (hasattr(ramp,'colorSpec') and ramp.colorSpec() != QColor.Rgb)):
+            return [ramp.color(float(v)) for v in values]
+        stops=([(0.0,ramp.color1())]
+               +[(s.offset,s.color) for s in ramp.stops()]
+               +[(1.0,ramp.color2())])
+        offsets=np.array([s[0] for s in stops])
+        channels=np.array([s[1].getRgb() for s in stops],dtype=np.float64)
+        rgba=np.column_stack([np.interp(values,offsets,channels[:,i]) for i in range(4)])
+        rgba=np.rint(rgba).astype(int).tolist()
+        return [QColor(r,g,b,a) for r,g,b,a in rgba]
+
+    def statistics( self ):
+        '''
+        The ClassifyStats object recording the time and memory used by
+        each stage of the classification
+        '''
+        return self._stats
+
+    def reportStatistics( self ):
+        self._feedback.pushInfo(tr("Classification statistics:")+"\n"+self._stats.summary())
 
     def setReloadData( self ):
         self._dataLoaded=False
-        self._gridTested=False
-        self._levels=None
 
     def data( self ):
+        '''
+        The x, y, z arrays of the loaded points, with x and y relative to
+        the origin
+        '''
         if self._dataLoaded:
-            return self._x, self._y, self._z
+            return self._engine.data()
         self._dataLoaded=True
         self._x = None
         self._y = None
         self._z = None
-        self._gridShape=None
-        self._gridTested=False
-        self._dataLoaded=True
+        self._pointFids = None
+        self._pointZ = None
+        self._engine.setData(None,None,None)
 
         source=self._source
         zField=self._zField
         if source is None or zField is None or zField == '':
-            return self._x, self._y, self._z
+            return self._engine.data()
 
-        discardTolerance=self._discardTolerance
         feedback=self._feedback
 
         total = source.featureCount()
         percent = 100.0 / total if total > 0 else 0
 
+        # Compact typed arrays rather than lists of python floats
         count = 0
-        x = list()
-        y = list()
-        z = list()
+        float32 = self._float32
+        x = array('d')
+        y = array('d')
+        z = array('d')
+        fids = array('q')
         try:
             if source.fields().lookupField(zField) >= 0:
                 zField='"'+zField.replace('"','""')+'"'
@@ -276,95 +392,111 @@ class ClassifyGenerator( QObject ):
             context.setFields(fields)
             if not expression.prepare(context):
                 raise ClassifyError(tr("Cannot evaluate value")+ " "+zField)
+            float32=self._loadFloat32(total)
             request = QgsFeatureRequest()
             request.setSubsetOfAttributes( expression.referencedColumns(),fields)
             if self._sourceFids is not None:
                 request.setFilterFids(self._sourceFids)
-            for current,feat in enumerate(source.getFeatures( request )):
-                try:
-                    if feedback.isCanceled():
-                        raise ClassifyError('Cancelled by user')
-                    feedback.setProgress(int(current * percent))
-                    context.setFeature(feat)
-                    zval=expression.evaluate(context)
+            area=self._area
+            if area is not None:
+                request.setFilterRect(area if isinstance(area,QgsRectangle) else area.boundingBox())
+            with self._stats.stage('load'):
+                for current,feat in enumerate(source.getFeatures( request )):
                     try:
-                        zval=float(zval)
-                    except ValueError:
-                        raise ClassifyError(tr("Z value {0} is not number")
-                                                   .format(zval))
-                    if zval is not None:
-                        fgeom = feat.geometry()
-                        if QgsWkbTypes.flatType(fgeom.wkbType()) != QgsWkbTypes.Point:
-                            raise ClassifyError(tr("Invalid geometry type for Classifying - must be point geometry"))
-                        geom=fgeom.asPoint()
-                        x.append(geom.x())
-                        y.append(geom.y())
-                        z.append(zval)
-                except Exception as ex:
-                    raise
-                count = count + 1
-
+                        if feedback.isCanceled():
+                            raise ClassifyError('Cancelled by user')
+                        feedback.setProgress(int(current * percent))
+                        context.setFeature(feat)
+                        zval=expression.evaluate(context)
+                        try:
+                            zval=float(zval)
+                        except ValueError:
+                            raise ClassifyError(tr("Z value {0} is not number")
+                                                       .format(zval))
+                        if zval is not None:
+                            fgeom = feat.geometry()
+                            if QgsWkbTypes.flatType(fgeom.wkbType()) != QgsWkbTypes.Point:
+                                raise ClassifyError(tr("Invalid geometry type for Classifying - must be point geometry"))
+                            geom=fgeom.asPoint()
+                            x.append(geom.x())
+                            y.append(geom.y())
+                            z.append(zval)
+                            fids.append(feat.id())
+                    except Exception as ex:
+                        raise
+                    count = count + 1
+                x=np.frombuffer(x)
+                y=np.frombuffer(y)
+                z=np.frombuffer(z)
+                fids=np.frombuffer(fids,dtype=np.int64)
+            if area is not None and not isinstance(area,QgsRectangle):
+                with self._stats.stage('area filter'):
+                    inside=ClassifyUtils.pointsInPolygon(x,y,self._areaRings())
+                    x,y,z,fids=x[inside],y[inside],z[inside],fids[inside]
             npt=len(x)
-            if npt > 0:
-                x=np.array(x)
-                y=np.array(y)
-                z=np.array(z)
-                if discardTolerance > 0:
-                    index=ClassifyUtils.discardDuplicatePoints(
-                        x,y,discardTolerance,self.crs().isGeographic())
-                    npt1=len(index)
-                    if npt1 < npt:
-                        x=x[index]
-                        y=y[index]
-                        z=z[index]
-                        feedback.pushInfo(tr("{0} near duplicate points discarded - tolerance {1}")
-                                          .format(npt-npt1,discardTolerance))
+            discardTolerance=self._discardTolerance
+            tolerance=self._coordinateTolerance or discardTolerance or None
+            x,y,origin=Engine.relativeCoordinates(x,y,float32,tolerance)
+            self._stats.setCount('features read',count)
+            self._stats.setCount('points',npt)
         except ClassifyError as ce:
             feedback.reportError(ce.message())
             feedback.setProgress(0)
-            return self._x,self._y,self._z
+            return self._engine.data()
         finally:
             feedback.setProgress(0)
 
         if len(x) < 3:
             feedback.reportError(tr("Too few points to Classify"))
-            return self._x, self._y, self._z
-        self._x=x
-        self._y=y
-        self._z=z
+            return self._engine.data()
+
+        # Keep the value of every loaded point, including those discarded
+        # as duplicates, so that the points can be tagged with their class
+        self._pointFids=fids
+        self._pointZ=z
+        engine=self._engine
+        engine.setData(x,y,z,origin)
+        # The engine budget excludes the point ids kept here
+        budget=self._memoryBudget
+        if budget is not None:
+            budget=max(budget-fids.nbytes,1)
+        engine.setMemoryBudget(budget)
+        if discardTolerance > 0:
+            ndiscarded=engine.discardDuplicatePoints(
+                discardTolerance,self.crs().isGeographic())
+            if ndiscarded > 0:
+                feedback.pushInfo(tr("{0} near duplicate points discarded - tolerance {1}")
+                                  .format(ndiscarded,discardTolerance))
+        self._x,self._y,self._z=engine.data()
         return self._x, self._y, self._z
 
     def isGridded(self):
         """
         Check if points data are on a regular grid
         """
-        if not self._gridTested:
-            x,y,z=self.data()
-            self._gridShape,self._gridOrder=DataGridder(x,y).calcGrid()
-            self._gridTested=True
-        return self._gridShape is not None
+        self.data()
+        return self._engine.isGridded()
 
     def gridShape(self):
-        return self._gridShape if self.isGridded() else None
+        return self._engine.gridShape() if self.isGridded() else None
 
     def levels( self ):
-        if self._levels is None:
-            x,y,z = self.data()
-            if z is None:
-                raise ClassifyError(tr("Classify data not defined"))
-            method=self._ClassifyMethod
-            params=self._ClassifyMethodParams
-            if method is None:
-                raise ClassifyError(tr("Classifying method not defined"))
-            self._levels=ClassifyMethod.calculateLevels(z,method,**params)
-            self._defaultLabelNdp = None
-        return self._levels
+        self.data()
+        return self._engine.levels()
+
+    def calculateLevels( self, method, params ):
+        '''
+        Levels for the data with a method other than the current one,
+        using the engine level cache
+        '''
+        self.data()
+        return self._engine.calculateLevels(method,params)
 
     def crs( self ):
         return self._source.sourceCrs()
 
     def wkbtype( self ):
-        return ClassifyType.wkbtype(self._ClassifyType)
+        return ClassifyType.wkbtype(self._engine.classifyType())
 
     def zFieldName( self ):
         zfield=self._zFieldName or self._zField
@@ -379,21 +511,12 @@ class ClassifyGenerator( QObject ):
             zfield='_'+zfield
         return zfield
 
+    def fieldDefs( self ):
+        return self._engine.fieldDefs(self.zFieldName())
+
     def fields( self ):
-        zFieldName=self.zFieldName()
-        if self._ClassifyType == ClassifyType.filled:
-            fielddef= [('index',int),
-                       (zFieldName+"_min",float),
-                       (zFieldName+"_max",float),
-                       ('label',str)
-                      ]
-        else:
-            fielddef= [('index',int),
-                      (zFieldName,float),
-                      ('label',str)
-                      ]
         fields = QgsFields()
-        for name, ftype in fielddef:
+        for name, ftype in self.fieldDefs():
             fields.append(
                 QgsField(name,QVariant.Int,'Int') if ftype == int else
                 QgsField(name,QVariant.Double,'Double') if ftype == float else
@@ -401,281 +524,234 @@ class ClassifyGenerator( QObject ):
                 )
         return fields
 
-    def ClassifyFeatures(self):
-        if self._ClassifyType == ClassifyType.line:
-            return self.lineClassifyFeatures()
-        elif self._ClassifyType == ClassifyType.filled:
-            return self.filledClassifyFeatures()
-        elif self._ClassifyType == ClassifyType.layer:
-            return self.layerClassifyFeatures()
-        else:
-            return []
-
-    def gridClassifyData(self):
-        gx,gy,gz=self.data()
-        order=self._gridOrder
-        shape=self._gridShape
-        if order is not None:
-            gx=gx[order]
-            gy=gy[order]
-            gz=gz[order]
-        gx=gx.reshape(shape)
-        gy=gy.reshape(shape)
-        gz=gz.reshape(shape)
-        self._feedback.pushInfo("Classifying {0} by {1} grid"
-            .format(shape[0],shape[1]))
-        return gx, gy, gz
-
-    def _buildtrig_workaround( self, x, y ):
-        '''
-        Workaround implemented as qhull fails when called from
-        within QGIS python in ubuntu 17.10, QGIS 3.1 :-( 
-        ''' 
-        import os
-        import sys
-        import subprocess
-        import tempfile
-        tfh,tfname=tempfile.mkstemp('.npy','tmp_Classify_generator')
-        tfh2,tfname2=tempfile.mkstemp('.npy','tmp_Classify_generator')
-        os.close(tfh)
-        os.close(tfh2)
-        trig=None
-        try:
-            np.save(tfname,np.vstack((x,y)))
-            pydir=os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
-            pyscript=os.path.join(pydir,'buildtrig_qhull_workaround.py')
-            python=sys.executable
-            result=subprocess.call([python,pyscript,tfname,tfname2])
-            triangles=np.load(tfname2)
-            trig=Triangulation(x,y,triangles)
-        finally:
-            os.remove(tfname)
-            os.remove(tfname2)
-        return trig
-
-    def buildTriangulation( self, x, y ):
-        trig=None
-        if qgis_qhull_fails:
-            trig=self._buildtrig_workaround(x,y)
-        else:
-            trig=Triangulation(x,y)
-        analyzer=TriAnalyzer(trig)
-        mask=analyzer.get_flat_tri_mask()
-        trig.set_mask(mask)
-        return trig
-
-    def trigClassifyData(self):
-        x,y,z=self.data()
-        self._feedback.pushInfo("Triangulating {0} points"
-            .format(len(x)))
-        trig=self.buildTriangulation(x,y)
-        self._feedback.pushInfo("Classifying {0} triangles"
-            .format(trig.triangles.shape[0]))
-        return trig,z
-        return polygons
-
-    def calcLabelNdp( self ):
-        if self._labelNdp is not None and self._labelNdp > 0:
-            return self._labelNdp
-        if self._defaultLabelNdp is None:
-            levels=self.levels()
-            ndp=ClassifyUtils.calcDefaultNdp(levels)
-            self._defaultLabelNdp = ndp
-        return self._defaultLabelNdp
-
-    def formatLevel( self, level ):
-        ndp=self.calcLabelNdp()
-        if ndp < 0:
-            return str(level)
-        elif self._labelTrimZeros:
-            level=np.round(level,ndp)
-            return str(level)
-        else:
-            return "{1:.{0}f}".format(ndp,level)
-
-    def _levelLabel(self,level):
-        return self.formatLevel(level)+self._labelUnits
-
-    def lineClassifyFeatures(self):
-        x,y,z=self.data()
-        levels = self.levels()
-        usegrid=self.isGridded() and self._useGrid
-        try:
-            if usegrid:
-                gx,gy,gz=self.gridClassifyData()
-                cs = Classify(gx, gy, gz, levels )
-            else:
-                trig,z=self.trigClassifyData()
-                cs = triClassify(trig, z, levels )
-        except:
-            raise ClassifyGenerationError.fromException(sys.exc_info())
-
-        fields = self.fields()
-        zfield=self.zFieldName()
-        dx,dy=self._origin
-        for i, line in enumerate(cs.collections):
-            level=float(cs.levels[i])
-            glines = []
-            try:
-                for path in line.get_paths():
-                    if len(path.vertices) > 1:
-                        points=[QgsPointXY(x,y) for x,y in path.vertices]
-                        glines.append(points)
-                geom=QgsGeometry.fromMultiPolylineXY(glines)
-                geom.translate(dx,dy)
-                feat = QgsFeature(fields)
-                feat.setGeometry(geom)
-                feat['index']=i
-                feat[zfield]=level
-                feat['label']=self._levelLabel(level)
-                yield feat
-            except:
-                message=sys.exc_info()[1]
-                self._feedback.reportError(message)
-
-    def _rangeLabel(self,min,max):
-        op=' - '
-        lmin=''
-        lmax=''
-        if np.isfinite(min):
-            lmin=self.formatLevel(min)
-        else:
-            op='< '
-        if np.isfinite(max):
-            lmax=self.formatLevel(max)
-        else:
-            op='> '
-            lmax=lmin
-            lmin=''
-        return lmin+op+lmax+self._labelUnits
-
-    def buildQgsMultipolygon(self,polygon):
-        '''
-        Construct QgsMultiPolygon from matplotlib version
-        '''
-        mpoly=[]
-        invalid=0
-        for path in polygon.get_paths():
-            path.should_simplify = False
-            poly = path.to_polygons()
-            if len(poly) < 1:
-                continue
-            if len(poly[0]) < 3:
-                # Have had one vertix polygon from matplotlib!
-                continue
-            polypts=[[QgsPointXY(x,y) for x,y in p]
-                 for p in poly if len(p) > 3 ]
-            mpoly.append(polypts)
-        geom = None
-        if len(mpoly) > 0:
-            geom=QgsGeometry.fromMultiPolygonXY(mpoly)
-            geom=geom.makeValid()
-        return geom
-
-    def filledClassifyFeatures(self ):
-        levels = self.levels()
-        extend=self._extendFilled
-        usegrid=self.isGridded() and self._useGrid
-        try:
-            if usegrid:
-                gx,gy,gz=self.gridClassifyData()
-                cs = Classifyf(gx, gy, gz, levels, extend=extend)
-            else:
-                trig,z=self.trigClassifyData()
-                cs = triClassifyf(trig, z, levels, extend=extend)
-        except:
-            raise ClassifyGenerationError.fromException(sys.exc_info())
-
-        levels = [float(l) for l in cs.levels]
-        if ClassifyExtendOption.extendBelow(extend):
-            levels = np.append([-np.inf,], levels)
-        if ClassifyExtendOption.extendAbove(extend):
-            levels = np.append(levels, [np.inf,])
-
-        fields = self.fields()
-        ninvalid=0
-        dx,dy=self._origin
-        zfieldname=self.zFieldName()
-        zminfield=zfieldname+'_min'
-        zmaxfield=zfieldname+'_max'
-
-        for i, polygon in enumerate(cs.collections):
-            level_min=levels[i]
-            level_max=levels[i+1]
-            label = self._rangeLabel(level_min,level_max)
-            try:
+    def classifyResults( self, workers=0, convert=None ):
+        '''
+        Generator of ClassifyEngine.ClassifyFeature results, in which the
+        geometry is a vertex buffer in source coordinates rather than a
+        QgsGeometry.  If workers is more than 0 the results are contoured
+        by that many threads while they are consumed (see
+        ClassifyEngine.pipelinedFeatures), and convert, if given, is
+        applied to each result in the worker threads.
+        '''
+        self.data()
+        if workers > 0:
+            return self._engine.pipelinedFeatures(workers,convert=convert)
+        results=self._engine.features()
+        if convert is not None:
+            results=(r for r in map(convert,results) if r is not None)
+        return results
+
+    def _qgsFeature( self, result, fields ):
+        # Converts a ClassifyFeature to a QgsFeature, or None if its
+        # polygon geometry is invalid and cannot be repaired
+        with self._stats.stage('geometry'):
+            geom=QgsGeometry()
+            geom.fromWkb(result.geometry.wkb())
+            if result.geometry.type == ClassifyGeometry.polygon:
                 try:
-                    geom=self.buildQgsMultipolygon(polygon)
-                    if geom is None:
-                        continue
-                    geom.translate(dx,dy)
+                    geom=geom.makeValid()
                 except Exception as ex:
-                    ninvalid += 1
-                    continue
-                feat = QgsFeature(fields)
-                feat.setGeometry(geom)
-                feat['index']=i
-                feat[zminfield]=float(level_min)
-                feat[zmaxfield]=float(level_max)
-                feat['label']=label
-                yield feat
-            except Exception as ex:
-                raise
-                self._feedback.reportError(sys.exc_info()[1])
-
+                    geom=None
+                if geom is None or geom.isEmpty():
+                    self._stats.count('invalid geometries')
+                    return None
+            feat = QgsFeature(fields)
+            feat.setGeometry(geom)
+            feat.setAttributes(self._engine.featureAttributes(result))
+        return feat
+
+    def ClassifyFeatures( self, workers=0 ):
+        '''
+        Generator of the classification as QgsFeatures.  If workers is
+        more than 0 the features are contoured and built by that many
+        threads, holding a bounded number of features ahead of the caller.
+        '''
+        fields = self.fields()
+        self._stats.setCount('invalid geometries',0)
+        convert=lambda result: self._qgsFeature(result,fields)
+        for feat in self.classifyResults(workers,convert):
+            yield feat
+        ninvalid=self._stats.counter('invalid geometries')
         if ninvalid > 0:
             self._feedback.pushInfo(tr('{0} invalid Classify geometries discarded').format(ninvalid))
 
-    def layerClassifyFeatures(self):
-        levels = self.levels()
-        usegrid=self.isGridded() and self._useGrid
-        try:
-            if usegrid:
-                gx,gy,gz=self.gridClassifyData()
-            else:
-                trig,gz=self.trigClassifyData()
-        except:
-            raise ClassifyGenerationError.fromException(sys.exc_info())
+    def pointValues( self, x, y ):
+        '''
+        Value interpolated at arrays of query x, y in the source crs
+        '''
+        self.data()
+        return self._engine.pointValues(x,y)
 
-        fields = self.fields()
-        ninvalid=0
-        dx,dy=self._origin
-        zfield=self.zFieldName()
-        zmax=np.max(gz)
-        zmax += (1.0+abs(zmax))
-        zmin = np.min(gz)
-
-        for i,level in enumerate(levels):
-            if level <= zmin:
-                continue
-            try:
-                if usegrid:
-                    cs = Classifyf(gx, gy, gz, [level,zmax], extend=ClassifyExtendOption.neither)
-                else:
-                    cs = triClassifyf(trig, gz, [level,zmax], extend=ClassifyExtendOption.neither)
-            except:
-                raise ClassifyGenerationError.fromException(sys.exc_info())
-            if len(cs.collections) < 1:
-                continue
-            polygon=cs.collections[0]
-            try:
-                try:
-                    geom=self.buildQgsMultipolygon(polygon)
-                    if geom is None:
-                        continue
-                    geom.translate(dx,dy)
-                except Exception as ex:
-                    ninvalid += 1
-                    continue
-                feat = QgsFeature(fields)
-                feat.setGeometry(geom)
-                feat['index']=i
-                feat[zfield]=float(level)
-                feat['label']=self._levelLabel(level)
-                yield feat
-            except Exception as ex:
-                self._feedback.reportError(ex.message)
+    def classifyPoints( self, x, y, nodata=-1 ):
+        '''
+        Class index (the filled feature index) of arrays of query x, y in
+        the source crs, or nodata if not in a class
+        '''
+        self.data()
+        return self._engine.classifyPoints(x,y,nodata)
 
-        if ninvalid > 0:
-            self._feedback.pushInfo(tr('{0} invalid Classify geometries discarded').format(ninvalid))
+    def pointClasses( self ):
+        '''
+        Feature ids and class index (the filled feature index, or -1 if
+        not in a class) of every loaded point, calculated directly from
+        the point values
+        '''
+        self.data()
+        if self._pointFids is None:
+            raise ClassifyError(tr("Classify data not defined"))
+        with self._stats.stage('point classes'):
+            classes=self._engine.classIndex(self._pointZ)
+        return self._pointFids,classes
+
+    def pointClassFields( self, fieldName='class', labelFieldName='class_label' ):
+        return [
+            QgsField(fieldName,QVariant.Int,'Int'),
+            QgsField(labelFieldName,QVariant.String,'String'),
+            ]
+
+    def tagSourcePoints( self, layer, fieldName='class', labelFieldName='class_label',
+                         batchSize=50000, feedback=None ):
+        '''
+        Write the class index and label of each loaded point to fields of
+        the source layer, adding the fields if necessary.  Values are
+        written through the data provider with one changeAttributeValues
+        call for each batch of batchSize features.  Progress is reported
+        to feedback, by default the generator feedback.  Returns the
+        number of features updated.
+
+        This edits the layer, so must be called from the thread the layer
+        belongs to (the main thread for project layers).  The processing
+        algorithm tags the source in postProcessAlgorithm.
+        '''
+        provider=layer.dataProvider()
+        capabilities=provider.capabilities()
+        if not capabilities & QgsVectorDataProvider.ChangeAttributeValues:
+            raise ClassifyError(tr("Cannot update attributes of layer {0}").format(layer.name()))
+        newFields=[f for f in self.pointClassFields(fieldName,labelFieldName)
+                   if provider.fields().lookupField(f.name()) < 0]
+        if newFields:
+            if not capabilities & QgsVectorDataProvider.AddAttributes:
+                raise ClassifyError(tr("Cannot add fields to layer {0}").format(layer.name()))
+            provider.addAttributes(newFields)
+            layer.updateFields()
+        classField=provider.fields().lookupField(fieldName)
+        labelField=provider.fields().lookupField(labelFieldName)
+        labels=self._engine.classLabels()
+        fids,classes=self.pointClasses()
+        feedback=feedback or self._feedback
+        with self._stats.stage('write'):
+            for start in range(0,len(fids),batchSize):
+                if feedback.isCanceled():
+                    raise ClassifyError(tr('Cancelled by user'))
+                feedback.setProgress(int(start*100.0/len(fids)))
+                changes={}
+                for fid,cls in zip(fids[start:start+batchSize].tolist(),
+                                   classes[start:start+batchSize].tolist()):
+                    changes[fid]={
+                        classField: cls if cls >= 0 else None,
+                        labelField: labels[cls] if cls >= 0 else None,
+                        }
+                if not provider.changeAttributeValues(changes):
+                    raise ClassifyError(tr("Failed to update attributes of layer {0}")
+                                        .format(layer.name()))
+            feedback.setProgress(0)
+        layer.triggerRepaint()
+        self._stats.setCount('points tagged',len(fids))
+        return len(fids)
 
+    def pointFields( self, fieldName='class', labelFieldName='class_label' ):
+        '''
+        Fields of the source points copied with their class
+        '''
+        fields=QgsFields(self._source.fields())
+        for field in self.pointClassFields(fieldName,labelFieldName):
+            fields.append(field)
+        return fields
+
+    def pointFeatures( self, fieldName='class', labelFieldName='class_label', batchSize=10000 ):
+        '''
+        Generator of lists of up to batchSize copies of the source point
+        features with the class index and label appended.  The class of
+        each batch is looked up from the loaded point classes with a
+        single searchsorted.
+        '''
+        fids,classes=self.pointClasses()
+        order=np.argsort(fids)
+        fids=fids[order]
+        classes=classes[order]
+        labels=self._engine.classLabels()
+        fields=self.pointFields(fieldName,labelFieldName)
+        request=QgsFeatureRequest()
+        if self._sourceFids is not None:
+            request.setFilterFids(self._sourceFids)
+        features=self._source.getFeatures(request)
+        while True:
+            if self._feedback.isCanceled():
+                raise ClassifyError(tr('Cancelled by user'))
+            batch=[feat for feat,i in zip(features,range(batchSize))]
+            if not batch:
+                break
+            with self._stats.stage('point classes'):
+                batchFids=np.array([feat.id() for feat in batch],dtype=np.int64)
+                index=np.minimum(np.searchsorted(fids,batchFids),len(fids)-1)
+                found=fids[index] == batchFids
+                batchClasses=np.where(found,classes[index],-1).tolist()
+                copies=[]
+                for feat,cls in zip(batch,batchClasses):
+                    copy=QgsFeature(fields)
+                    copy.setGeometry(feat.geometry())
+                    copy.setAttributes(feat.attributes()+[
+                        cls if cls >= 0 else None,
+                        labels[cls] if cls >= 0 else None])
+                    copies.append(copy)
+            yield copies
+
+    def writeFile( self, filename, workers=0 ):
+        '''
+        Write the classification to a file with one of the
+        ClassifyWriters, bypassing QgsFeature creation.  If workers is
+        more than 0 the features are contoured by that many threads while
+        they are written.  Returns the number of features written.
+        '''
+        writer=ClassifyWriters.writerForFile(filename)
+        engine=self._engine
+        fieldDefs=self.fieldDefs()
+        crs=self.crs()
+        # The write stage only times the writer, not contouring the results
+        results=self._stats.excluding(self.classifyResults(workers))
+        records=((engine.featureAttributes(r),r.geometry) for r in results)
+        with self._stats.stage('write'):
+            count=writer(filename,records,fieldDefs,crs.authid() or crs.toWkt())
+        return count
+
+    def rasterDefinition( self, resolution=None ):
+        '''
+        ClassifyEngine.ClassifyRaster defining the raster output in
+        source coordinates
+        '''
+        self.data()
+        return self._engine.rasterDefinition(resolution)
+
+    def writeRaster( self, filename, resolution=None ):
+        '''
+        Write the class index raster to a file a block at a time.  The
+        resolution is used for data which are not on a grid.
+        '''
+        writer=ClassifyWriters.rasterWriterForFile(filename)
+        raster=self.rasterDefinition(resolution)
+        engine=self._engine
+        self._feedback.pushInfo(tr("Writing {0} by {1} classified raster")
+                                .format(raster.nrows,raster.ncols))
+        with self._stats.stage('write'):
+            writer(filename,raster,engine.rasterBlocks(raster),
+                   engine.classLabels(),self.crs().toWkt())
+        self._stats.setCount('raster cells',raster.nrows*raster.ncols)
+        return raster
+
+    def calcLabelNdp( self ):
+        self.data()
+        return self._engine.calcLabelNdp()
+
+    def formatLevel( self, level ):
+        self.data()
+        return self._engine.formatLevel(level)
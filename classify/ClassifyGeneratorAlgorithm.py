@@ -1,6 +1,8 @@
 __revision__ = "$Format:%H$"
 
+import json
 import os.path
+import threading
 from PyQt5.QtCore import QCoreApplication, QUrl
 from PyQt5.QtGui import QIcon
 from qgis.core import (
@@ -10,17 +12,30 @@ from qgis.core import (
     QgsProcessingParameterFeatureSource,
     QgsProcessingParameterEnum,
     QgsProcessingParameterExpression,
+    QgsProcessingParameterExtent,
     QgsProcessingParameterNumber,
     QgsProcessingParameterBoolean,
     QgsProcessingParameterString,
     QgsProcessingParameterFeatureSink,
+    QgsProcessingParameterRasterDestination,
+    QgsProcessingOutputString,
+    QgsProcessingLayerPostProcessorInterface,
+    QgsFeatureRequest,
+    QgsFeatureSource,
+    QgsGeometry,
+    QgsProcessingUtils,
+    QgsVectorDataProvider,
+    QgsVectorLayer,
     QgsWkbTypes,
 )
-from .ClassifyGenerator import ClassifyGenerator, ClassifyType, ClassifyExtendOption
-from .ClassifyGenerator import ClassifyError, ClassifyMethodError
-from . import ClassifyMethod
+from .ClassifyWriters import ClassifyWriterError
+from . import ClassifyOptions
 from . import resources
 
+# The generator, engine and methods import numpy and matplotlib, so they
+# are imported when the algorithm is first run rather than when the
+# plugin is loaded.  The enum parameter options come from ClassifyOptions.
+
 
 def tr(string):
     return QCoreApplication.translate("Processing", string)
@@ -30,6 +45,40 @@ class ClassifyGeneratorAlgorithmError(RuntimeError):
     pass
 
 
+class _LodRendererPostProcessor(QgsProcessingLayerPostProcessorInterface):
+    """
+    Applies scale dependent rendering of the levels of detail to the
+    output layer once it is loaded
+    """
+
+    # Processing does not keep a reference to the post processor, so each
+    # is held until it has run.  Algorithms running in parallel threads
+    # may each create one.
+    instances = set()
+    instancesLock = threading.Lock()
+
+    def __init__(self, scales):
+        QgsProcessingLayerPostProcessorInterface.__init__(self)
+        self._scales = scales
+
+    def postProcessLayer(self, layer, context, feedback):
+        from .ClassifyGenerator import ClassifyGenerator
+
+        if isinstance(layer, QgsVectorLayer):
+            renderer = ClassifyGenerator.lodRenderer(layer.renderer(), self._scales)
+            layer.setRenderer(renderer)
+            layer.triggerRepaint()
+        with _LodRendererPostProcessor.instancesLock:
+            _LodRendererPostProcessor.instances.discard(self)
+
+    @staticmethod
+    def create(scales):
+        instance = _LodRendererPostProcessor(scales)
+        with _LodRendererPostProcessor.instancesLock:
+            _LodRendererPostProcessor.instances.add(instance)
+        return instance
+
+
 class ClassifyGeneratorAlgorithm(QgsProcessingAlgorithm):
     """
     Algorithm to calculate Classify lines or filled Classifys from
@@ -41,44 +90,87 @@ class ClassifyGeneratorAlgorithm(QgsProcessingAlgorithm):
     # calling from the QGIS console.
 
     PrmOutputLayer = "OutputLayer"
+    PrmOutputRaster = "OutputRaster"
+    PrmOutputPoints = "OutputPoints"
+    PrmTagPoints = "TagPoints"
+    PrmRasterResolution = "RasterResolution"
+    PrmLevelsOfDetail = "LevelsOfDetail"
+    PrmLodTolerance = "LodTolerance"
+    PrmDropMinorLevels = "DropMinorLevels"
     PrmInputLayer = "InputLayer"
     PrmInputField = "InputField"
+    PrmExtent = "Extent"
+    PrmMaskLayer = "MaskLayer"
+    PrmAreaBuffer = "AreaBuffer"
     PrmClassifyMethod = "ClassifyMethod"
     PrmNClassify = "NClassify"
     PrmMinClassifyValue = "MinClassifyValue"
     PrmMaxClassifyValue = "MaxClassifyValue"
     PrmClassifyInterval = "ClassifyInterval"
     PrmClassifyLevels = "ClassifyLevels"
+    PrmBreaksSampleSize = "BreaksSampleSize"
     PrmClassifyType = "ClassifyType"
     PrmExtendClassify = "ExtendOption"
     PrmLabelDecimalPlaces = "LabelDecimalPlaces"
     PrmLabelTrimZeros = "LabelTrimZeros"
     PrmLabelUnits = "LabelUnits"
     PrmDuplicatePointTolerance = "DuplicatePointTolerance"
-
-    TypeValues = ClassifyType.types()
-    TypeOptions = [ClassifyType.description(t) for t in TypeValues]
-
-    ExtendValues = ClassifyExtendOption.options()
-    ExtendOptions = [ClassifyExtendOption.description(t) for t in ExtendValues]
-
-    MethodValues = [m.id for m in ClassifyMethod.methods]
-    MethodOptions = [m.name for m in ClassifyMethod.methods]
-
-    EnumMapping = {
-        PrmClassifyMethod: (MethodValues, MethodOptions),
-        PrmClassifyType: (TypeValues, TypeOptions),
-        PrmExtendClassify: (ExtendValues, ExtendOptions),
-    }
+    PrmFloat32Coordinates = "Float32Coordinates"
+    PrmWorkerThreads = "WorkerThreads"
+    PrmMemoryBudget = "MemoryBudget"
+    PrmInterpolation = "Interpolation"
+    PrmCellSize = "InterpolationCellSize"
+    PrmCalculationPath = "CalculationPath"
+    PrmPathTolerance = "PathTolerance"
+    OutStatistics = "Statistics"
+
+    TagNone = "none"
+    TagSource = "source"
+    TagCopy = "copy"
+    TagValues = [TagNone, TagSource, TagCopy]
+    TagOptions = [
+        tr("Do not tag input points"),
+        tr("Add class to the input layer"),
+        tr("Copy input points with class to output points layer"),
+    ]
+
+    BulkOutputFormats = [".gpkg", ".parquet"]
+
+    # OGR layer creation options for sink outputs whose provider would
+    # otherwise update a spatial index as each feature is written.  The
+    # index is built once by _createSpatialIndex when the sink is closed.
+    SinkNoIndexOptions = {".sqlite": ["SPATIAL_INDEX=NO"]}
+
+    # Number of features added to the output sink at a time
+    SinkBatchSize = 1000
+
+    # Generator and layer to tag in postProcessAlgorithm
+    _tagLayer = None
+
+    @classmethod
+    def enumMapping(cls):
+        """
+        The (values, options) of each enum parameter
+        """
+        mapping = {cls.PrmTagPoints: (cls.TagValues, cls.TagOptions)}
+        for name, options in (
+            (cls.PrmClassifyType, ClassifyOptions.ClassifyTypeOptions),
+            (cls.PrmExtendClassify, ClassifyOptions.ExtendOptions),
+            (cls.PrmInterpolation, ClassifyOptions.InterpolationOptions),
+            (cls.PrmCalculationPath, ClassifyOptions.PathOptions),
+            (cls.PrmClassifyMethod, ClassifyOptions.MethodOptions),
+        ):
+            mapping[name] = ([v for v, d in options], [tr(d) for v, d in options])
+        return mapping
 
     def _enumParameter(self, name, description, optional=True):
-        values, options = self.EnumMapping[name]
+        values, options = self.enumMapping()[name]
         return QgsProcessingParameterEnum(name, description, options, optional=optional)
 
     def _getEnumValue(self, parameters, name, context):
         # Wishful thinking - currently enum parameter can only accept integer value :-(
         # Hopefully will be able to get value as code in the future
-        values, options = self.EnumMapping[name]
+        values, options = self.enumMapping()[name]
         if name not in parameters:
             return values[0]
         id = self.parameterAsString(parameters, name, context)
@@ -91,6 +183,18 @@ class ClassifyGeneratorAlgorithm(QgsProcessingAlgorithm):
                 )
         return id
 
+    def _bulkOutputFile(self, parameters, context):
+        """
+        The output layer file name if it is a format written directly by
+        ClassifyWriters, otherwise None
+        """
+        if parameters.get(self.PrmOutputLayer) is None:
+            return None
+        dest = self.parameterAsOutputLayer(parameters, self.PrmOutputLayer, context)
+        if dest and os.path.splitext(dest)[1].lower() in self.BulkOutputFormats:
+            return dest
+        return None
+
     def initAlgorithm(self, config):
         """
         Set up parameters for the ClassifyGenerator algorithm
@@ -118,6 +222,34 @@ class ClassifyGeneratorAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        # Area of interest - only points in the extent and mask polygons
+        # (expanded by the buffer) are loaded
+
+        self.addParameter(
+            QgsProcessingParameterExtent(
+                self.PrmExtent, tr("Only use points in extent"), optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.PrmMaskLayer,
+                tr("Only use points in polygons"),
+                [QgsProcessing.TypeVectorPolygon],
+                optional=True,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PrmAreaBuffer,
+                tr("Buffer around area of interest (default 5% of its size)"),
+                QgsProcessingParameterNumber.Double,
+                minValue=0.0,
+                optional=True,
+            )
+        )
+
         # Duplicate point radius - discards points if closer than
         # this to each other (approximately).  0 means don't discard
 
@@ -132,8 +264,88 @@ class ClassifyGeneratorAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        # Coordinates are held relative to the centre of the data, which
+        # for large data sets can be stored as float32 to halve memory
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.PrmFloat32Coordinates,
+                tr("Store coordinates in single precision to reduce memory"),
+                False,
+                optional=True,
+            )
+        )
+
+        # Memory budget in MB - stages that would exceed it use cheaper
+        # strategies where possible, otherwise the algorithm fails
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PrmMemoryBudget,
+                tr("Memory budget in MB (0 for no limit)"),
+                QgsProcessingParameterNumber.Integer,
+                defaultValue=0,
+                minValue=0,
+                optional=True,
+            )
+        )
+
+        # Contours can be calculated by worker threads while the output
+        # is written, each holding only a few features ahead of the writer
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PrmWorkerThreads,
+                tr("Number of contouring worker threads (0 to contour while writing)"),
+                QgsProcessingParameterNumber.Integer,
+                defaultValue=0,
+                minValue=0,
+                maxValue=16,
+                optional=True,
+            )
+        )
+
         # Define the Classify type
 
+        # Scattered data can be interpolated to a grid and the grid
+        # contoured, which is much faster than triangulating large data sets
+
+        self.addParameter(
+            self._enumParameter(
+                self.PrmInterpolation, tr("Interpolate scattered data to a grid")
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PrmCellSize,
+                tr("Interpolation grid cell size (0 for automatic)"),
+                QgsProcessingParameterNumber.Double,
+                defaultValue=0.0,
+                minValue=0.0,
+                optional=True,
+            )
+        )
+
+        # The calculation path is chosen by estimated cost unless set.
+        # Interpolation is only chosen automatically if its cell size is
+        # within the tolerance, as it approximates the data
+
+        self.addParameter(
+            self._enumParameter(self.PrmCalculationPath, tr("Calculation path"))
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PrmPathTolerance,
+                tr("Largest interpolation cell size for automatic path (0 to always triangulate)"),
+                QgsProcessingParameterNumber.Double,
+                defaultValue=0.0,
+                minValue=0.0,
+                optional=True,
+            )
+        )
+
         self.addParameter(self._enumParameter(self.PrmClassifyType, tr("Classify type")))
 
         self.addParameter(
@@ -200,6 +412,20 @@ class ClassifyGeneratorAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        # Number of values used to calculate natural breaks - larger
+        # data sets are grouped into this many values of equal weight
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PrmBreaksSampleSize,
+                tr("Natural breaks sample size"),
+                QgsProcessingParameterNumber.Integer,
+                defaultValue=10000,
+                minValue=2,
+                optional=True,
+            )
+        )
+
         # Define label formatting - number of significant digits and
         # whether trailiing zeros are trimmed.
 
@@ -233,13 +459,160 @@ class ClassifyGeneratorAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        # Pixel size of the classified raster for data not on a grid.
+        # 0 uses approximately the mean point spacing.
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PrmRasterResolution,
+                tr("Classified raster resolution (0 for automatic)"),
+                QgsProcessingParameterNumber.Double,
+                defaultValue=0.0,
+                minValue=0.0,
+                optional=True,
+            )
+        )
+
+        # Levels of detail - each feature is repeated with progressively
+        # simplified geometry and a lod field, rendered by scale
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PrmLevelsOfDetail,
+                tr("Number of levels of detail"),
+                QgsProcessingParameterNumber.Integer,
+                defaultValue=1,
+                minValue=1,
+                maxValue=10,
+                optional=True,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PrmLodTolerance,
+                tr("Simplification tolerance of first level of detail (0 for automatic)"),
+                QgsProcessingParameterNumber.Double,
+                defaultValue=0.0,
+                minValue=0.0,
+                optional=True,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.PrmDropMinorLevels,
+                tr("Drop minor levels at coarser levels of detail"),
+                False,
+                optional=True,
+            )
+        )
+
         # Output layer for the Classifys
 
         self.addParameter(
-            QgsProcessingParameterFeatureSink(self.PrmOutputLayer, tr("Output layer"))
+            QgsProcessingParameterFeatureSink(
+                self.PrmOutputLayer, tr("Output layer"), optional=True
+            )
+        )
+
+        # Output raster for the classified raster type
+
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(
+                self.PrmOutputRaster, tr("Output classified raster"), optional=True
+            )
+        )
+
+        # Tag the input points with the class of their value, either by
+        # adding fields to the input layer or in a copy
+
+        self.addParameter(
+            self._enumParameter(self.PrmTagPoints, tr("Tag input points with class"))
         )
 
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.PrmOutputPoints,
+                tr("Output points with class"),
+                QgsProcessing.TypeVectorPoint,
+                optional=True,
+            )
+        )
+
+        # Timing, memory and counts for each stage of the classification,
+        # as a JSON string
+
+        self.addOutput(
+            QgsProcessingOutputString(
+                self.OutStatistics, tr("Classification statistics")
+            )
+        )
+
+    def _areaOfInterest(self, parameters, context, source):
+        """
+        The extent and mask polygons as a QgsRectangle or QgsGeometry in
+        the source crs, or None if neither is set
+        """
+        area = None
+        if parameters.get(self.PrmExtent) is not None:
+            extent = self.parameterAsExtent(
+                parameters, self.PrmExtent, context, source.sourceCrs()
+            )
+            if not extent.isNull():
+                area = extent
+        mask = self.parameterAsSource(parameters, self.PrmMaskLayer, context)
+        if mask is not None:
+            request = QgsFeatureRequest()
+            request.setDestinationCrs(source.sourceCrs(), context.transformContext())
+            request.setNoAttributes()
+            geom = QgsGeometry.unaryUnion([f.geometry() for f in mask.getFeatures(request)])
+            if area is not None:
+                geom = geom.intersection(QgsGeometry.fromRect(area))
+            area = geom
+        return area
+
+    def _sinkLayerOptions(self, parameters, context):
+        """
+        Layer creation options for the output sink, turning off per
+        feature spatial indexing for the formats in SinkNoIndexOptions
+        """
+        if parameters.get(self.PrmOutputLayer) is None:
+            return []
+        dest = self.parameterAsOutputLayer(parameters, self.PrmOutputLayer, context)
+        if not dest:
+            return []
+        return self.SinkNoIndexOptions.get(os.path.splitext(dest)[1].lower(), [])
+
+    def _setLodPostProcessor(self, generator, dest_id, nlod, context):
+        """
+        Display the levels of detail of the output layer in their scale
+        ranges if it is loaded when the algorithm completes
+        """
+        if nlod > 1 and context.willLoadLayerOnCompletion(dest_id):
+            details = context.layerToLoadOnCompletionDetails(dest_id)
+            details.setPostProcessor(_LodRendererPostProcessor.create(generator.lodScales()))
+
+    def _createSpatialIndex(self, dest_id, context, feedback):
+        """
+        Build the spatial index of the output layer in one pass once all
+        the features are written, for memory outputs and for file outputs
+        created without an index (see SinkNoIndexOptions)
+        """
+        layer = QgsProcessingUtils.mapLayerFromString(dest_id, context)
+        if not isinstance(layer, QgsVectorLayer):
+            return
+        provider = layer.dataProvider()
+        if provider.hasSpatialIndex() == QgsFeatureSource.SpatialIndexPresent:
+            return
+        if not provider.capabilities() & QgsVectorDataProvider.CreateSpatialIndex:
+            return
+        if not provider.createSpatialIndex():
+            feedback.pushInfo(tr("Could not create a spatial index for the output layer"))
+
     def processAlgorithm(self, parameters, context, feedback):
+        from .ClassifyGenerator import ClassifyGenerator, ClassifyType
+        from .ClassifyGenerator import ClassifyError, ClassifyMethodError
 
         # Retrieve the Classify parameters
 
@@ -248,6 +621,18 @@ class ClassifyGeneratorAlgorithm(QgsProcessingAlgorithm):
         DuplicatePointTolerance = self.parameterAsDouble(
             parameters, self.PrmDuplicatePointTolerance, context
         )
+        float32 = self.parameterAsBool(parameters, self.PrmFloat32Coordinates, context)
+        workers = self.parameterAsInt(parameters, self.PrmWorkerThreads, context)
+        memorybudget = self.parameterAsInt(parameters, self.PrmMemoryBudget, context)
+        area = self._areaOfInterest(parameters, context, source)
+        areabuffer = None
+        if parameters.get(self.PrmAreaBuffer) is not None:
+            areabuffer = self.parameterAsDouble(parameters, self.PrmAreaBuffer, context)
+
+        interpolation = self._getEnumValue(parameters, self.PrmInterpolation, context)
+        cellsize = self.parameterAsDouble(parameters, self.PrmCellSize, context)
+        path = self._getEnumValue(parameters, self.PrmCalculationPath, context)
+        pathtolerance = self.parameterAsDouble(parameters, self.PrmPathTolerance, context)
 
         method = self._getEnumValue(parameters, self.PrmClassifyMethod, context)
 
@@ -260,51 +645,164 @@ class ClassifyGeneratorAlgorithm(QgsProcessingAlgorithm):
             zmax = self.parameterAsDouble(parameters, self.PrmMaxClassifyValue, context)
         interval = self.parameterAsDouble(parameters, self.PrmClassifyInterval, context)
         levels = self.parameterAsString(parameters, self.PrmClassifyLevels, context)
+        sample = None
+        if parameters.get(self.PrmBreaksSampleSize) is not None:
+            sample = self.parameterAsInt(parameters, self.PrmBreaksSampleSize, context)
 
         Classifytype = self._getEnumValue(parameters, self.PrmClassifyType, context)
         extend = self._getEnumValue(parameters, self.PrmExtendClassify, context)
         labelndp = self.parameterAsInt(parameters, self.PrmLabelDecimalPlaces, context)
         labeltrim = self.parameterAsBool(parameters, self.PrmLabelTrimZeros, context)
         labelunits = self.parameterAsString(parameters, self.PrmLabelUnits, context)
+        resolution = self.parameterAsDouble(parameters, self.PrmRasterResolution, context)
+        tagpoints = self._getEnumValue(parameters, self.PrmTagPoints, context)
+        nlod = self.parameterAsInt(parameters, self.PrmLevelsOfDetail, context)
+        lodtolerance = self.parameterAsDouble(parameters, self.PrmLodTolerance, context)
+        dropminor = self.parameterAsBool(parameters, self.PrmDropMinorLevels, context)
 
         # Construct and configure the Classify generator
 
         params = {
             "min": zmin,
             "max": zmax,
-            "nClassify": nClassify,
-            "maxClassify": nClassify,
+            "ncontour": nClassify,
+            "maxcontour": nClassify,
             "interval": interval,
             "levels": levels,
+            "sample": sample,
         }
 
         generator = ClassifyGenerator(source, field, feedback)
         generator.setDuplicatePointTolerance(DuplicatePointTolerance)
+        generator.setFloat32Coordinates(float32)
+        generator.setMemoryBudget(memorybudget * 1048576 if memorybudget > 0 else None)
+        if area is not None:
+            generator.setAreaOfInterest(area, areabuffer)
+        generator.setInterpolation(interpolation, cellsize)
+        generator.setCalculationPath(path, pathtolerance or None)
         generator.setClassifyMethod(method, params)
         generator.setClassifyType(Classifytype)
         generator.setClassifyExtendOption(extend)
         generator.setLabelFormat(labelndp, labeltrim, labelunits)
+        generator.setLevelsOfDetail(nlod, lodtolerance or None, dropMinor=dropminor)
 
         # Create the destination layer
 
         dest_id = None
+        raster_file = None
+        points_id = None
         try:
-            wkbtype = generator.wkbtype()
-            fields = generator.fields()
-            crs = generator.crs()
+            if tagpoints == self.TagSource:
+                layer = self.parameterAsVectorLayer(parameters, self.PrmInputLayer, context)
+                if layer is None:
+                    raise ClassifyError(tr("The input must be a layer to tag its points"))
+                # The classes are calculated here, but the layer is edited in
+                # postProcessAlgorithm, which runs in the main thread
+                generator.pointClasses()
+                self._tagLayer = (generator, layer)
+            elif tagpoints == self.TagCopy:
+                (points_sink, points_id) = self.parameterAsSink(
+                    parameters,
+                    self.PrmOutputPoints,
+                    context,
+                    generator.pointFields(),
+                    source.wkbType(),
+                    source.sourceCrs(),
+                )
+                if points_sink is None:
+                    raise ClassifyError(tr("An output points layer is required"))
+                stats = generator.statistics()
+                for features in generator.pointFeatures():
+                    with stats.stage("write"):
+                        points_sink.addFeatures(features, QgsFeatureSink.FastInsert)
+
+            bulk_file = self._bulkOutputFile(parameters, context)
+            if ClassifyType.isRaster(Classifytype):
+                raster_file = self.parameterAsOutputLayer(
+                    parameters, self.PrmOutputRaster, context
+                )
+                if not raster_file:
+                    raise ClassifyError(tr("An output raster is required for raster output"))
+                generator.writeRaster(raster_file, resolution)
+            elif bulk_file:
+                # GeoPackage and GeoParquet outputs are written directly by a bulk writer
+                # rather than one feature at a time through a sink
+                generator.writeFile(bulk_file, workers)
+                dest_id = bulk_file
+                self._setLodPostProcessor(generator, dest_id, nlod, context)
+            else:
+                wkbtype = generator.wkbtype()
+                fields = generator.fields()
+                crs = generator.crs()
+
+                (sink, dest_id) = self.parameterAsSink(
+                    parameters,
+                    self.PrmOutputLayer,
+                    context,
+                    fields,
+                    wkbtype,
+                    crs,
+                    layerOptions=self._sinkLayerOptions(parameters, context),
+                )
+                if sink is None:
+                    if tagpoints == self.TagNone:
+                        raise ClassifyError(tr("An output layer is required"))
+                else:
+                    # Add features to the sink in batches
+                    stats = generator.statistics()
+                    batch = []
+                    for feature in generator.ClassifyFeatures(workers):
+                        batch.append(feature)
+                        if len(batch) >= self.SinkBatchSize:
+                            with stats.stage("write"):
+                                sink.addFeatures(batch, QgsFeatureSink.FastInsert)
+                            batch = []
+                    if batch:
+                        with stats.stage("write"):
+                            sink.addFeatures(batch, QgsFeatureSink.FastInsert)
+                    # Close the sink so the output is complete before it is indexed
+                    del sink
+                    with stats.stage("index"):
+                        self._createSpatialIndex(dest_id, context, feedback)
+                    self._setLodPostProcessor(generator, dest_id, nlod, context)
+
+        except (ClassifyError, ClassifyMethodError, ClassifyWriterError) as ex:
+            feedback.reportError(ex.message())
 
-            (sink, dest_id) = self.parameterAsSink(
-                parameters, self.PrmOutputLayer, context, fields, wkbtype, crs
-            )
+        generator.reportStatistics()
+        statistics = json.dumps(generator.statistics().asDict())
 
-            # Add features to the sink
-            for feature in generator.ClassifyFeatures():
-                sink.addFeature(feature, QgsFeatureSink.FastInsert)
+        return {
+            self.PrmOutputLayer: dest_id,
+            self.PrmOutputRaster: raster_file,
+            self.PrmOutputPoints: points_id,
+            self.OutStatistics: statistics,
+        }
 
-        except (ClassifyError, ClassifyMethodError) as ex:
-            feedback.reportError(ex.message())
+    def postProcessAlgorithm(self, context, feedback):
+        """
+        Tag the source layer points, which edits a project layer so is
+        done in the main thread rather than in processAlgorithm
+        """
+        from .ClassifyGenerator import ClassifyError
+
+        if self._tagLayer is not None:
+            generator, layer = self._tagLayer
+            self._tagLayer = None
+            try:
+                generator.tagSourcePoints(layer, feedback=feedback)
+            except ClassifyError as ex:
+                feedback.reportError(ex.message())
+        return {}
 
-        return {self.PrmOutputLayer: dest_id}
+    def flags(self):
+        """
+        The algorithm keeps all of its state in the ClassifyGenerator it
+        creates for each run, and tags the source layer in
+        postProcessAlgorithm in the main thread, so it can run in a
+        background thread and in parallel batch and model runs
+        """
+        return super().flags() & ~QgsProcessingAlgorithm.FlagNoThreading
 
     def icon(self):
         return QIcon(":/plugins/classify/classify.png")
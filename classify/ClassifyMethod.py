@@ -1,7 +1,8 @@
-import numpy as np
 import math
 import inspect
+import threading
 from collections import namedtuple
+import numpy as np
 
 # Need to use QObject.tr on method name, description
 
@@ -9,9 +10,13 @@ class ClassifyMethodError( RuntimeError ):
     def message(self):
         return self.args[0] if len(self.args)  > 0 else "Exception"
 
-ContourMethod=namedtuple('ContourMethod','id name calc required optional description')
+ContourMethod=namedtuple('ContourMethod','id name calc required optional description usesData')
 
-methods=[]
+# Registered methods.  The tuple is replaced rather than modified when a
+# method is registered, so it can be iterated from any thread while
+# another registers a method.
+methods=()
+_methodsLock=threading.Lock()
 
 tr=lambda x: x
 
@@ -51,6 +56,7 @@ _paramtypes={
     'offset': _floatParam,
     'levels': _numberListParam,
     'mantissa': _numberListParam,
+    'sample': _intParam,
     }
 
 def _evalParam(p,v):
@@ -66,9 +72,11 @@ def _sortedLevels(levels):
     levels=levels[diff > 0]
     return levels
 
-def _methodFunc(z,f,name,req,opt,kwa):
+def _methodFunc(z,f,name,req,opt,kwa,data=None,usesData=False):
     pav=[]
     kwv={}
+    if usesData:
+        kwv['data']=data
     for k in req:
         if k not in kwa:
             raise ClassifyMethodError(tr('Parameter {0} missing in {1}').format(k,name))
@@ -79,6 +87,11 @@ def _methodFunc(z,f,name,req,opt,kwa):
             kwv[k]=_evalParam(k,v)
     return _sortedLevels(f(z,*pav,**kwv))
 
+def _registerMethod( method ):
+    global methods
+    with _methodsLock:
+        methods=tuple(m for m in methods if m.id != method.id)+(method,)
+
 def contourmethod(id=None,name=None,description=None):
     def mf2( f ):
         nonlocal id, name, description
@@ -91,14 +104,19 @@ def contourmethod(id=None,name=None,description=None):
         sig=inspect.signature(f)
         req=[]
         opt=[]
+        # Methods with a data parameter are passed the object providing
+        # the data (ie the ClassifyEngine) rather than a user parameter
+        usesData='data' in sig.parameters
         for pn in sig.parameters:
+            if pn == 'data':
+                continue
             p=sig.parameters[pn]
             if p.kind == inspect.Parameter.POSITIONAL_ONLY:
                 req.append(pn)
             else:
                 opt.append(pn)
-        func=lambda z,**kwa: _methodFunc(z,f,name,req,opt,kwa)
-        methods.append(ContourMethod(id,name,func,req,opt,description))
+        func=lambda z,data=None,**kwa: _methodFunc(z,f,name,req,opt,kwa,data,usesData)
+        _registerMethod(ContourMethod(id,name,func,req,opt,description,usesData))
         return func
     return mf2
 
@@ -133,6 +151,203 @@ def calcQuantileContours( z, ncontour, min=None, max=None ):
     return np.percentile(z,pcnt)
     
 
+def _groupSorted( values, weights, ngroup ):
+    '''
+    Combine sorted weighted values into at most ngroup consecutive groups
+    of approximately equal weight.  Returns the weighted mean, minimum
+    value, maximum value, and total weight of each group.
+    '''
+    cumw=np.cumsum(weights)-weights
+    total=cumw[-1]+weights[-1]
+    group=(cumw*(ngroup/total if total > 0 else 0)).astype(int)
+    starts=np.flatnonzero(np.diff(group,prepend=-1))
+    gweights=np.add.reduceat(weights,starts)
+    gmeans=np.add.reduceat(values*weights,starts)/gweights
+    gmin=values[starts]
+    gmax=values[np.append(starts[1:],len(values))-1]
+    return gmeans,gmin,gmax,gweights
+
+def _naturalBreaks( values, weights, nclass ):
+    '''
+    Optimal partition of sorted weighted values into nclass classes
+    minimising the total within class sum of squares (Fisher-Jenks).
+    Uses the ckmeans dynamic programme in which the optimal start of the
+    last class is monotonic in the index of the last value, so that each
+    row can be filled by divide and conquer.  All the segments at each
+    level of the divide and conquer are evaluated together, giving
+    O(nclass.n.log(n)) time.  Returns the index of the last value in
+    each class.
+    '''
+    n=len(values)
+    values=values-np.average(values,weights=weights)
+    pw=np.concatenate(([0.0],np.cumsum(weights)))
+    ps=np.concatenate(([0.0],np.cumsum(values*weights)))
+    pss=np.concatenate(([0.0],np.cumsum(values*values*weights)))
+
+    def cost( j, i ):
+        # Weighted sum of squares of values j..i inclusive
+        s=ps[i+1]-ps[j]
+        return (pss[i+1]-pss[j])-s*s/(pw[i+1]-pw[j])
+
+    index=np.arange(n)
+    dp=np.empty((nclass,n))
+    start=np.zeros((nclass,n),dtype=int)
+    dp[0]=np.maximum(cost(np.zeros(n,dtype=int),index),0.0)
+    for q in range(1,nclass):
+        ilo=np.array([q])
+        ihi=np.array([n-1])
+        jlo=np.array([q])
+        jhi=np.array([n-1])
+        while len(ilo) > 0:
+            mid=(ilo+ihi)//2
+            lo=np.maximum(jlo,q)
+            hi=np.minimum(jhi,mid)
+            length=hi-lo+1
+            offsets=np.concatenate(([0],np.cumsum(length)[:-1]))
+            seg=np.repeat(np.arange(len(mid)),length)
+            j=lo[seg]+np.arange(len(seg))-offsets[seg]
+            c=dp[q-1][j-1]+np.maximum(cost(j,mid[seg]),0.0)
+            cmin=np.minimum.reduceat(c,offsets)
+            first=np.where(c == cmin[seg],np.arange(len(seg)),len(seg))
+            jopt=j[np.minimum.reduceat(first,offsets)]
+            dp[q][mid]=cmin
+            start[q][mid]=jopt
+            ilo,ihi,jlo,jhi=(
+                np.concatenate((ilo,mid+1)),
+                np.concatenate((mid-1,ihi)),
+                np.concatenate((jlo,jopt)),
+                np.concatenate((jopt,jhi)))
+            keep=ilo <= ihi
+            ilo,ihi,jlo,jhi=ilo[keep],ihi[keep],jlo[keep],jhi[keep]
+    ends=[]
+    i=n-1
+    for q in range(nclass-1,-1,-1):
+        ends.append(i)
+        i=start[q][i]-1
+    ends.reverse()
+    return np.array(ends)
+
+def _areaDistribution( x, y, z, triangles ):
+    '''
+    Distribution of area against z for z linearly interpolated over
+    triangles.  Over each triangle the area density is piecewise linear
+    in z, rising from 0 at the lowest vertex value to a peak at the
+    middle value and falling to 0 at the highest, so the total density
+    is piecewise linear with breakpoints at the vertex values.  Returns
+    the breakpoints t, the density d just above each breakpoint, the
+    slope s of the density above each breakpoint, and the cumulative
+    area e up to and including each breakpoint.
+    '''
+    tz=np.sort(z[triangles],axis=1)
+    tx=x[triangles]
+    ty=y[triangles]
+    area=0.5*np.abs((tx[:,1]-tx[:,0])*(ty[:,2]-ty[:,0])-(tx[:,2]-tx[:,0])*(ty[:,1]-ty[:,0]))
+    z0,z1,z2=tz[:,0],tz[:,1],tz[:,2]
+    flat=z2 <= z0
+    with np.errstate(divide='ignore',invalid='ignore'):
+        peak=np.where(flat,0.0,2.0*area/(z2-z0))
+        rise=np.where(z1 > z0,peak/(z1-z0),0.0)
+        fall=np.where(z2 > z1,peak/(z2-z1),0.0)
+    # Each triangle contributes a rising piece on [z0,z1] and a falling
+    # piece on [z1,z2], recorded as changes of density (jump), slope,
+    # and point mass (for triangles with constant z) at each value
+    risejump=np.where(z1 > z0,peak,0.0)
+    falljump=np.where(z2 > z1,peak,0.0)
+    zero=np.zeros(len(z0))
+    position=np.concatenate((z0,z1,z1,z2,z0))
+    jump=np.concatenate((zero,-risejump,falljump,zero,zero))
+    slope=np.concatenate((rise,-rise,-fall,fall,zero))
+    mass=np.concatenate((zero,zero,zero,zero,np.where(flat,area,0.0)))
+    t,index=np.unique(position,return_inverse=True)
+    jump=np.bincount(index,jump,len(t))
+    slope=np.cumsum(np.bincount(index,slope,len(t)))
+    mass=np.bincount(index,mass,len(t))
+    dt=np.diff(t)
+    d=np.maximum(np.cumsum(jump)+np.concatenate(([0.0],np.cumsum(slope[:-1]*dt))),0.0)
+    segment=np.maximum(d[:-1]*dt+0.5*slope[:-1]*dt*dt,0.0)
+    e=np.cumsum(mass)+np.concatenate(([0.0],np.cumsum(segment)))
+    return t,d,slope,e
+
+def _areaBelow( dist, value ):
+    '''
+    Area with z less than or equal to value
+    '''
+    t,d,s,e=dist
+    k=np.clip(np.searchsorted(t,value,side='right')-1,0,len(t)-1)
+    u=np.clip(value-t[k],0.0,np.append(np.diff(t),0.0)[k])
+    return np.where(value < t[0],0.0,e[k]+d[k]*u+0.5*s[k]*u*u)
+
+def _areaQuantile( dist, area ):
+    '''
+    Values of z below which the given areas lie
+    '''
+    t,d,s,e=dist
+    k=np.clip(np.searchsorted(e,area,side='left'),0,len(t)-1)
+    km1=np.maximum(k-1,0)
+    # Areas within rounding error of a breakpoint are at the breakpoint,
+    # so that flat areas do not give levels differing only by rounding
+    r=area-e[km1]
+    r=np.where(r > 1.0e-12*e[-1],r,0.0)
+    dk=d[km1]
+    sk=s[km1]
+    # Solve dk.u+sk.u^2/2=r in a numerically stable form
+    root=np.sqrt(np.maximum(dk*dk+2.0*sk*r,0.0))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        u=np.where(r > 0,2.0*r/(dk+root),0.0)
+    u=np.nan_to_num(u,nan=0.0,posinf=0.0)
+    value=np.minimum(t[km1]+u,t[k])
+    return np.where(k == 0,t[0],value)
+
+@contourmethod('areaquantile','N area weighted quantiles')
+def calcAreaQuantileContours( z, ncontour, min=None, max=None, data=None ):
+    'Contours dividing the map area between min and max into equal parts'
+    if data is None:
+        raise ClassifyMethodError(tr('Area weighted quantiles require the data point locations'))
+    if ncontour < 1:
+        raise ClassifyMethodError(tr('Invalid number of contours - must be greater than 0'))
+    x,y,z,triangles=data.triangleData()
+    if len(triangles) == 0:
+        raise ClassifyMethodError(tr('Not enough data to calculate area weighted quantiles'))
+    dist=_areaDistribution(x,y,z,triangles)
+    t,e=dist[0],dist[3]
+    amin=0.0 if min is None else float(_areaBelow(dist,min))
+    amax=e[-1] if max is None else float(_areaBelow(dist,max))
+    if amax <= amin:
+        raise ClassifyMethodError(tr('No data area between contour min and max'))
+    levels=_areaQuantile(dist,np.linspace(amin,amax,ncontour+1))
+    levels[0]=t[0] if min is None else min
+    levels[-1]=t[-1] if max is None else max
+    return levels
+
+@contourmethod('jenks','Natural breaks (Jenks)')
+def calcJenksContours( z, ncontour, min=None, max=None, sample=10000 ):
+    'Contours at natural breaks in the data distribution between min and max'
+    if min is not None:
+        z=z[z >= min]
+    if max is not None:
+        z=z[z <= max]
+    if len(z) < 2:
+        raise ClassifyMethodError(tr('Not enough z values to calculate natural breaks'))
+    if ncontour < 1:
+        raise ClassifyMethodError(tr('Invalid number of contours - must be greater than 0'))
+    if sample < 2:
+        raise ClassifyMethodError(tr('Natural breaks sample size must be at least 2'))
+    values,counts=np.unique(z,return_counts=True)
+    zmin,zmax=values[0],values[-1]
+    if zmax <= zmin:
+        raise ClassifyMethodError(tr('Invalid contour range - zmin=zmax'))
+    weights=counts.astype(float)
+    lower=upper=values
+    if len(values) > sample:
+        values,lower,upper,weights=_groupSorted(values,weights,sample)
+    nclass=ncontour if ncontour < len(values) else len(values)
+    ends=_naturalBreaks(values,weights,nclass)
+    # Each break is midway between the last value of a class and the
+    # first of the next, so that classifying the data by the levels
+    # reproduces the classes
+    breaks=0.5*(upper[ends[:-1]]+lower[ends[:-1]+1])
+    return np.concatenate(([zmin],breaks,[zmax]))
+
 @contourmethod('log','Logarithmic intervals')
 def calcLogContours( z, ncontour, min=None, max=None, mantissa=[1,2,5] ):
     'Contours at up to n values 1, 2, 5 * 10^n between min and max'
@@ -197,9 +412,34 @@ def getMethod( id ):
             return m
     return None
 
-def calculateLevels( z, method, **params ):
+def paramsKey( method, params ):
+    '''
+    Hashable key identifying the levels calculated by a method, made
+    from the method id and the evaluated values of the parameters it
+    uses, so that equivalent parameter sets give the same key.
+    '''
+    m=getMethod(method.lower())
+    if m is None:
+        raise ClassifyMethodError("Invalid contouring method {0}".format(method))
+    values=[]
+    for k in m.required+m.optional:
+        v=params.get(k)
+        if v is None or k not in _paramtypes:
+            continue
+        v=_evalParam(k,v)
+        if isinstance(v,np.ndarray):
+            v=tuple(v.tolist())
+        values.append((k,v))
+    return (m.id,tuple(values))
+
+def calculateLevels( z, method, data=None, **params ):
+    '''
+    Calculate levels for z values using the named method.  data is the
+    ClassifyEngine providing the data, which is required by methods that
+    use the point locations as well as the values.
+    '''
     method=method.lower()
     m=getMethod(method)
     if m is not None:
-        return m.calc(z,**params)
+        return m.calc(z,data=data,**params)
     raise ClassifyMethodError("Invalid contouring method {0}".format(method))
@@ -0,0 +1,63 @@
+'''
+Option values and descriptions of the processing algorithm parameters,
+and checks for the optional python modules.
+
+These are used when the plugin is loaded and the processing provider is
+registered, so this module must not import numpy, matplotlib, or the
+modules that depend on them.  The values and descriptions are the same as
+those of the ClassifyEngine option classes and the registered
+ClassifyMethod methods, which is checked by the tests.
+'''
+
+import importlib.util
+
+def moduleAvailable( name ):
+    '''
+    Test if a module can be imported without importing it
+    '''
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+# Each is a tuple of (value, description) in the order of the
+# corresponding ClassifyEngine options
+
+ClassifyTypeOptions=(
+    ('line','Classify lines'),
+    ('filled','Filled Classify polygons'),
+    ('layer','Layer Classify polygons'),
+    ('raster','Classified raster'),
+    )
+
+ExtendOptions=(
+    ('both','Fill below minimum and above maximum Classify'),
+    ('min','Fill below minimum Classify'),
+    ('max','Fill above maximum Classify'),
+    ('neither','Don\'t fill below or above maximum Classify'),
+    )
+
+InterpolationOptions=(
+    ('none','Triangulate scattered data'),
+    ('idw','Inverse distance weighted interpolation to a grid'),
+    ('linear','Linear interpolation to a grid'),
+    )
+
+PathOptions=(
+    ('auto','Choose the path with the lowest estimated cost'),
+    ('grid','Contour data on a regular grid directly'),
+    ('triangulation','Contour the triangulation of the points'),
+    ('interpolation','Interpolate the points to a grid and contour the grid'),
+    )
+
+# (id, name) of the methods registered in ClassifyMethod
+
+MethodOptions=(
+    ('equal','N equal intervals'),
+    ('quantile','N quantiles'),
+    ('areaquantile','N area weighted quantiles'),
+    ('jenks','Natural breaks (Jenks)'),
+    ('log','Logarithmic intervals'),
+    ('interval','Fixed contour interval'),
+    ('manual','User selected contour levels'),
+    )
@@ -6,7 +6,7 @@ import inspect
 
 from qgis.core import QgsProcessingAlgorithm, QgsApplication
 from .ClassifyGeneratorProvider import ClassifyGeneratorProvider
-from .ClassifyDialog import ClassifyDialogPlugin
+from .ClassifyDialogPlugin import ClassifyDialogPlugin, mplAvailable
 
 cmd_folder = os.path.split(inspect.getfile(inspect.currentframe()))[0]
 
@@ -20,9 +20,14 @@ class ClassifyPlugin(object):
         self.dialog = ClassifyDialogPlugin(iface)
 
     def initGui(self):
-        QgsApplication.processingRegistry().addProvider(self.provider)
+        # The algorithm needs numpy and matplotlib, so the provider is only
+        # added if they are installed (the dialog warns if they are not)
+        self.providerAdded = mplAvailable()
+        if self.providerAdded:
+            QgsApplication.processingRegistry().addProvider(self.provider)
         self.dialog.initGui()
 
     def unload(self):
-        QgsApplication.processingRegistry().removeProvider(self.provider)
+        if self.providerAdded:
+            QgsApplication.processingRegistry().removeProvider(self.provider)
         self.dialog.unload()
@@ -0,0 +1,194 @@
+"""
+Live preview of the classification on the map canvas.  A decimated copy
+of the data is contoured on a background thread each time the levels
+change, and the results are drawn as rubber bands.  The decimated data
+and its triangulation are reused until the source data changes, so an
+update only recalculates the contours.
+"""
+
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import QCoreApplication, QObject, pyqtSignal
+from PyQt5.QtGui import QColor
+from qgis.core import (
+    Qgis,
+    QgsCoordinateTransform,
+    QgsGeometry,
+    QgsMessageLog,
+    QgsProject,
+    QgsWkbTypes,
+)
+from qgis.gui import QgsRubberBand
+
+from .ClassifyEngine import ClassifyError, ClassifyGeometry, ClassifyType
+from .ClassifyMethod import ClassifyMethodError
+
+
+def tr(string):
+    return QCoreApplication.translate("Processing", string)
+
+
+class _PreviewFeedback:
+    """
+    Feedback for the preview engine, which cancels the running job as
+    soon as a newer one is requested
+    """
+
+    def __init__(self, preview):
+        self._preview = preview
+        self.job = 0
+
+    def isCanceled(self):
+        return self.job != self._preview._job
+
+    def setProgress(self, percent):
+        pass
+
+    def pushInfo(self, info):
+        pass
+
+    def reportError(self, message, fatal=False):
+        raise ClassifyError(message)
+
+
+class ClassifyPreview(QObject):
+    """
+    Draws a preview of the classification of an engine on a map canvas.
+    Call update whenever the levels or classify type change.
+    """
+
+    # Maximum number of points contoured for the preview
+    MaxPoints = 10000
+
+    # Delay in ms used to debounce parameter changes before updating
+    Delay = 100
+
+    _finished = pyqtSignal(int, object, str)
+
+    # Emitted with a message if calculating a preview fails unexpectedly
+    failed = pyqtSignal(str)
+
+    def __init__(self, canvas):
+        QObject.__init__(self)
+        self._canvas = canvas
+        self._bands = []
+        self._job = 0
+        self._dataKey = None
+        self._engine = None
+        self._feedback = _PreviewFeedback(self)
+        # A single worker so that jobs share the preview engine in turn
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._finished.connect(self._showResults)
+
+    def update(self, engine, classifyType, extend, crs, colors=None):
+        """
+        Start contouring a decimated copy of the data of engine, using
+        its current levels, and draw the result when done.  Any preview
+        still being calculated is cancelled.  crs is the coordinate
+        system of the data, and colors an optional function of the
+        feature number and number of features returning a QColor.
+        """
+        self._job += 1
+        job = self._job
+        try:
+            levels = engine.levels()
+            key = (id(engine), engine.dataVersion())
+            if key != self._dataKey:
+                self._engine = engine.decimatedEngine(self.MaxPoints, self._feedback)
+                self._dataKey = key
+        except ClassifyError:
+            self.clear()
+            return
+        if ClassifyType.isRaster(classifyType):
+            classifyType = ClassifyType.filled
+        self._crs = crs
+        self._colors = colors
+        self._executor.submit(
+            self._run, self._engine, job, list(levels), classifyType, extend
+        )
+
+    def _run(self, engine, job, levels, classifyType, extend):
+        # Runs on the worker thread
+        self._feedback.job = job
+        if self._feedback.isCanceled():
+            return
+        results = None
+        error = ""
+        try:
+            engine.setClassifyLevels(levels)
+            engine.setClassifyType(classifyType)
+            engine.setClassifyExtendOption(extend)
+            results = [
+                (feature.geometry.type, feature.geometry.wkb())
+                for feature in engine.features()
+                if not feature.geometry.isEmpty()
+            ]
+        except (ClassifyError, ClassifyMethodError):
+            # Parameters which cannot be classified (or a cancelled job)
+            # just show no preview
+            pass
+        except Exception as ex:
+            error = str(ex) or type(ex).__name__
+            QgsMessageLog.logMessage(traceback.format_exc(), "Classify", Qgis.Warning)
+        if not self._feedback.isCanceled():
+            self._finished.emit(job, results, error)
+
+    def _showResults(self, job, results, error):
+        if job != self._job:
+            return
+        self._removeBands()
+        if error:
+            self.failed.emit(error)
+        if not results:
+            return
+        transform = None
+        canvasCrs = self._canvas.mapSettings().destinationCrs()
+        if self._crs is not None and self._crs != canvasCrs:
+            transform = QgsCoordinateTransform(
+                self._crs, canvasCrs, QgsProject.instance()
+            )
+        nfeature = len(results)
+        for i, (geomtype, wkb) in enumerate(results):
+            geom = QgsGeometry()
+            geom.fromWkb(wkb)
+            if transform is not None:
+                geom.transform(transform)
+            color = None
+            if self._colors is not None:
+                color = self._colors(i, nfeature)
+            if color is None:
+                color = QColor(255, 0, 0)
+            if geomtype == ClassifyGeometry.polygon:
+                band = QgsRubberBand(self._canvas, QgsWkbTypes.PolygonGeometry)
+                fill = QColor(color)
+                fill.setAlpha(100)
+                band.setFillColor(fill)
+                band.setStrokeColor(color)
+            else:
+                band = QgsRubberBand(self._canvas, QgsWkbTypes.LineGeometry)
+                band.setColor(color)
+            band.setWidth(1)
+            band.addGeometry(geom, None)
+            self._bands.append(band)
+
+    def _removeBands(self):
+        scene = self._canvas.scene()
+        for band in self._bands:
+            band.reset()
+            scene.removeItem(band)
+        self._bands = []
+
+    def clear(self):
+        """
+        Cancel any preview being calculated and remove the preview from
+        the canvas
+        """
+        self._job += 1
+        self._removeBands()
+
+    def close(self):
+        self.clear()
+        self._engine = None
+        self._dataKey = None
+        self._executor.shutdown(wait=False)
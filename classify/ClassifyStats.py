@@ -0,0 +1,195 @@
+'''
+ClassifyStats records the time, memory use and counts of objects
+processed in each stage of the classification.
+'''
+
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+def _peakRss():
+    '''
+    Peak resident set size of the process in bytes, or None if it
+    cannot be determined on this platform.
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, bytes on MacOS
+    return peak if sys.platform == 'darwin' else peak*1024
+
+class ClassifyStats:
+    '''
+    Accumulates wall time, cpu time and peak memory for each named
+    stage, and a set of named counters.  A stage may be entered many
+    times (for example once per feature), in which case the times are
+    summed and the peak memory is the maximum.
+
+    Stages may be nested, in which case the time of the inner stage is
+    excluded from the time of the outer stage.
+
+    Memory is measured with tracemalloc if it is tracing (either
+    because traceMemory is set or because it was started elsewhere),
+    otherwise as the process peak resident set size.
+
+    Stages may be recorded from several threads, each nesting its own
+    stages.  The cpu time of a stage includes all threads of the process.
+    The tracemalloc peak is global to the process, so traced memory is
+    only measured in the thread that created the ClassifyStats.
+    '''
+
+    def __init__( self, traceMemory=False ):
+        self._traceMemory=traceMemory
+        self._startedTrace=False
+        self._lock=threading.Lock()
+        self._thread=threading.get_ident()
+        self.reset()
+
+    def reset( self ):
+        self._stages={}
+        self._order=[]
+        self._local=threading.local()
+        self._counters={}
+
+    def _stack( self ):
+        stack=getattr(self._local,'stack',None)
+        if stack is None:
+            stack=self._local.stack=[]
+        return stack
+
+    @contextmanager
+    def stage( self, name ):
+        '''
+        Context in which the time and memory of stage name are recorded.
+        If name is None nothing is recorded, but the time is still
+        excluded from the enclosing stage.
+        '''
+        owner=threading.get_ident() == self._thread
+        if owner and self._traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._startedTrace=True
+        tracing=tracemalloc.is_tracing()
+        traced=tracing and owner
+        stack=self._stack()
+        frame={'child_wall': 0.0,'child_cpu': 0.0,'peak': 0}
+        if traced:
+            current,peak=tracemalloc.get_traced_memory()
+            if stack:
+                parent=stack[-1]
+                parent['peak']=max(parent['peak'],peak)
+            frame['start']=current
+            tracemalloc.reset_peak()
+        stack.append(frame)
+        wall0=time.perf_counter()
+        cpu0=time.process_time()
+        try:
+            yield self
+        finally:
+            wall=time.perf_counter()-wall0
+            cpu=time.process_time()-cpu0
+            stack.pop()
+            if stack:
+                parent=stack[-1]
+                parent['child_wall'] += wall
+                parent['child_cpu'] += cpu
+            if traced:
+                peak=max(frame['peak'],tracemalloc.get_traced_memory()[1])
+                if stack:
+                    parent=stack[-1]
+                    parent['peak']=max(parent['peak'],peak)
+                peak -= frame['start']
+                memtype='traced'
+            elif tracing:
+                peak=None
+                memtype='traced'
+            else:
+                peak=_peakRss()
+                memtype='rss'
+            if name is not None:
+                self._record(name,wall-frame['child_wall'],cpu-frame['child_cpu'],peak,memtype)
+
+    def _record( self, name, wall, cpu, peak, memtype ):
+        with self._lock:
+            if name not in self._stages:
+                self._order.append(name)
+                self._stages[name]={
+                    'calls': 0,
+                    'wall': 0.0,
+                    'cpu': 0.0,
+                    'peak_memory': None,
+                    'memory_type': memtype,
+                    }
+            stats=self._stages[name]
+            stats['calls'] += 1
+            stats['wall'] += wall
+            stats['cpu'] += cpu
+            if peak is not None:
+                stats['peak_memory']=max(peak,stats['peak_memory'] or 0)
+
+    def excluding( self, iterable ):
+        '''
+        Generator of the items of iterable, excluding the time taken to
+        produce each item from the enclosing stage.  This is used when a
+        stage consumes results produced by other threads, so that it does
+        not include the time spent waiting for them.
+        '''
+        iterator=iter(iterable)
+        while True:
+            with self.stage(None):
+                try:
+                    item=next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count( self, name, value=1 ):
+        '''
+        Add value to the named counter
+        '''
+        with self._lock:
+            self._counters[name]=self._counters.get(name,0)+int(value)
+
+    def setCount( self, name, value ):
+        with self._lock:
+            self._counters[name]=int(value)
+
+    def counter( self, name ):
+        return self._counters.get(name,0)
+
+    def stop( self ):
+        '''
+        Stop memory tracing if it was started by this object
+        '''
+        if self._startedTrace:
+            tracemalloc.stop()
+            self._startedTrace=False
+
+    def asDict( self ):
+        return {
+            'stages': {name: dict(self._stages[name]) for name in self._order},
+            'counters': dict(self._counters),
+            }
+
+    def summary( self ):
+        '''
+        Multiline text summary of the stage timings and counters
+        '''
+        lines=[]
+        for name in self._order:
+            stats=self._stages[name]
+            line='{0}: {1:.3f}s wall, {2:.3f}s cpu'.format(
+                name,stats['wall'],stats['cpu'])
+            if stats['peak_memory'] is not None:
+                label='peak traced' if stats['memory_type'] == 'traced' else 'peak rss'
+                line += ', {0} {1:.1f}MB'.format(label,stats['peak_memory']/1048576.0)
+            if stats['calls'] > 1:
+                line += ' ({0} calls)'.format(stats['calls'])
+            lines.append(line)
+        if self._counters:
+            lines.append(', '.join('{0}: {1}'.format(k,v)
+                                   for k,v in self._counters.items()))
+        return '\n'.join(lines)
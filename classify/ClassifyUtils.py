@@ -1,10 +1,71 @@
-
-import numpy as np
-
 '''
 ContourUtils provide support functions for the contouring tool
 '''
 
+import numpy as np
+
+def classIndex( levels, z, nodata=-1 ):
+    '''
+    Index of the class containing each z value, where class i is the
+    range levels[i] to levels[i+1] (including the upper bound for the
+    last class).  Values outside the levels or undefined are set to
+    nodata.  levels may start with -inf or end with inf to include all
+    values below or above the levels.
+    '''
+    levels=np.asarray(levels,dtype=np.float64)
+    z=np.asarray(z,dtype=np.float64)
+    nclass=len(levels)-1
+    index=np.searchsorted(levels,z,side='right')-1
+    index[z == levels[-1]]=nclass-1
+    index[(index < 0) | (index >= nclass) | np.isnan(z)]=nodata
+    return index.astype(np.int16 if nclass < 32767 else np.int32)
+
+def pointsInPolygon( x, y, rings, batchSize=10000000 ):
+    '''
+    Mask of the points x, y inside a polygon given as a list of (n,2)
+    arrays of ring vertices (outer rings and holes, possibly of several
+    polygons), using the even-odd rule.
+
+    The points are sorted by y once, and each edge only tests the points
+    in its y range, so the cost is proportional to the number of points
+    times the number of edges crossed by a horizontal line rather than
+    the total number of edges.  Edges are processed in vectorized batches
+    of about batchSize point tests.
+    '''
+    x=np.asarray(x,dtype=np.float64)
+    y=np.asarray(y,dtype=np.float64)
+    order=np.argsort(y,kind='stable')
+    xs=x[order]
+    ys=y[order]
+    rings=[np.asarray(r,dtype=np.float64) for r in rings if len(r) > 2]
+    if not rings:
+        return np.zeros(len(x),dtype=bool)
+    start=np.concatenate(rings)
+    end=np.concatenate([np.roll(r,-1,axis=0) for r in rings])
+    x0,y0,x1,y1=start[:,0],start[:,1],end[:,0],end[:,1]
+    select=y0 != y1
+    x0,y0,x1,y1=x0[select],y0[select],x1[select],y1[select]
+    # A point crosses an edge if ylow <= y < yhigh and it is left of the edge
+    first=np.searchsorted(ys,np.minimum(y0,y1),side='left')
+    last=np.searchsorted(ys,np.maximum(y0,y1),side='left')
+    count=last-first
+    crossings=np.zeros(len(x),dtype=np.int64)
+    total=np.cumsum(count)
+    edge0=0
+    while edge0 < len(count):
+        base=total[edge0-1] if edge0 > 0 else 0
+        edge1=max(int(np.searchsorted(total,base+batchSize,side='right')),edge0+1)
+        ecount=count[edge0:edge1]
+        edge=np.repeat(np.arange(edge0,edge1),ecount)
+        offset=np.cumsum(ecount)-ecount
+        index=np.arange(int(ecount.sum()))-np.repeat(offset,ecount)+first[edge]
+        xc=x0[edge]+(ys[index]-y0[edge])*(x1[edge]-x0[edge])/(y1[edge]-y0[edge])
+        crossings += np.bincount(index[xs[index] < xc],minlength=len(x))
+        edge0=edge1
+    inside=np.empty(len(x),dtype=bool)
+    inside[order]=(crossings % 2) == 1
+    return inside
+
 def _discardIndex( x, y, x0, y0, resolution, index):
     values,ix=np.unique(((x[index]-x0)/resolution).astype(int),return_inverse=True)
     values,iy=np.unique(((y[index]-y0)/resolution).astype(int),return_inverse=True)
@@ -0,0 +1,407 @@
+'''
+Writers for classification results which do not depend on QGIS.
+
+Each vector writer is called as writer(filename, records, fieldDefs, crs=None)
+where records is an iterable of (attributes, geometry) pairs, the
+attributes being a list of values in the order of fieldDefs (a list of
+(name, type) as returned by ClassifyEngine.fieldDefs), and the geometry
+a ClassifyEngine.ClassifyGeometry.  crs is an optional authority id such
+as 'EPSG:28355'.  Each returns the number of records written.
+
+Raster writers are called as writer(filename, raster, blocks, labels, crs)
+as described in writeGeoTiff.
+'''
+
+import csv
+import itertools
+import json
+import math
+import os
+import re
+import sqlite3
+import struct
+
+class ClassifyWriterError( RuntimeError ):
+
+    def message(self):
+        return self.args[0] if len(self.args) > 0 else "Exception"
+
+def _jsonValue( value ):
+    if isinstance(value,float) and not math.isfinite(value):
+        return None
+    return value
+
+def _geoJsonGeometry( geometry ):
+    if geometry.type == geometry.line:
+        return {
+            'type': 'MultiLineString',
+            'coordinates': [line.tolist() for line in geometry.parts()],
+            }
+    return {
+        'type': 'MultiPolygon',
+        'coordinates': [[ring.tolist() for ring in polygon]
+                        for polygon in geometry.parts()],
+        }
+
+def writeGeoJson( filename, records, fieldDefs, crs=None ):
+    '''
+    Write the records as a GeoJSON feature collection.  Features are
+    written one at a time so the whole collection is never held in
+    memory.
+    '''
+    names=[name for name,ftype in fieldDefs]
+    count=0
+    with open(filename,'w') as jf:
+        jf.write('{"type": "FeatureCollection",\n')
+        if crs:
+            jf.write('"crs": '+json.dumps({'type':'name','properties':{'name':crs}})+',\n')
+        jf.write('"features": [\n')
+        for attributes,geometry in records:
+            feature={
+                'type': 'Feature',
+                'properties': {n: _jsonValue(v) for n,v in zip(names,attributes)},
+                'geometry': _geoJsonGeometry(geometry),
+                }
+            if count > 0:
+                jf.write(',\n')
+            jf.write(json.dumps(feature))
+            count += 1
+        jf.write('\n]}\n')
+    return count
+
+def writeCsv( filename, records, fieldDefs, crs=None ):
+    '''
+    Write the records as CSV with the geometry as hex encoded WKB in
+    the first column
+    '''
+    names=[name for name,ftype in fieldDefs]
+    count=0
+    with open(filename,'w',newline='') as cf:
+        writer=csv.writer(cf)
+        writer.writerow(['wkb']+names)
+        for attributes,geometry in records:
+            writer.writerow([geometry.wkb().hex()]+list(attributes))
+            count += 1
+    return count
+
+_gpkgTypes={int: 'INTEGER', float: 'DOUBLE', str: 'TEXT'}
+
+_gpkgSetup='''
+PRAGMA application_id=1196444487;
+PRAGMA user_version=10300;
+CREATE TABLE gpkg_spatial_ref_sys (
+    srs_name TEXT NOT NULL, srs_id INTEGER NOT NULL PRIMARY KEY,
+    organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL,
+    definition TEXT NOT NULL, description TEXT);
+CREATE TABLE gpkg_contents (
+    table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL,
+    identifier TEXT UNIQUE, description TEXT DEFAULT '',
+    last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+    min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER,
+    CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id));
+CREATE TABLE gpkg_geometry_columns (
+    table_name TEXT NOT NULL, column_name TEXT NOT NULL,
+    geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL,
+    z TINYINT NOT NULL, m TINYINT NOT NULL,
+    CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),
+    CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+    CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id));
+CREATE TABLE gpkg_extensions (
+    table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL,
+    definition TEXT NOT NULL, scope TEXT NOT NULL,
+    CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name));
+INSERT INTO gpkg_spatial_ref_sys VALUES
+    ('Undefined cartesian SRS',-1,'NONE',-1,'undefined','undefined cartesian coordinate reference system'),
+    ('Undefined geographic SRS',0,'NONE',0,'undefined','undefined geographic coordinate reference system'),
+    ('WGS 84 geodetic',4326,'EPSG',4326,'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AXIS["Latitude",NORTH],AXIS["Longitude",EAST],AUTHORITY["EPSG","4326"]]','longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid');
+'''
+
+# R-tree maintenance triggers required by the GeoPackage spatial index
+# extension.  These are created after the bulk load.
+_gpkgRtreeTriggers='''
+CREATE TRIGGER "rtree_{t}_{c}_insert" AFTER INSERT ON "{t}"
+WHEN (new."{c}" NOT NULL AND NOT ST_IsEmpty(NEW."{c}"))
+BEGIN
+  INSERT OR REPLACE INTO "rtree_{t}_{c}" VALUES (NEW.fid,
+    ST_MinX(NEW."{c}"), ST_MaxX(NEW."{c}"), ST_MinY(NEW."{c}"), ST_MaxY(NEW."{c}"));
+END;
+CREATE TRIGGER "rtree_{t}_{c}_update1" AFTER UPDATE OF "{c}" ON "{t}"
+WHEN OLD.fid = NEW.fid AND (NEW."{c}" NOTNULL AND NOT ST_IsEmpty(NEW."{c}"))
+BEGIN
+  INSERT OR REPLACE INTO "rtree_{t}_{c}" VALUES (NEW.fid,
+    ST_MinX(NEW."{c}"), ST_MaxX(NEW."{c}"), ST_MinY(NEW."{c}"), ST_MaxY(NEW."{c}"));
+END;
+CREATE TRIGGER "rtree_{t}_{c}_update2" AFTER UPDATE OF "{c}" ON "{t}"
+WHEN OLD.fid = NEW.fid AND (NEW."{c}" ISNULL OR ST_IsEmpty(NEW."{c}"))
+BEGIN
+  DELETE FROM "rtree_{t}_{c}" WHERE id = OLD.fid;
+END;
+CREATE TRIGGER "rtree_{t}_{c}_update3" AFTER UPDATE ON "{t}"
+WHEN OLD.fid != NEW.fid AND (NEW."{c}" NOTNULL AND NOT ST_IsEmpty(NEW."{c}"))
+BEGIN
+  DELETE FROM "rtree_{t}_{c}" WHERE id = OLD.fid;
+  INSERT OR REPLACE INTO "rtree_{t}_{c}" VALUES (NEW.fid,
+    ST_MinX(NEW."{c}"), ST_MaxX(NEW."{c}"), ST_MinY(NEW."{c}"), ST_MaxY(NEW."{c}"));
+END;
+CREATE TRIGGER "rtree_{t}_{c}_update4" AFTER UPDATE ON "{t}"
+WHEN OLD.fid != NEW.fid AND (NEW."{c}" ISNULL OR ST_IsEmpty(NEW."{c}"))
+BEGIN
+  DELETE FROM "rtree_{t}_{c}" WHERE id IN (OLD.fid, NEW.fid);
+END;
+CREATE TRIGGER "rtree_{t}_{c}_delete" AFTER DELETE ON "{t}"
+WHEN old."{c}" NOT NULL
+BEGIN
+  DELETE FROM "rtree_{t}_{c}" WHERE id = OLD.fid;
+END;
+'''
+
+def _gpkgSrs( crs ):
+    '''
+    Returns srs_id, organization, organization_coordsys_id, and WKT
+    definition for a crs given as an authority id or WKT
+    '''
+    if not crs:
+        return -1,'NONE',-1,'undefined'
+    definition='undefined'
+    try:
+        from osgeo import osr
+        srs=osr.SpatialReference()
+        if srs.SetFromUserInput(crs) == 0:
+            definition=srs.ExportToWkt()
+    except Exception:
+        pass
+    match=re.match(r'^(\w+):(\d+)$',crs.strip())
+    if match:
+        return int(match.group(2)),match.group(1).upper(),int(match.group(2)),definition
+    return 100000,'NONE',100000,crs
+
+def _gpkgBlob( geometry, srsId ):
+    '''
+    GeoPackage geometry blob - the GP header with the xy envelope
+    followed by the WKB
+    '''
+    bounds=geometry.bounds()
+    if bounds is None:
+        # Little endian, no envelope, empty geometry
+        return struct.pack('<2sBBi',b'GP',0,0x11,srsId)+geometry.wkb(),None
+    xmin,ymin,xmax,ymax=bounds
+    header=struct.pack('<2sBBi4d',b'GP',0,0x03,srsId,xmin,xmax,ymin,ymax)
+    return header+geometry.wkb(),bounds
+
+def writeGeoPackage( filename, records, fieldDefs, crs=None ):
+    '''
+    Write the records as a GeoPackage feature table.  All the features
+    are inserted in one transaction with a single prepared statement,
+    geometry blobs are encoded directly from the vertex buffers, and the
+    R-tree spatial index is built once at the end rather than updated as
+    each row is inserted.  The table is named after the file.
+    '''
+    if os.path.exists(filename):
+        os.remove(filename)
+    records=iter(records)
+    first=next(records,None)
+    if first is None:
+        geometryType='GEOMETRY'
+    else:
+        geometryType='MULTILINESTRING' if first[1].type == first[1].line else 'MULTIPOLYGON'
+        records=itertools.chain([first],records)
+    table=re.sub(r'\W+','_',os.path.splitext(os.path.basename(filename))[0]) or 'classify'
+    column='geom'
+    srsId,organization,orgId,definition=_gpkgSrs(crs)
+    names=[name for name,ftype in fieldDefs]
+    columns=', '.join('"{0}" {1}'.format(name,_gpkgTypes.get(ftype,'TEXT'))
+                      for name,ftype in fieldDefs)
+    bounds=[]
+    count=0
+
+    def rows():
+        nonlocal count
+        for fid,(attributes,geometry) in enumerate(records,1):
+            count=fid
+            blob,bbox=_gpkgBlob(geometry,srsId)
+            if bbox is not None:
+                bounds.append((fid,bbox[0],bbox[2],bbox[1],bbox[3]))
+            yield [fid,blob]+[_jsonValue(v) for v in attributes]
+
+    db=sqlite3.connect(filename)
+    try:
+        db.execute('PRAGMA synchronous=OFF')
+        db.execute('PRAGMA journal_mode=MEMORY')
+        db.executescript(_gpkgSetup)
+        with db:
+            if srsId not in (-1,0,4326):
+                db.execute('INSERT INTO gpkg_spatial_ref_sys VALUES (?,?,?,?,?,?)',
+                           (crs,srsId,organization,orgId,definition,''))
+            db.execute('CREATE TABLE "{0}" (fid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, '
+                       '"{1}" {2}, {3})'.format(table,column,geometryType,columns))
+            insert='INSERT INTO "{0}" (fid, "{1}", {2}) VALUES ({3})'.format(
+                table,column,', '.join('"{0}"'.format(n) for n in names),
+                ', '.join('?'*(len(names)+2)))
+            db.executemany(insert,rows())
+            extent=[None]*4
+            if bounds:
+                extent=[min(b[1] for b in bounds),min(b[3] for b in bounds),
+                        max(b[2] for b in bounds),max(b[4] for b in bounds)]
+            db.execute('INSERT INTO gpkg_contents (table_name, data_type, identifier, '
+                       'min_x, min_y, max_x, max_y, srs_id) VALUES (?,?,?,?,?,?,?,?)',
+                       [table,'features',table]+extent+[srsId])
+            db.execute('INSERT INTO gpkg_geometry_columns VALUES (?,?,?,?,0,0)',
+                       (table,column,geometryType,srsId))
+            rtree=False
+            try:
+                db.execute('CREATE VIRTUAL TABLE "rtree_{0}_{1}" USING rtree(id, minx, maxx, miny, maxy)'
+                           .format(table,column))
+            except sqlite3.OperationalError:
+                # SQLite built without R-tree support - no spatial index
+                pass
+            else:
+                db.executemany('INSERT INTO "rtree_{0}_{1}" VALUES (?,?,?,?,?)'
+                               .format(table,column),bounds)
+                db.execute('INSERT INTO gpkg_extensions VALUES (?,?,?,?,?)',
+                           (table,column,'gpkg_rtree_index',
+                            'http://www.geopackage.org/spec120/#extension_rtree','write-only'))
+                rtree=True
+        if rtree:
+            db.executescript(_gpkgRtreeTriggers.format(t=table,c=column))
+    finally:
+        db.close()
+    return count
+
+_arrowTypes={int: 'int64', float: 'float64', str: 'string'}
+
+def _geoParquetCrs( crs ):
+    '''
+    PROJJSON for the crs as required by GeoParquet, or None (unknown)
+    if pyproj is not installed to convert it
+    '''
+    if not crs:
+        return None
+    try:
+        import pyproj
+        return pyproj.CRS.from_user_input(crs).to_json_dict()
+    except Exception:
+        return None
+
+def writeGeoParquet( filename, records, fieldDefs, crs=None, rowGroupSize=10000 ):
+    '''
+    Write the records as GeoParquet with a WKB geometry column.  Records
+    are converted to columns and written rowGroupSize at a time, so only
+    one row group is held in memory.  Requires pyarrow.
+
+    Each row also has a bbox column (the GeoParquet 1.1 bounding box
+    covering) calculated from the vertex buffer, so that readers can
+    skip row groups and rows by their statistics rather than decoding
+    each geometry.
+    '''
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ClassifyWriterError("GeoParquet output requires pyarrow")
+    records=iter(records)
+    first=next(records,None)
+    geometryTypes=[]
+    if first is not None:
+        geometryTypes=['MultiLineString' if first[1].type == first[1].line else 'MultiPolygon']
+        records=itertools.chain([first],records)
+    names=[name for name,ftype in fieldDefs]
+    bboxNames=['xmin','ymin','xmax','ymax']
+    schema=pa.schema(
+        [pa.field(name,getattr(pa,_arrowTypes.get(ftype,'string'))()) for name,ftype in fieldDefs]
+        +[pa.field('geometry',pa.binary()),
+          pa.field('bbox',pa.struct([(name,pa.float64()) for name in bboxNames]))])
+    geo={
+        'version': '1.1.0',
+        'primary_column': 'geometry',
+        'columns': {
+            'geometry': {
+                'encoding': 'WKB',
+                'geometry_types': geometryTypes,
+                'crs': _geoParquetCrs(crs),
+                'covering': {'bbox': {name: ['bbox',name] for name in bboxNames}},
+                },
+            },
+        }
+    schema=schema.with_metadata({b'geo': json.dumps(geo).encode('utf8')})
+    count=0
+    with pq.ParquetWriter(filename,schema) as writer:
+        while True:
+            group=list(itertools.islice(records,rowGroupSize))
+            if not group:
+                break
+            columns=[[_jsonValue(attributes[i]) for attributes,geometry in group]
+                     for i in range(len(names))]
+            columns.append([geometry.wkb() for attributes,geometry in group])
+            bounds=(geometry.bounds() for attributes,geometry in group)
+            columns.append([dict(zip(bboxNames,b)) if b is not None else None for b in bounds])
+            writer.write_table(pa.Table.from_arrays(columns,schema=schema))
+            count += len(group)
+    return count
+
+def writeGeoTiff( filename, raster, blocks, labels=None, crs=None, nodata=-1 ):
+    '''
+    Write a classified raster as a GeoTIFF.  raster is the
+    ClassifyEngine.ClassifyRaster defining the geotransform and size,
+    blocks an iterable of (row, array) blocks of class indices as
+    generated by ClassifyEngine.rasterBlocks, so the raster is written a
+    block at a time without being held in memory.  labels are the class
+    names.  Returns the number of rows written.
+    '''
+    try:
+        from osgeo import gdal, osr
+    except ImportError:
+        raise ClassifyWriterError("GeoTIFF output requires the GDAL python bindings")
+    gdal.UseExceptions()
+    datatype=gdal.GDT_Int16
+    if labels is not None and len(labels) >= 32767:
+        datatype=gdal.GDT_Int32
+    driver=gdal.GetDriverByName('GTiff')
+    ds=driver.Create(filename,raster.ncols,raster.nrows,1,datatype,
+                     ['TILED=YES','COMPRESS=DEFLATE'])
+    if ds is None:
+        raise ClassifyWriterError("Cannot create {0}".format(filename))
+    nrows=0
+    try:
+        ds.SetGeoTransform([float(v) for v in raster.geotransform])
+        if crs:
+            srs=osr.SpatialReference()
+            srs.SetFromUserInput(crs)
+            ds.SetProjection(srs.ExportToWkt())
+        band=ds.GetRasterBand(1)
+        band.SetNoDataValue(nodata)
+        if labels:
+            band.SetCategoryNames(list(labels))
+        for row,block in blocks:
+            band.WriteArray(block,0,row)
+            nrows += block.shape[0]
+        band.FlushCache()
+    finally:
+        ds=None
+    return nrows
+
+writers={
+    '.geojson': writeGeoJson,
+    '.json': writeGeoJson,
+    '.csv': writeCsv,
+    '.gpkg': writeGeoPackage,
+    '.parquet': writeGeoParquet,
+    }
+
+def writerForFile( filename ):
+    ext=os.path.splitext(filename)[1].lower()
+    if ext not in writers:
+        raise ClassifyWriterError("Cannot write {0} files - must be one of {1}"
+                                  .format(ext,', '.join(writers)))
+    return writers[ext]
+
+rasterWriters={
+    '.tif': writeGeoTiff,
+    '.tiff': writeGeoTiff,
+    }
+
+def rasterWriterForFile( filename ):
+    ext=os.path.splitext(filename)[1].lower()
+    if ext not in rasterWriters:
+        raise ClassifyWriterError("Cannot write {0} raster files - must be one of {1}"
+                                  .format(ext,', '.join(rasterWriters)))
+    return rasterWriters[ext]
@@ -0,0 +1,4 @@
+from .ClassifyCli import main
+import sys
+
+sys.exit(main())
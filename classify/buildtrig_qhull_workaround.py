@@ -0,0 +1,15 @@
+'''
+Builds a triangulation in a separate python process, as qhull fails when
+called from within QGIS python on some platforms.
+
+Usage: python buildtrig_qhull_workaround.py xyfile.npy trianglefile.npy
+'''
+
+import sys
+import numpy as np
+from matplotlib.tri import Triangulation
+
+if __name__ == '__main__':
+    xy=np.load(sys.argv[1])
+    trig=Triangulation(xy[0],xy[1])
+    np.save(sys.argv[2],trig.triangles)
@@ -0,0 +1,54 @@
+'''
+Shared fixtures for the equivalence tests.  Each test runs over the
+synthetic datasets from benchmarks.datasets, and over any recorded
+datasets (files readable by classify.ClassifyCli.readPoints) in
+tests/data or in the directories listed in the CLASSIFY_TEST_DATA
+environment variable.
+'''
+
+import glob
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0,ROOT)
+
+from benchmarks.datasets import makeDataset
+
+# Points in each synthetic dataset - large enough to exercise grid
+# detection and polygon assembly, small enough to keep the tests quick
+DatasetSize=3000
+
+SyntheticDatasets=['grid','rotated','uniform','clustered','duplicates']
+
+def recordedDatasets():
+    dirs=[os.path.join(os.path.dirname(__file__),'data')]
+    dirs.extend(d for d in os.environ.get('CLASSIFY_TEST_DATA','').split(os.pathsep) if d)
+    files=[]
+    for d in dirs:
+        for ext in ('*.csv','*.npy','*.npz'):
+            files.extend(sorted(glob.glob(os.path.join(d,ext))))
+    return files
+
+def loadDataset( name ):
+    '''
+    x, y, z arrays of a synthetic dataset name or a recorded dataset file
+    '''
+    if name in SyntheticDatasets:
+        return makeDataset(name,DatasetSize,seed=1)
+    from classify.ClassifyCli import readPoints
+    x,y,z=readPoints(name)
+    return (np.asarray(x,dtype=np.float64),np.asarray(y,dtype=np.float64),
+            np.asarray(z,dtype=np.float64))
+
+@pytest.fixture(params=SyntheticDatasets+recordedDatasets(),
+                ids=lambda name: os.path.basename(name))
+def dataset( request ):
+    '''
+    (name, x, y, z) of each synthetic and recorded dataset
+    '''
+    return (request.param,)+tuple(loadDataset(request.param))
@@ -0,0 +1,120 @@
+'''
+Comparison of classification results from a reference engine and an
+alternative (faster) one.  Levels and attributes are compared exactly,
+geometries either exactly (by WKB) or within a tolerance, measured as
+the symmetric difference area relative to the reference area for
+polygons and the Hausdorff distance for both lines and polygons.
+'''
+
+import numpy as np
+import shapely
+from shapely.geometry import MultiLineString, MultiPolygon
+
+from classify.ClassifyEngine import ClassifyEngine, ClassifyGeometry, relativeCoordinates
+
+def makeEngine( x, y, z, classifyType='filled', method='equal', ncontour=8,
+                float32=False, **settings ):
+    '''
+    Engine for x, y, z with coordinates relative to the data centre (as
+    the plugin loads them) and the given settings, each the name of a
+    setter without "set" and its argument, eg useGrid=False
+    '''
+    x,y,origin=relativeCoordinates(x,y,float32)
+    engine=ClassifyEngine(x,y,z,origin=origin)
+    engine.setClassifyMethod(method,{'ncontour':ncontour,'maxcontour':ncontour})
+    engine.setClassifyType(classifyType)
+    for name,value in settings.items():
+        setter=getattr(engine,'set'+name[0].upper()+name[1:])
+        if isinstance(value,tuple):
+            setter(*value)
+        else:
+            setter(value)
+    return engine
+
+def meanSpacing( x, y ):
+    return float(np.sqrt((np.max(x)-np.min(x))*(np.max(y)-np.min(y))/len(x)))
+
+def shapelyGeometry( geom ):
+    '''
+    shapely geometry of a ClassifyGeometry, built from its parts rather
+    than its WKB
+    '''
+    if geom.type == ClassifyGeometry.line:
+        return MultiLineString([np.asarray(line,dtype=np.float64) for line in geom.parts()])
+    return MultiPolygon([(np.asarray(rings[0],dtype=np.float64),
+                          [np.asarray(r,dtype=np.float64) for r in rings[1:]])
+                         for rings in geom.parts()])
+
+def featureKey( feature ):
+    return (feature.index,feature.lod)
+
+def assertLevelsEqual( reference, alternative ):
+    reference=np.asarray(reference)
+    alternative=np.asarray(alternative)
+    assert reference.shape == alternative.shape
+    assert np.array_equal(reference,alternative), \
+        'levels differ: {0} != {1}'.format(reference,alternative)
+
+def assertAttributesEqual( refEngine, reference, altEngine, alternative ):
+    '''
+    Same features (by index and level of detail) in the same order with
+    the same attribute values
+    '''
+    assert [featureKey(f) for f in reference] == [featureKey(f) for f in alternative]
+    assert refEngine.fieldDefs() == altEngine.fieldDefs()
+    for ref,alt in zip(reference,alternative):
+        assert refEngine.featureAttributes(ref) == altEngine.featureAttributes(alt)
+
+def assertFeaturesIdentical( refEngine, reference, altEngine, alternative ):
+    '''
+    Same attributes and byte for byte identical geometries
+    '''
+    assertAttributesEqual(refEngine,reference,altEngine,alternative)
+    for ref,alt in zip(reference,alternative):
+        assert ref.geometry.wkb() == alt.geometry.wkb(), \
+            'geometry of feature {0} differs'.format(featureKey(ref))
+
+def geometryDifference( reference, alternative ):
+    '''
+    Returns (relative area, hausdorff) comparing shapely geometries,
+    where relative area is the symmetric difference area divided by the
+    reference area (0 for lines)
+    '''
+    if reference.is_empty or alternative.is_empty:
+        return (0.0,0.0) if reference.is_empty == alternative.is_empty else (np.inf,np.inf)
+    hausdorff=shapely.hausdorff_distance(reference,alternative)
+    area=0.0
+    if reference.geom_type == 'MultiPolygon':
+        reference=shapely.make_valid(reference)
+        alternative=shapely.make_valid(alternative)
+        area=reference.symmetric_difference(alternative).area/max(reference.area,1e-300)
+    return area,hausdorff
+
+def isDegenerate( geom ):
+    '''
+    True for geometries with no area (polygons) or length (lines), such
+    as contours at the data minimum, which paths may or may not return
+    '''
+    return geom.is_empty or (geom.area == 0.0 if geom.geom_type == 'MultiPolygon' else geom.length == 0.0)
+
+def assertFeaturesEquivalent( refEngine, reference, altEngine, alternative,
+                              areaTolerance, distanceTolerance, minArea=0.0 ):
+    '''
+    Same attributes, and geometries within distanceTolerance (Hausdorff)
+    and areaTolerance (relative symmetric difference area), ignoring
+    degenerate features.  Features with a reference area less than
+    minArea are only compared by distance, as small polygons have large
+    relative differences.
+    '''
+    reference=[(f,shapelyGeometry(f.geometry)) for f in reference]
+    alternative=[(f,shapelyGeometry(f.geometry)) for f in alternative]
+    reference=[(f,g) for f,g in reference if not isDegenerate(g)]
+    alternative=[(f,g) for f,g in alternative if not isDegenerate(g)]
+    assertAttributesEqual(refEngine,[f for f,g in reference],altEngine,[f for f,g in alternative])
+    for (ref,refGeom),(alt,altGeom) in zip(reference,alternative):
+        area,distance=geometryDifference(refGeom,altGeom)
+        assert distance <= distanceTolerance, \
+            'feature {0} Hausdorff distance {1} > {2}'.format(featureKey(ref),distance,distanceTolerance)
+        if refGeom.area >= minArea:
+            assert area <= areaTolerance, \
+                'feature {0} area difference {1} > {2}'.format(featureKey(ref),area,areaTolerance)
@@ -0,0 +1,412 @@
+'''
+Tests of the ClassifyEngine calculation path planner and memory budget.
+'''
+
+import numpy as np
+import pytest
+
+from benchmarks.datasets import makeDataset
+from classify import ClassifyEngine as Engine
+from classify import ClassifyUtils
+from classify.ClassifyEngine import (
+    ClassifyEngine,
+    ClassifyError,
+    ClassifyInterpolation,
+    ClassifyPath,
+    )
+from classify.ClassifyStats import ClassifyStats
+from conftest import loadDataset
+from equivalence import makeEngine
+
+def _triangulationBudget( engine, fraction ):
+    # Budget allowing for the data and fraction of the triangulation
+    return engine.dataMemory()+int(fraction*engine._stageMemory('triangulation'))
+
+@pytest.mark.parametrize('path',[ClassifyPath.triangulation,ClassifyPath.interpolation])
+def test_plan_selected_path( path ):
+    x,y,z=loadDataset('uniform')
+    engine=makeEngine(x,y,z,calculationPath=path,interpolation=ClassifyInterpolation.linear)
+    plan=engine.plan()
+    assert plan.path == path
+    assert plan.reason == 'selected'
+    assert plan.interpolation == (ClassifyInterpolation.linear if path == ClassifyPath.interpolation
+                                  else ClassifyInterpolation.none)
+    assert engine.usesGrid() == (path == ClassifyPath.interpolation)
+
+def test_plan_selected_grid_path_needs_gridded_data():
+    x,y,z=loadDataset('uniform')
+    engine=makeEngine(x,y,z,calculationPath=ClassifyPath.grid)
+    with pytest.raises(ClassifyError):
+        engine.plan()
+
+@pytest.mark.parametrize('name',['grid','rotated'])
+def test_plan_gridded_data( name ):
+    x,y,z=loadDataset(name)
+    plan=makeEngine(x,y,z).plan()
+    assert plan.path == ClassifyPath.grid
+    assert plan.reason == 'data on a regular grid'
+    # Unless the grid is not used
+    plan=makeEngine(x,y,z,useGrid=False).plan()
+    assert plan.path == ClassifyPath.triangulation
+
+def test_plan_interpolation_method_set():
+    x,y,z=loadDataset('clustered')
+    plan=makeEngine(x,y,z,interpolation=ClassifyInterpolation.linear).plan()
+    assert plan.path == ClassifyPath.interpolation
+    assert plan.interpolation == ClassifyInterpolation.linear
+    assert plan.reason == 'interpolation method set'
+
+def test_plan_triangulation_without_tolerance():
+    x,y,z=loadDataset('clustered')
+    plan=makeEngine(x,y,z).plan()
+    assert plan.path == ClassifyPath.triangulation
+    assert plan.costs[ClassifyPath.triangulation] > 0
+    if Engine.idwAvailable():
+        assert plan.reason == 'no interpolation tolerance set'
+        assert plan.costs[ClassifyPath.interpolation] > 0
+    else:
+        assert plan.costs[ClassifyPath.interpolation] is None
+
+def test_plan_cheaper_interpolation_within_tolerance():
+    pytest.importorskip('scipy')
+    x,y,z=loadDataset('uniform')
+    engine=makeEngine(x,y,z)
+    # A cell size within the tolerance is only used if it is cheaper
+    engine.setCalculationPath(ClassifyPath.auto,1.0e9)
+    plan=engine.plan()
+    trigCost=plan.costs[ClassifyPath.triangulation]
+    idwCost=plan.costs[ClassifyPath.interpolation]
+    expected=ClassifyPath.interpolation if idwCost < trigCost else ClassifyPath.triangulation
+    assert plan.path == expected
+    assert plan.reason == 'lowest estimated cost'
+    engine.setCalculationPath(ClassifyPath.auto,1.0e-9)
+    plan=engine.plan()
+    assert plan.path == ClassifyPath.triangulation
+    assert plan.reason == 'interpolation cell size exceeds tolerance'
+
+def test_plan_triangulation_over_budget_interpolates():
+    pytest.importorskip('scipy')
+    x,y,z=loadDataset('uniform')
+    engine=makeEngine(x,y,z)
+    engine.setMemoryBudget(_triangulationBudget(engine,0.5))
+    plan=engine.plan()
+    assert plan.path == ClassifyPath.interpolation
+    assert plan.interpolation == ClassifyInterpolation.idw
+    assert plan.reason == 'triangulation exceeds the memory budget'
+    assert plan.costs[ClassifyPath.triangulation] is None
+    assert len(list(engine.features())) > 0
+
+def test_plan_no_path_within_budget():
+    # Neither the triangulation nor an interpolation grid (or without
+    # scipy, no interpolation at all) fits.  Grid detection is turned off
+    # as it would fail first.
+    x,y,z=loadDataset('uniform')
+    engine=makeEngine(x,y,z,useGrid=False)
+    engine.setMemoryBudget(engine.dataMemory()+1000)
+    with pytest.raises(ClassifyError,match='Triangulation needs about'):
+        engine.plan()
+    with pytest.raises(ClassifyError):
+        list(engine.features())
+    # The plan is remade when the budget changes
+    engine.setMemoryBudget(None)
+    assert engine.plan().path == ClassifyPath.triangulation
+
+def test_memory_estimate():
+    x,y,z=loadDataset('uniform')
+    npt=len(z)
+    engine=makeEngine(x,y,z,method='quantile')
+    data=engine.dataMemory()
+    assert data == 3*8*npt
+    perPoint=ClassifyEngine.MemoryPerPoint
+    assert engine.memoryEstimate() == {
+        'data': data,
+        'grid': data+npt*perPoint['grid'],
+        'levels': data+npt*perPoint['quantile'],
+        'triangulation': data+npt*perPoint['triangulation'],
+        'contour': data+npt*perPoint['contour'],
+        }
+    # Interpolating replaces the triangulation with the grid
+    engine.setInterpolation(ClassifyInterpolation.linear)
+    xmin,ymin,cellSize,nrows,ncols=engine._interpolationShape(ClassifyInterpolation.linear)
+    estimate=engine.memoryEstimate()
+    assert 'triangulation' not in estimate
+    assert estimate['interpolation'] == (data+nrows*ncols*ClassifyEngine.MemoryPerCell
+                                         +npt*perPoint['triangulation'])
+
+def test_memory_budget_error_message():
+    x,y,z=loadDataset('uniform')
+    engine=makeEngine(x,y,z,calculationPath=ClassifyPath.triangulation)
+    needed=engine.dataMemory()+engine._stageMemory('triangulation')
+    engine.setMemoryBudget(needed-1)
+    message='Triangulation needs about {0:.0f}MB, more than the memory budget of {1:.0f}MB'.format(
+        needed/1048576.0,(needed-1)/1048576.0)
+    with pytest.raises(ClassifyError) as excinfo:
+        list(engine.features())
+    assert excinfo.value.message() == message
+    # The stage is run if it fits
+    engine.setMemoryBudget(needed)
+    assert len(list(engine.features())) > 0
+
+def test_memory_budget_samples_levels():
+    # Levels are calculated from a sample of the values first, as that
+    # needs the least memory
+    x,y,z=makeDataset('uniform',60000,seed=2)
+    stats=ClassifyStats()
+    engine=ClassifyEngine(x,y,z,stats=stats)
+    engine.setClassifyMethod('quantile',{'ncontour':5})
+    full=np.array(engine.levels())
+    assert stats.counter('level sample') == 0
+    budget=engine.dataMemory()+len(z)*ClassifyEngine.MemoryPerPoint['quantile']//2
+    engine.setMemoryBudget(budget)
+    sampled=np.array(engine.levels())
+    nsample=stats.counter('level sample')
+    assert ClassifyEngine.MinLevelSample <= nsample < len(z)
+    assert engine.dataMemory()+nsample*ClassifyEngine.MemoryPerPoint['quantile'] <= budget+2*16
+    # The sample includes the extremes
+    assert sampled[0] == full[0] and sampled[-1] == full[-1]
+    assert np.allclose(sampled,full,atol=0.02*(full[-1]-full[0]))
+
+def test_memory_budget_coarsens_interpolation_grid():
+    # If the triangulation does not fit the data are interpolated, on a
+    # coarser grid if the grid at the point spacing does not fit even
+    # when queried a row at a time.  Grid detection is turned off as it
+    # needs more memory than the coarsened grid.
+    pytest.importorskip('scipy')
+    x,y,z=loadDataset('uniform')
+    idw=ClassifyInterpolation.idw
+    engine=makeEngine(x,y,z,useGrid=False)
+    xmin,ymin,spacing,nrows,ncols=engine._interpolationShape(idw)
+    rowMemory=engine._interpolationMemory(nrows,ncols,idw,ncols)
+    budget=engine.dataMemory()+int(0.9*rowMemory)
+    assert budget < _triangulationBudget(engine,1.0)
+    engine.setMemoryBudget(budget)
+    plan=engine.plan()
+    assert plan.path == ClassifyPath.interpolation
+    cellSize=engine._interpolationShape(idw)[2]
+    assert spacing < cellSize <= spacing*ClassifyEngine.MaxCellSizeFactor
+    estimate=engine.memoryEstimate()
+    assert all(memory <= budget for stage,memory in estimate.items() if stage != 'grid')
+    assert len(list(engine.features())) > 0
+    # A cell size that is set is not changed
+    engine.setInterpolation(idw,spacing)
+    with pytest.raises(ClassifyError,match='Interpolation needs about'):
+        engine.interpolatedGrid()
+
+def test_memory_budget_reduces_interpolation_batches():
+    pytest.importorskip('scipy')
+    x,y,z=loadDataset('uniform')
+    idw=ClassifyInterpolation.idw
+    engine=makeEngine(x,y,z,interpolation=idw)
+    nrows,ncols=engine._interpolationShape(idw)[3:]
+    full=engine._interpolationBatchSize(nrows,ncols,idw)
+    assert full == ClassifyEngine.InterpolationBatchSize
+    # Budget for the grid and kd-tree and a few rows of neighbours
+    oneNode=engine._interpolationMemory(nrows,ncols,idw,1)
+    perNode=min(engine._idwNeighbours,len(z))*ClassifyEngine.MemoryPerNeighbour
+    engine.setMemoryBudget(engine.dataMemory()+oneNode+3*ncols*perNode)
+    batchSize=engine._interpolationBatchSize(nrows,ncols,idw)
+    assert batchSize == 3*ncols
+    # The batches are reduced before the grid is coarsened
+    assert engine._interpolationShape(idw)[3:] == (nrows,ncols)
+    assert np.isfinite(engine.interpolatedGrid()[2]).any()
+
+def _plane( x, y ):
+    return 0.013*x+0.031*y+0.1
+
+def _rasterArray( engine, raster, blockRows=7 ):
+    array=np.full((raster.nrows,raster.ncols),-2,dtype=np.int32)
+    for row,block in engine.rasterBlocks(raster,blockRows=blockRows):
+        array[row:row+block.shape[0]]=block
+    return array
+
+def _pixelCentres( raster ):
+    x0,dxcol,dxrow,y0,dycol,dyrow=raster.geotransform
+    col,row=np.meshgrid(np.arange(raster.ncols)+0.5,np.arange(raster.nrows)+0.5)
+    return x0+col*dxcol+row*dxrow,y0+col*dycol+row*dyrow
+
+def _assertRasterClasses( engine, raster, array ):
+    # The class of each pixel is that of the plane at its centre, where
+    # the value is not too close to a level to be sure of its class
+    px,py=_pixelCentres(raster)
+    pz=_plane(px,py)
+    expected=engine.classIndex(pz)
+    levels=engine.levels()
+    clear=np.min(np.abs(pz[...,None]-levels),axis=-1) > 1.0e-6
+    defined=array >= 0
+    assert defined.sum() > 0.5*array.size
+    assert np.array_equal(array[defined & clear],expected[defined & clear])
+
+@pytest.mark.parametrize('name',['grid','rotated','uniform'])
+def test_raster_north_up( name ):
+    x,y,z=loadDataset(name)
+    engine=makeEngine(x,y,_plane(x,y),classifyType='raster')
+    raster=engine.rasterDefinition()
+    x0,dxcol,dxrow,y0,dycol,dyrow=raster.geotransform
+    assert dxcol > 0 and dyrow < 0
+    assert abs(dycol) < dxcol and abs(dxrow) < -dyrow
+    _assertRasterClasses(engine,raster,_rasterArray(engine,raster))
+
+@pytest.mark.parametrize('flip',['rows','columns','transpose'])
+def test_raster_grid_orientation( flip ):
+    # However the grid points are ordered the raster is north up, and
+    # for a grid the pixel centres are the grid points
+    gx,gy=np.meshgrid(np.arange(12)*10.0+1000.0,np.arange(9)*10.0+5000.0)
+    if flip == 'rows':
+        gx,gy=gx[::-1],gy[::-1]
+    elif flip == 'columns':
+        gx,gy=gx[:,::-1],gy[:,::-1]
+    else:
+        gx,gy=gx.T,gy.T
+    x,y=gx.ravel(),gy.ravel()
+    engine=makeEngine(x,y,_plane(x,y),classifyType='raster',ncontour=5)
+    assert engine.plan().path == ClassifyPath.grid
+    raster=engine.rasterDefinition()
+    assert (raster.nrows,raster.ncols) == (9,12)
+    assert np.allclose(raster.geotransform,(995.0,10.0,0.0,5085.0,0.0,-10.0))
+    array=_rasterArray(engine,raster)
+    # The top row is the north edge, with the highest values
+    assert np.array_equal(array[0],engine.classIndex(_plane(np.arange(12)*10.0+1000.0,5080.0)))
+    assert array[0,-1] == array.max() and array[-1,0] == array.min()
+    _assertRasterClasses(engine,raster,array)
+
+def _referenceIdw( x, y, z, qx, qy, k, power ):
+    dist=np.hypot(x[None,:]-qx[:,None],y[None,:]-qy[:,None])
+    nearest=np.argsort(dist,axis=1,kind='stable')[:,:k]
+    d=np.take_along_axis(dist,nearest,axis=1)
+    with np.errstate(divide='ignore'):
+        w=1.0/d**power
+    exact=d[:,0] == 0.0
+    w[exact]=0.0
+    w[exact,0]=1.0
+    return np.sum(w*z[nearest],axis=1)/np.sum(w,axis=1),d[:,0]
+
+def test_idw_interpolation():
+    pytest.importorskip('scipy')
+    x,y,z=loadDataset('clustered')
+    engine=makeEngine(x,y,z,interpolation=(ClassifyInterpolation.idw,None,2.0,6))
+    plan=engine.plan()
+    assert (plan.path,plan.interpolation) == (ClassifyPath.interpolation,ClassifyInterpolation.idw)
+    gx,gy,gz=engine.interpolatedGrid()
+    ex,ey,ez=engine.data()
+    cellSize=gx[0,1]-gx[0,0]
+    spacing=np.sqrt((ex.max()-ex.min())*(ey.max()-ey.min())/len(ex))
+    expected,nearest=_referenceIdw(ex,ey,ez,gx.ravel(),gy.ravel(),6,2.0)
+    # Nodes further than the maximum distance from any point are not set
+    far=nearest > 2.0*max(cellSize,spacing)
+    assert far.any() and not far.all()
+    assert np.all(np.isnan(gz.ravel()[far]))
+    assert np.allclose(gz.ravel()[~far],expected[~far],rtol=1e-12,atol=1e-9)
+    # Querying in batches gives the same grid
+    batched=makeEngine(x,y,z,interpolation=(ClassifyInterpolation.idw,None,2.0,6))
+    batched.InterpolationBatchSize=3*gz.shape[1]+1
+    assert np.array_equal(batched.interpolatedGrid()[2],gz,equal_nan=True)
+    assert len(list(engine.features())) > 0
+
+def test_idw_interpolation_at_points():
+    # Nodes at data points take their values
+    pytest.importorskip('scipy')
+    gx,gy=np.meshgrid(np.arange(10)*5.0,np.arange(8)*5.0)
+    x,y=gx.ravel(),gy.ravel()
+    z=np.sin(x)+np.cos(y)
+    engine=makeEngine(x,y,z,calculationPath=ClassifyPath.interpolation,
+                      interpolation=(ClassifyInterpolation.idw,5.0))
+    assert np.allclose(engine.interpolatedGrid()[2],z.reshape(gx.shape),rtol=0.0,atol=1e-12)
+
+@pytest.mark.parametrize('settings',[
+    {'interpolation': ClassifyInterpolation.idw},
+    {'calculationPath': ClassifyPath.interpolation},
+    ])
+def test_idw_requires_scipy_when_planned( monkeypatch, settings ):
+    # Without scipy a plan using IDW fails when it is made, not after
+    # the path is chosen
+    monkeypatch.setattr(Engine,'idwAvailable',lambda: False)
+    x,y,z=loadDataset('uniform')
+    engine=makeEngine(x,y,z,**settings)
+    with pytest.raises(ClassifyError,match='IDW interpolation requires the python scipy module'):
+        engine.plan()
+    # Linear interpolation does not need scipy
+    engine.setInterpolation(ClassifyInterpolation.linear)
+    assert engine.plan().interpolation == ClassifyInterpolation.linear
+
+def test_idw_not_considered_without_scipy( monkeypatch ):
+    monkeypatch.setattr(Engine,'idwAvailable',lambda: False)
+    x,y,z=loadDataset('uniform')
+    engine=makeEngine(x,y,z,calculationPath=(ClassifyPath.auto,1.0e9))
+    plan=engine.plan()
+    assert plan.path == ClassifyPath.triangulation
+    assert plan.costs[ClassifyPath.interpolation] is None
+
+def _queryEngine( gridded, **settings ):
+    # z=x+2y over 0 <= x <= 10, 0 <= y <= 6, on a grid or scattered.
+    # The scattered points are a jittered grid with points along the
+    # edges, so that no triangles on the edges are masked as flat.
+    gx,gy=np.meshgrid(np.arange(11.0),np.arange(7.0))
+    if not gridded:
+        rng=np.random.default_rng(4)
+        interior=(gx > 0) & (gx < 10) & (gy > 0) & (gy < 6)
+        gx=gx+np.where(interior,rng.uniform(-0.3,0.3,gx.shape),0.0)
+        gy=gy+np.where(interior,rng.uniform(-0.3,0.3,gy.shape),0.0)
+    x,y=gx.ravel(),gy.ravel()
+    engine=makeEngine(x+500000.0,y+7000000.0,x+2.0*y,useGrid=gridded,**settings)
+    engine.setClassifyLevels([2.0,5.0,10.0,15.0,22.0])
+    engine.setClassifyExtendOption('neither')
+    return engine
+
+@pytest.mark.parametrize('gridded',[True,False])
+def test_point_values( gridded ):
+    engine=_queryEngine(gridded)
+    assert engine.usesGrid() == gridded
+    rng=np.random.default_rng(8)
+    qx=rng.uniform(0.0,10.0,2000)
+    qy=rng.uniform(0.0,6.0,2000)
+    values=engine.pointValues(qx+500000.0,qy+7000000.0)
+    assert np.allclose(values,qx+2.0*qy,rtol=0.0,atol=1e-8)
+    # Points on the corners and edges of the data are inside
+    qx=np.array([0.0,10.0,10.0,0.0,5.0,10.0,3.5,0.0])
+    qy=np.array([0.0,0.0,6.0,6.0,0.0,2.5,6.0,4.25])
+    values=engine.pointValues(qx+500000.0,qy+7000000.0)
+    assert np.allclose(values,qx+2.0*qy,rtol=0.0,atol=1e-8)
+    # Points outside are nan
+    qx=np.array([-0.1,10.1,5.0,5.0,-100.0])
+    qy=np.array([3.0,3.0,-0.1,6.1,-100.0])
+    assert np.all(np.isnan(engine.pointValues(qx+500000.0,qy+7000000.0)))
+
+@pytest.mark.parametrize('gridded',[True,False])
+def test_classify_points( gridded ):
+    # Classes are the filled ranges including their lower level, the
+    # last including its upper level.  Points outside the data or the
+    # levels have no class.  The points with values on a level are data
+    # points, so their interpolated values are exact.
+    engine=_queryEngine(gridded)
+    qx=np.array([0.0,2.0,4.0,5.0,6.0,10.0,9.0,0.5,3.0,-1.0])
+    qy=np.array([1.0,0.0,3.0,0.0,4.5,6.0,6.0,0.0,0.5,3.0])
+    # Values            2, 2, 10, 5, 15, 22, 21, 0.5, 4, outside
+    expected=np.array([0,0,2,1,3,3,3,-1,0,-1])
+    assert np.array_equal(engine.classifyPoints(qx+500000.0,qy+7000000.0),expected)
+    assert np.array_equal(engine.classifyPoints(qx+500000.0,qy+7000000.0,nodata=-99),
+                          np.where(expected < 0,-99,expected))
+    # Extending below the lowest level adds a class for lower values
+    engine.setClassifyExtendOption('both')
+    classes=engine.classifyPoints(qx+500000.0,qy+7000000.0)
+    assert np.array_equal(classes,[1,1,3,2,4,5,4,0,1,-1])
+    # Classes are the filled feature indices
+    labels=engine.classLabels()
+    features=list(engine.features())
+    assert len(features) > 0
+    for feature in features:
+        assert feature.label == labels[feature.index]
+
+@pytest.mark.parametrize('gridded',[True,False])
+def test_source_point_classes( gridded ):
+    # Source points are tagged with the class of their own value, which
+    # is the class the query gives at their location
+    engine=_queryEngine(gridded)
+    x,y,z=engine.data()
+    x0,y0=engine._origin
+    classes=engine.classIndex(z)
+    assert np.array_equal(classes,engine.classifyPoints(x+x0,y+y0))
+    assert np.array_equal(classes,ClassifyUtils.classIndex([2.0,5.0,10.0,15.0,22.0],z))
+    # Values on each level are in the class above it, and the last
+    # level in the class below
+    assert np.array_equal(engine.classIndex(np.array([2.0,5.0,10.0,15.0,22.0,1.9,22.1,np.nan])),
+                          [0,1,2,3,3,-1,-1,-1])
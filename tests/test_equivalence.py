@@ -0,0 +1,276 @@
+'''
+Equivalence of the alternative (faster) calculation paths with the
+reference path on each dataset.
+'''
+
+import json
+
+import numpy as np
+import pytest
+import shapely
+
+from classify import ClassifyEngine
+from classify import ClassifyMethod
+from classify import ClassifyUtils
+from classify import ClassifyWriters
+from classify.ClassifyEngine import ClassifyPath, ClassifyType
+from classify.DataGridder import DataGridder
+from benchmarks.datasets import makeDataset
+from conftest import loadDataset
+from equivalence import (
+    assertAttributesEqual,
+    assertFeaturesEquivalent,
+    assertFeaturesIdentical,
+    assertLevelsEqual,
+    makeEngine,
+    meanSpacing,
+    shapelyGeometry,
+    )
+
+ContourTypes=[ClassifyType.line,ClassifyType.filled,ClassifyType.layer]
+
+@pytest.mark.parametrize('classifyType',ContourTypes)
+def test_pipelined_matches_serial( dataset, classifyType ):
+    name,x,y,z=dataset
+    engine=makeEngine(x,y,z,classifyType,levelsOfDetail=2)
+    reference=list(engine.features())
+    alternative=list(engine.pipelinedFeatures(3,queueSize=1))
+    assertFeaturesIdentical(engine,reference,engine,alternative)
+
+@pytest.mark.parametrize('classifyType',ContourTypes)
+def test_float32_matches_float64( dataset, classifyType ):
+    # Rounding can change the triangulation of near duplicate points, so
+    # they are discarded first
+    name,x,y,z=dataset
+    spacing=meanSpacing(x,y)
+    index=ClassifyUtils.discardDuplicatePoints(x,y,0.1*spacing)
+    x,y,z=x[index],y[index],z[index]
+    refEngine=makeEngine(x,y,z,classifyType)
+    altEngine=makeEngine(x,y,z,classifyType,float32=True)
+    assertLevelsEqual(refEngine.levels(),altEngine.levels())
+    assertFeaturesEquivalent(refEngine,list(refEngine.features()),
+                             altEngine,list(altEngine.features()),
+                             areaTolerance=1e-4,distanceTolerance=0.01*spacing,
+                             minArea=spacing**2)
+
+@pytest.mark.parametrize('classifyType',ContourTypes)
+def test_grid_matches_triangulation( classifyType ):
+    # Contouring cells rather than triangles only moves contours within
+    # a cell
+    x,y,z=loadDataset('grid')
+    refEngine=makeEngine(x,y,z,classifyType,calculationPath=ClassifyPath.triangulation)
+    altEngine=makeEngine(x,y,z,classifyType,calculationPath=ClassifyPath.grid)
+    assertLevelsEqual(refEngine.levels(),altEngine.levels())
+    spacing=meanSpacing(x,y)
+    assertFeaturesEquivalent(refEngine,list(refEngine.features()),
+                             altEngine,list(altEngine.features()),
+                             areaTolerance=0.02,distanceTolerance=spacing,
+                             minArea=100*spacing**2)
+
+def _referenceDiscard( x, y, resolution ):
+    # One point per cell, the last in input order, for each of the four
+    # half cell offsets of the grid
+    index=np.arange(len(x))
+    x0,y0=np.min(x),np.min(y)
+    for dx,dy in ((0,0),(0.5,0),(0,0.5),(0.5,0.5)):
+        cells={}
+        for i in index:
+            cell=(int((x[i]-x0-dx*resolution)/resolution),int((y[i]-y0-dy*resolution)/resolution))
+            cells[cell]=i
+        index=np.array([cells[c] for c in sorted(cells)])
+    return index
+
+def test_dedup_matches_reference():
+    x,y,z=loadDataset('duplicates')
+    x,y,z=x[:1000],y[:1000],z[:1000]
+    resolution=20.0
+    reference=_referenceDiscard(x,y,resolution)
+    alternative=ClassifyUtils.discardDuplicatePoints(x,y,resolution)
+    assert np.array_equal(reference,alternative)
+
+def test_engine_dedup_matches_utils( dataset ):
+    # The engine holds coordinates relative to the data centre, which
+    # can round points on cell boundaries differently from absolute ones
+    name,x,y,z=dataset
+    tolerance=0.1*meanSpacing(x,y)
+    engine=makeEngine(x,y,z)
+    rx,ry,rz=engine.data()
+    index=ClassifyUtils.discardDuplicatePoints(rx,ry,tolerance)
+    if len(index) == len(rz):
+        # The data are left in their original order if none are discarded
+        index=np.arange(len(rz))
+    engine.discardDuplicatePoints(tolerance)
+    ex,ey,ez=engine.data()
+    assert np.array_equal(ez,z[index])
+    assert np.array_equal(ex,rx[index])
+    assert np.array_equal(ey,ry[index])
+
+@pytest.mark.parametrize('name',['grid','rotated'])
+def test_grid_detection( name ):
+    x,y,z=loadDataset(name)
+    shape,order=DataGridder(x,y).calcGrid()
+    assert shape is not None
+    assert shape[0]*shape[1] == len(x)
+    if order is not None:
+        x,y=x[order],y[order]
+    gx=x.reshape(shape)
+    gy=y.reshape(shape)
+    # Rows and columns are straight lines of equally spaced points
+    for g in (gx,gy):
+        assert np.allclose(np.diff(g,axis=0),np.diff(g,axis=0)[0],atol=1e-6)
+        assert np.allclose(np.diff(g,axis=1),np.diff(g,axis=1)[:,:1],atol=1e-6)
+
+@pytest.mark.parametrize('name',['uniform','clustered','duplicates'])
+def test_scattered_not_gridded( name ):
+    x,y,z=loadDataset(name)
+    assert DataGridder(x,y).calcGrid()[0] is None
+
+@pytest.mark.parametrize('method',['quantile','jenks','equal'])
+def test_level_cache_matches_calculation( dataset, method ):
+    name,x,y,z=dataset
+    engine=makeEngine(x,y,z,method=method)
+    reference=ClassifyMethod.calculateLevels(z,method,ncontour=8)
+    assertLevelsEqual(reference,engine.levels())
+    engine.setClassifyMethod('equal',{'ncontour':3})
+    engine.levels()
+    engine.setClassifyMethod(method,{'ncontour':8})
+    assertLevelsEqual(reference,engine.levels())
+    assertLevelsEqual(reference,engine.decimatedEngine(500).levels())
+
+def test_quantile_levels( dataset ):
+    name,x,y,z=dataset
+    engine=makeEngine(x,y,z,method='quantile')
+    assertLevelsEqual(np.percentile(z,np.linspace(0.0,100.0,9)),engine.levels())
+
+def test_wkb_matches_parts( dataset ):
+    name,x,y,z=dataset
+    for classifyType in ContourTypes:
+        engine=makeEngine(x,y,z,classifyType)
+        for feature in engine.features():
+            fromWkb=shapely.from_wkb(feature.geometry.wkb())
+            fromParts=shapelyGeometry(feature.geometry)
+            assert shapely.equals_exact(fromWkb,fromParts,tolerance=0.0)
+
+def test_levels_of_detail_within_tolerance( dataset ):
+    name,x,y,z=dataset
+    engine=makeEngine(x,y,z,ClassifyType.line,levelsOfDetail=3)
+    tolerances=engine.lodTolerances()
+    full={}
+    for feature in engine.features():
+        geom=shapelyGeometry(feature.geometry)
+        if feature.lod == 0:
+            full[feature.index]=geom
+            continue
+        # Each level is simplified from the one before, so errors add up
+        distance=shapely.hausdorff_distance(full[feature.index],geom)
+        assert distance <= sum(tolerances[1:feature.lod+1])*(1.0+1e-9)
+
+def test_geojson_writer_matches_features( dataset, tmp_path ):
+    name,x,y,z=dataset
+    engine=makeEngine(x,y,z,ClassifyType.filled)
+    features=list(engine.features())
+    fieldDefs=engine.fieldDefs()
+    filename=str(tmp_path/'output.geojson')
+    records=((engine.featureAttributes(f),f.geometry) for f in features)
+    ClassifyWriters.writerForFile(filename)(filename,records,fieldDefs,None)
+    with open(filename) as fh:
+        written=json.load(fh)['features']
+    assert len(written) == len(features)
+    names=[n for n,t in fieldDefs]
+    for feature,output in zip(features,written):
+        # GeoJSON has no infinite values, so open ranges are written as null
+        expected=[None if isinstance(v,float) and not np.isfinite(v) else v
+                  for v in engine.featureAttributes(feature)]
+        properties=output['properties']
+        assert [properties[n] for n in names] == expected
+        geom=shapely.geometry.shape(output['geometry'])
+        assert shapely.equals_exact(geom,shapelyGeometry(feature.geometry),tolerance=1e-6)
+
+def test_geoparquet_bbox_matches_geometry( dataset, tmp_path ):
+    pq=pytest.importorskip('pyarrow.parquet')
+    name,x,y,z=dataset
+    engine=makeEngine(x,y,z,ClassifyType.line)
+    features=list(engine.features())
+    filename=str(tmp_path/'output.parquet')
+    records=((engine.featureAttributes(f),f.geometry) for f in features)
+    ClassifyWriters.writeGeoParquet(filename,records,engine.fieldDefs(),rowGroupSize=3)
+    table=pq.read_table(filename)
+    for feature,bbox,wkb in zip(features,table.column('bbox').to_pylist(),
+                                table.column('geometry').to_pylist()):
+        bounds=shapely.from_wkb(wkb).bounds
+        if bbox is None:
+            assert feature.geometry.isEmpty()
+            continue
+        assert (bbox['xmin'],bbox['ymin'],bbox['xmax'],bbox['ymax']) == bounds
+
+def test_qgis_geometry_matches_engine( dataset ):
+    qgis=pytest.importorskip('qgis.core')
+    name,x,y,z=dataset
+    engine=makeEngine(x,y,z,ClassifyType.filled)
+    for feature in engine.features():
+        geom=qgis.QgsGeometry()
+        geom.fromWkb(feature.geometry.wkb())
+        reference=shapelyGeometry(feature.geometry)
+        assert geom.area() == pytest.approx(reference.area,rel=1e-9)
+        assert geom.constGet().nCoordinates() == feature.geometry.nVertices()
+
+@pytest.mark.parametrize('classifyType',[ClassifyType.line,ClassifyType.filled])
+def test_linear_interpolation_matches_triangulation( classifyType ):
+    # Interpolating the triangulation to a fine grid only moves contours
+    # within a grid cell, except where the grid cuts the data boundary
+    x,y,z=loadDataset('uniform')
+    spacing=meanSpacing(x,y)
+    cellSize=0.25*spacing
+    refEngine=makeEngine(x,y,z,classifyType)
+    altEngine=makeEngine(x,y,z,classifyType,interpolation=('linear',cellSize))
+    assertLevelsEqual(refEngine.levels(),altEngine.levels())
+    assertFeaturesEquivalent(refEngine,list(refEngine.features()),
+                             altEngine,list(altEngine.features()),
+                             areaTolerance=0.02,distanceTolerance=2*spacing,
+                             minArea=100*spacing**2)
+
+def test_sampled_quantiles_approximate_exact():
+    # Levels calculated from a sample to fit a memory budget
+    x,y,z=makeDataset('uniform',200000,seed=1)
+    refEngine=makeEngine(x,y,z,method='quantile')
+    altEngine=makeEngine(x,y,z,method='quantile')
+    altEngine.setMemoryBudget(altEngine.dataMemory()+altEngine.MinLevelSample*altEngine.MemoryPerPoint['quantile'])
+    reference=refEngine.levels()
+    alternative=altEngine.levels()
+    assert altEngine.statistics().asDict()['counters']['level sample'] < len(z)
+    assert alternative[0] == reference[0] and alternative[-1] == reference[-1]
+    # Sample quantiles are within a few standard errors in probability
+    probability=np.searchsorted(np.sort(z),alternative)/len(z)
+    assert np.allclose(probability,np.linspace(0.0,1.0,len(reference)),atol=0.02)
+
+def test_private_tricontour_api_available():
+    # Fails if a matplotlib release changes or removes the private
+    # TriContourGenerator, which would silently fall back to the slower
+    # public tricontour API
+    x,y,z=loadDataset('uniform')
+    engine=makeEngine(x,y,z)
+    trig,gz=engine.trigClassifyData()
+    if ClassifyEngine._matplotlibVersion() < ClassifyEngine.PrivateTriContourMinVersion:
+        pytest.skip('matplotlib older than the private contour API')
+    generator=ClassifyEngine._privateTriContourGenerator(trig,gz)
+    assert generator is not None, \
+        'private matplotlib TriContourGenerator not available in matplotlib '+ClassifyEngine.matplotlib.__version__
+    level=float(np.median(gz))
+    for vertices,codes in (generator.create_contour(level),
+                           generator.create_filled_contour(level,float(np.max(gz)))):
+        assert isinstance(vertices,list) and isinstance(codes,list)
+        assert len(vertices) == len(codes) > 0
+        for v,c in zip(vertices,codes):
+            assert v.ndim == 2 and v.shape[1] == 2 and len(c) == len(v)
+
+@pytest.mark.parametrize('classifyType',ContourTypes)
+def test_public_tricontour_matches_private( dataset, classifyType, monkeypatch ):
+    name,x,y,z=dataset
+    kwargs=dict(calculationPath=ClassifyPath.triangulation)
+    refEngine=makeEngine(x,y,z,classifyType,**kwargs)
+    reference=list(refEngine.features())
+    monkeypatch.setattr(ClassifyEngine,'_privateTriContourGenerator',lambda trig,z: None)
+    altEngine=makeEngine(x,y,z,classifyType,**kwargs)
+    spacing=meanSpacing(x,y)
+    assertFeaturesEquivalent(refEngine,reference,altEngine,list(altEngine.features()),
+                             areaTolerance=1e-6,distanceTolerance=1e-6*spacing)
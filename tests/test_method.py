@@ -0,0 +1,191 @@
+'''
+Tests of the level calculation methods in ClassifyMethod against
+reference calculations.
+'''
+
+import itertools
+
+import numpy as np
+import pytest
+
+from classify import ClassifyMethod
+from classify import ClassifyUtils
+from classify.ClassifyMethod import ClassifyMethodError
+from conftest import loadDataset
+from equivalence import makeEngine
+
+def _partitionCost( values, weights, ends ):
+    '''
+    Total within class weighted sum of squares of sorted values divided
+    into classes ending at the indices ends
+    '''
+    cost=0.0
+    start=0
+    for end in ends:
+        v=values[start:end+1]
+        w=weights[start:end+1]
+        cost += np.sum(w*(v-np.average(v,weights=w))**2)
+        start=end+1
+    return cost
+
+def _bruteForceCost( values, weights, nclass ):
+    '''
+    Lowest cost of all the partitions of sorted values into nclass
+    non-empty classes of consecutive values
+    '''
+    n=len(values)
+    return min(_partitionCost(values,weights,list(breaks)+[n-1])
+               for breaks in itertools.combinations(range(n-1),nclass-1))
+
+def _assertOptimal( cost, optimal, values ):
+    scale=max(1.0,float(np.sum((values-np.mean(values))**2)))
+    assert cost <= optimal+1.0e-9*scale
+
+@pytest.mark.parametrize('seed',range(20))
+def test_natural_breaks_optimal( seed ):
+    rng=np.random.default_rng(seed)
+    n=int(rng.integers(1,10))
+    values=np.sort(rng.normal(0.0,10.0,n))
+    weights=rng.integers(1,5,n).astype(float)
+    for nclass in range(1,n+1):
+        ends=ClassifyMethod._naturalBreaks(values,weights,nclass)
+        assert len(ends) == nclass
+        assert ends[-1] == n-1
+        assert np.all(np.diff(ends) > 0) and ends[0] >= 0
+        cost=_partitionCost(values,weights,ends)
+        _assertOptimal(cost,_bruteForceCost(values,weights,nclass),values)
+
+def _classesOf( z, levels ):
+    '''
+    Cost and number of classes of z classified by levels
+    '''
+    index=ClassifyUtils.classIndex(levels,z)
+    assert np.all(index >= 0)
+    cost=sum(np.sum((z[index == i]-np.mean(z[index == i]))**2) for i in np.unique(index))
+    return cost,len(np.unique(index))
+
+@pytest.mark.parametrize('seed',range(10))
+def test_jenks_levels_give_optimal_classes( seed ):
+    # Integer values have many ties, which must stay in the same class
+    rng=np.random.default_rng(seed)
+    z=rng.integers(0,8,int(rng.integers(5,40))).astype(float)
+    values,counts=np.unique(z,return_counts=True)
+    if len(values) < 2:
+        pytest.skip('constant data')
+    for ncontour in range(1,len(values)+3):
+        levels=ClassifyMethod.calcJenksContours(z,ncontour=ncontour)
+        nclass=min(ncontour,len(values))
+        assert len(levels) == nclass+1
+        assert levels[0] == values[0] and levels[-1] == values[-1]
+        cost,nfound=_classesOf(z,levels)
+        assert nfound == nclass
+        _assertOptimal(cost,_bruteForceCost(values,counts.astype(float),nclass),z)
+
+def test_jenks_single_class():
+    z=np.array([3.0,1.0,4.0,1.0,5.0,9.0,2.0,6.0])
+    levels=ClassifyMethod.calcJenksContours(z,ncontour=1)
+    assert np.array_equal(levels,[1.0,9.0])
+
+@pytest.mark.parametrize('ncontour',[4,5,10])
+def test_jenks_class_for_each_value( ncontour ):
+    # With at least as many classes as distinct values each value is in
+    # its own class
+    z=np.array([2.0,7.0,2.0,3.0,7.0,7.0,11.0,3.0])
+    levels=ClassifyMethod.calcJenksContours(z,ncontour=ncontour)
+    assert np.allclose(levels,[2.0,2.5,5.0,9.0,11.0])
+    index=ClassifyUtils.classIndex(levels,z)
+    assert np.array_equal(index,[0,2,0,1,2,2,3,1])
+
+def test_jenks_sampled_groups():
+    # With more distinct values than the sample size the values are
+    # grouped, and the classes are optimal for the groups
+    rng=np.random.default_rng(3)
+    z=np.concatenate((rng.normal(0.0,1.0,200),rng.normal(10.0,1.0,200),rng.normal(30.0,2.0,200)))
+    values,counts=np.unique(z,return_counts=True)
+    means,lower,upper,weights=ClassifyMethod._groupSorted(values,counts.astype(float),8)
+    assert len(means) == 8
+    assert np.all(lower <= means) and np.all(means <= upper)
+    assert np.all(upper[:-1] < lower[1:])
+    levels=ClassifyMethod.calcJenksContours(z,ncontour=3,sample=8)
+    assert len(levels) == 4
+    assert levels[0] == z.min() and levels[-1] == z.max()
+    # Each break is between two groups
+    for level in levels[1:-1]:
+        k=np.searchsorted(upper,level)
+        assert upper[k-1] < level < lower[k]
+    index=ClassifyUtils.classIndex(levels,z)
+    group=np.searchsorted(upper,z)
+    gindex=np.array([index[group == g][0] for g in range(8)])
+    assert np.all(index == gindex[group])
+    ends=np.flatnonzero(np.diff(gindex,append=gindex[-1]+1))
+    _assertOptimal(_partitionCost(means,weights,ends),_bruteForceCost(means,weights,3),means)
+
+def test_jenks_constant_data():
+    with pytest.raises(ClassifyMethodError):
+        ClassifyMethod.calcJenksContours(np.full(10,2.0),ncontour=3)
+
+def _unitSquareEngine( f, n=21, method='areaquantile', ncontour=4 ):
+    gx,gy=np.meshgrid(np.linspace(0.0,1.0,n),np.linspace(0.0,1.0,n))
+    x,y=gx.ravel(),gy.ravel()
+    return makeEngine(x,y,f(x,y),method=method,ncontour=ncontour)
+
+@pytest.mark.parametrize('ncontour',[1,4,10])
+def test_area_quantiles_of_plane( ncontour ):
+    # z=x over the unit square has equal areas between equally spaced
+    # levels
+    engine=_unitSquareEngine(lambda x,y: x,ncontour=ncontour)
+    levels=engine.levels()
+    assert np.allclose(levels,np.linspace(0.0,1.0,ncontour+1),atol=1e-12)
+
+def test_area_quantiles_of_sloping_plane():
+    # z=x+y over the unit square has area t^2/2 below t for t <= 1 and
+    # 1-(2-t)^2/2 above, which is exact for linear interpolation
+    engine=_unitSquareEngine(lambda x,y: x+y,n=11,ncontour=8)
+    levels=engine.levels()
+    area=np.linspace(0.0,1.0,9)
+    expected=np.where(area <= 0.5,np.sqrt(2.0*area),2.0-np.sqrt(2.0*(1.0-area)))
+    assert np.allclose(levels,expected,atol=1e-12)
+    dist=ClassifyMethod._areaDistribution(*engine.triangleData())
+    assert ClassifyMethod._areaBelow(dist,-1.0) == 0.0
+    assert np.isclose(ClassifyMethod._areaBelow(dist,3.0),1.0)
+    assert np.allclose(ClassifyMethod._areaBelow(dist,levels),area,atol=1e-12)
+
+def test_area_quantiles_with_min_and_max():
+    engine=_unitSquareEngine(lambda x,y: x)
+    engine.setClassifyMethod('areaquantile',{'ncontour':4,'min':0.2,'max':0.6})
+    assert np.allclose(engine.levels(),[0.2,0.3,0.4,0.5,0.6],atol=1e-12)
+
+def test_area_quantiles_with_flat_area():
+    # Half of the square is flat at z=0, so the lowest two quarters of
+    # the area have the same level, which is only used once
+    engine=_unitSquareEngine(lambda x,y: np.maximum(x-0.5,0.0))
+    dist=ClassifyMethod._areaDistribution(*engine.triangleData())
+    assert np.isclose(ClassifyMethod._areaBelow(dist,0.0),0.5)
+    assert np.allclose(engine.levels(),[0.0,0.25,0.5],atol=1e-12)
+
+def test_area_quantiles_match_sampled_area():
+    # The levels divide the triangulated area into equal parts, so about
+    # equal numbers of points sampled uniformly over the area fall in
+    # each class of the interpolated surface
+    from matplotlib.tri import LinearTriInterpolator, Triangulation
+    x,y,z=loadDataset('clustered')
+    engine=makeEngine(x,y,z,method='areaquantile',ncontour=5)
+    levels=engine.levels()
+    tx,ty,tz,triangles=engine.triangleData()
+    interpolator=LinearTriInterpolator(Triangulation(tx,ty,triangles),tz)
+    rng=np.random.default_rng(5)
+    px=rng.uniform(tx.min(),tx.max(),400000)
+    py=rng.uniform(ty.min(),ty.max(),400000)
+    pz=interpolator(px,py)
+    pz=pz.data[~pz.mask]
+    fraction=np.bincount(ClassifyUtils.classIndex(levels,pz),minlength=5)/len(pz)
+    assert np.allclose(fraction,0.2,atol=0.01)
+
+def test_area_quantiles_of_sample_match_full_data():
+    # Levels from a random half of the points of a smooth surface are
+    # close to those from all of them
+    x,y,z=loadDataset('uniform')
+    full=makeEngine(x,y,z,method='areaquantile',ncontour=6).levels()
+    index=np.random.default_rng(7).choice(len(x),len(x)//2,replace=False)
+    sampled=makeEngine(x[index],y[index],z[index],method='areaquantile',ncontour=6).levels()
+    assert np.allclose(sampled[1:-1],full[1:-1],atol=0.02*(full[-1]-full[0]))
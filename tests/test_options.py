@@ -0,0 +1,45 @@
+'''
+The static parameter options used when the plugin is loaded must match
+the engine options and the registered methods.
+'''
+
+import subprocess
+import sys
+
+import pytest
+
+from classify import ClassifyMethod
+from classify import ClassifyOptions
+from classify.ClassifyEngine import (
+    ClassifyExtendOption,
+    ClassifyInterpolation,
+    ClassifyPath,
+    ClassifyType,
+    )
+from conftest import ROOT
+
+@pytest.mark.parametrize('options,values,description',[
+    (ClassifyOptions.ClassifyTypeOptions,ClassifyType.types(),ClassifyType.description),
+    (ClassifyOptions.ExtendOptions,ClassifyExtendOption.options(),ClassifyExtendOption.description),
+    (ClassifyOptions.InterpolationOptions,ClassifyInterpolation.options(),ClassifyInterpolation.description),
+    (ClassifyOptions.PathOptions,ClassifyPath.options(),ClassifyPath.description),
+    ],ids=['type','extend','interpolation','path'])
+def test_options_match_engine( options, values, description ):
+    assert list(options) == [(v,description(v)) for v in values]
+
+def test_method_options_match_registered_methods():
+    assert list(ClassifyOptions.MethodOptions) == [(m.id,m.name) for m in ClassifyMethod.methods]
+
+def test_options_do_not_import_numpy():
+    script=(
+        'import sys\n'
+        'import classify.ClassifyOptions\n'
+        'print(",".join(m for m in ("numpy","matplotlib") if m in sys.modules))\n'
+        )
+    result=subprocess.run([sys.executable,'-c',script],cwd=ROOT,capture_output=True,text=True,check=True)
+    assert result.stdout.strip() == ''
+
+def test_module_available():
+    assert ClassifyOptions.moduleAvailable('json')
+    assert not ClassifyOptions.moduleAvailable('classify_no_such_module')
+    assert not ClassifyOptions.moduleAvailable('classify_no_such_module.child')
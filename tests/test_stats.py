@@ -0,0 +1,97 @@
+'''
+Tests of the stage timing and memory recorded by ClassifyStats.
+'''
+
+import threading
+import time
+import tracemalloc
+
+import pytest
+
+from classify.ClassifyStats import ClassifyStats
+
+def _slowItems( stats, n, delay ):
+    for i in range(n):
+        with stats.stage('produce'):
+            time.sleep(delay)
+        yield i
+
+def test_nested_stage_time_excluded():
+    stats=ClassifyStats()
+    with stats.stage('outer'):
+        with stats.stage('inner'):
+            time.sleep(0.05)
+    stages=stats.asDict()['stages']
+    assert stages['inner']['wall'] >= 0.05
+    assert stages['outer']['wall'] < 0.03
+
+def test_excluding_items_produced_in_this_thread():
+    stats=ClassifyStats()
+    with stats.stage('write'):
+        items=list(stats.excluding(_slowItems(stats,3,0.02)))
+    assert items == [0,1,2]
+    stages=stats.asDict()['stages']
+    assert list(stages) == ['produce','write']
+    assert stages['produce']['calls'] == 3
+    assert stages['write']['wall'] < 0.03
+
+def test_excluding_items_produced_by_other_threads():
+    # Waiting for results from worker threads is not counted in the
+    # consuming stage, and the results are still recorded in their own
+    # stage
+    stats=ClassifyStats()
+    results=[]
+
+    def worker():
+        for i in _slowItems(stats,3,0.02):
+            results.append(i)
+
+    def items():
+        thread=threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        yield from results
+
+    with stats.stage('write'):
+        assert list(stats.excluding(items())) == [0,1,2]
+    stages=stats.asDict()['stages']
+    assert stages['produce']['wall'] >= 0.06
+    assert stages['write']['wall'] < 0.03
+
+def test_excluding_propagates_errors():
+    stats=ClassifyStats()
+
+    def items():
+        yield 1
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        with stats.stage('write'):
+            list(stats.excluding(items()))
+    assert list(stats.asDict()['stages']) == ['write']
+
+def test_traced_memory_only_reset_by_owner( monkeypatch ):
+    # tracemalloc's peak is global, so stages in other threads must not
+    # reset it under a stage of the owning thread
+    resets=[]
+    resetPeak=tracemalloc.reset_peak
+    monkeypatch.setattr(tracemalloc,'reset_peak',
+                        lambda: (resets.append(threading.get_ident()),resetPeak()))
+    stats=ClassifyStats(traceMemory=True)
+    try:
+        def worker():
+            with stats.stage('contour'):
+                pass
+        with stats.stage('write'):
+            data=bytearray(4*1048576)
+            thread=threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+            del data
+    finally:
+        stats.stop()
+    assert resets == [threading.get_ident()]
+    stages=stats.asDict()['stages']
+    assert stages['contour']['peak_memory'] is None
+    assert stages['write']['memory_type'] == 'traced'
+    assert stages['write']['peak_memory'] >= 4*1048576
@@ -0,0 +1,116 @@
+'''
+Tests of the support functions in ClassifyUtils.
+'''
+
+import numpy as np
+import pytest
+import shapely
+
+from classify import ClassifyUtils
+
+BatchSizes=[10000000,1000,7,1]
+
+def _rings( polygon ):
+    '''
+    Ring vertices of a shapely polygon or multipolygon as used by
+    pointsInPolygon
+    '''
+    rings=[]
+    for part in shapely.get_parts(polygon):
+        for ring in [part.exterior]+list(part.interiors):
+            rings.append(shapely.get_coordinates(ring))
+    return rings
+
+def _testPolygons():
+    rng=np.random.default_rng(1234)
+    # Square with two holes
+    square=shapely.Polygon(
+        [(0,0),(10,0),(10,10),(0,10)],
+        [[(1,1),(4,1),(4,4),(1,4)],[(6,5),(9,7),(7,9)]],
+        )
+    # Irregular polygons with holes from unions and differences of circles
+    centres=rng.uniform(0,20,(12,2))
+    blobs=shapely.union_all(shapely.buffer(shapely.points(centres),rng.uniform(1.5,4.0,12)))
+    holes=shapely.union_all(shapely.buffer(shapely.points(centres),rng.uniform(0.2,1.0,12)))
+    blobs=shapely.difference(blobs,holes)
+    # Separate polygons, one with a hole containing another polygon
+    nested=shapely.MultiPolygon([
+        shapely.Polygon([(0,0),(8,0),(8,8),(0,8)],[[(2,2),(6,2),(6,6),(2,6)]]),
+        shapely.Polygon([(3,3),(5,3),(4,5)]),
+        shapely.Polygon([(10,1),(14,2),(12,7)]),
+        ])
+    return {'square': square, 'blobs': blobs, 'nested': nested}
+
+@pytest.mark.parametrize('batchSize',BatchSizes)
+@pytest.mark.parametrize('name',['square','blobs','nested'])
+def test_points_in_polygon_matches_shapely( name, batchSize ):
+    polygon=_testPolygons()[name]
+    xmin,ymin,xmax,ymax=polygon.bounds
+    rng=np.random.default_rng(42)
+    x=rng.uniform(xmin-1,xmax+1,5000)
+    y=rng.uniform(ymin-1,ymax+1,5000)
+    # Away from the boundary the result is unambiguous
+    points=shapely.points(x,y)
+    away=shapely.distance(points,polygon.boundary) > 1.0e-6
+    x,y=x[away],y[away]
+    expected=shapely.contains(polygon,points[away])
+    inside=ClassifyUtils.pointsInPolygon(x,y,_rings(polygon),batchSize=batchSize)
+    assert inside.dtype == bool
+    assert np.array_equal(inside,expected)
+
+@pytest.mark.parametrize('batchSize',BatchSizes)
+def test_points_in_polygon_edges_and_vertices( batchSize ):
+    # Points on edges and vertices are inside on the left and bottom
+    # edges of a square and outside on the right and top, so for a
+    # square with a square hole the mask is the difference of half open
+    # boxes.  Both ring orientations give the same result.
+    outer=np.array([(0,0),(4,0),(4,4),(0,4)],dtype=float)
+    hole=np.array([(1,1),(1,3),(3,3),(3,1)],dtype=float)
+    gx,gy=np.meshgrid(np.arange(-1,5.5,0.5),np.arange(-1,5.5,0.5))
+    x,y=gx.ravel(),gy.ravel()
+    expected=((0 <= x) & (x < 4) & (0 <= y) & (y < 4)) & ~((1 <= x) & (x < 3) & (1 <= y) & (y < 3))
+    for rings in ([outer,hole],[outer[::-1],hole[::-1]],[hole,outer]):
+        inside=ClassifyUtils.pointsInPolygon(x,y,rings,batchSize=batchSize)
+        assert np.array_equal(inside,expected)
+
+@pytest.mark.parametrize('batchSize',BatchSizes)
+def test_points_in_polygon_partition( batchSize ):
+    # Polygons sharing edges and vertices partition the plane, so each
+    # point on the shared edges and vertices is in exactly one of them.
+    # The cells are the triangles of a square lattice split on alternate
+    # diagonals, which gives vertices shared by four and by eight cells.
+    cells=[]
+    n=4
+    for i in range(n):
+        for j in range(n):
+            p00,p10,p11,p01=(i,j),(i+1,j),(i+1,j+1),(i,j+1)
+            if (i+j) % 2:
+                cells += [[p00,p10,p11],[p00,p11,p01]]
+            else:
+                cells += [[p00,p10,p01],[p10,p11,p01]]
+    gx,gy=np.meshgrid(np.arange(0,n,0.25),np.arange(0,n,0.25))
+    x,y=gx.ravel(),gy.ravel()
+    count=np.zeros(len(x),dtype=int)
+    for cell in cells:
+        ring=np.array(cell,dtype=float)
+        inside=ClassifyUtils.pointsInPolygon(x,y,[ring],batchSize=batchSize)
+        polygon=shapely.Polygon(ring)
+        points=shapely.points(x,y)
+        # Points found inside are in the closed cell, and points strictly
+        # inside the cell are found
+        assert np.all(shapely.covers(polygon,points[inside]))
+        assert np.all(inside[shapely.contains_properly(polygon,points)])
+        count += inside
+    assert np.all(count == 1)
+
+def test_points_in_polygon_degenerate():
+    x=np.array([0.5,1.5])
+    y=np.array([0.5,0.5])
+    assert not ClassifyUtils.pointsInPolygon(x,y,[]).any()
+    # Rings with fewer than three vertices are ignored
+    assert not ClassifyUtils.pointsInPolygon(x,y,[np.array([(0,0),(1,1)])]).any()
+    # A ring repeating its first vertex at the end gives the same result
+    ring=np.array([(0,0),(1,0),(1,1),(0,1)],dtype=float)
+    closed=np.vstack((ring,ring[:1]))
+    assert np.array_equal(ClassifyUtils.pointsInPolygon(x,y,[ring]),[True,False])
+    assert np.array_equal(ClassifyUtils.pointsInPolygon(x,y,[closed]),[True,False])
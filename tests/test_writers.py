@@ -0,0 +1,192 @@
+'''
+Tests of the bulk file writers in ClassifyWriters, reading the files
+back without QGIS.
+'''
+
+import sqlite3
+import struct
+
+import numpy as np
+import pytest
+import shapely
+
+from classify import ClassifyWriters
+from classify.ClassifyEngine import ClassifyType
+from conftest import loadDataset
+from equivalence import makeEngine, shapelyGeometry
+
+def _records( engine, features ):
+    return [(engine.featureAttributes(f),f.geometry) for f in features]
+
+def _readGeoPackage( filename ):
+    db=sqlite3.connect(filename)
+    try:
+        table=db.execute('SELECT table_name FROM gpkg_contents').fetchone()[0]
+        cursor=db.execute('SELECT * FROM "{0}" ORDER BY fid'.format(table))
+        names=[d[0] for d in cursor.description]
+        return [dict(zip(names,row)) for row in cursor]
+    finally:
+        db.close()
+
+def _readGeoParquet( filename ):
+    import pyarrow.parquet as pq
+    return pq.read_table(filename).to_pylist()
+
+@pytest.mark.parametrize('extension,read,requires',[
+    ('.gpkg',_readGeoPackage,None),
+    ('.parquet',_readGeoParquet,'pyarrow.parquet'),
+    ])
+def test_bulk_writers_write_lod( tmp_path, extension, read, requires ):
+    # Outputs with levels of detail need the lod field for the scale
+    # dependent renderer applied when they are loaded
+    if requires:
+        pytest.importorskip(requires)
+    x,y,z=loadDataset('uniform')
+    engine=makeEngine(x,y,z,ClassifyType.line,levelsOfDetail=3)
+    features=list(engine.features())
+    assert 'lod' in [name for name,ftype in engine.fieldDefs()]
+    filename=str(tmp_path/('output'+extension))
+    writer=ClassifyWriters.writerForFile(filename)
+    assert writer(filename,_records(engine,features),engine.fieldDefs()) == len(features)
+    rows=read(filename)
+    assert [(row['index'],row['lod']) for row in rows] == [(f.index,f.lod) for f in features]
+    assert {row['lod'] for row in rows} == {0,1,2}
+
+def _parseGpkgBlob( blob ):
+    '''
+    (flags, srs id, envelope or None, wkb) of a GeoPackage geometry blob
+    '''
+    magic,version,flags,srsId=struct.unpack('<2sBBi',blob[:8])
+    assert magic == b'GP' and version == 0
+    assert flags & 0x01, 'blob header not little endian'
+    envelopeType=(flags >> 1) & 0x07
+    assert envelopeType in (0,1)
+    if envelopeType == 0:
+        return flags,srsId,None,blob[8:]
+    return flags,srsId,struct.unpack('<4d',blob[8:40]),blob[40:]
+
+def _writeGeoPackage( tmp_path, classifyType, crs=None ):
+    x,y,z=loadDataset('clustered')
+    engine=makeEngine(x,y,z,classifyType)
+    features=list(engine.features())
+    filename=str(tmp_path/'output.gpkg')
+    count=ClassifyWriters.writeGeoPackage(filename,_records(engine,features),engine.fieldDefs(),crs)
+    assert count == len(features)
+    return filename,features
+
+@pytest.mark.parametrize('classifyType',[ClassifyType.line,ClassifyType.filled])
+def test_geopackage_blobs( tmp_path, classifyType ):
+    filename,features=_writeGeoPackage(tmp_path,classifyType,'EPSG:28355')
+    db=sqlite3.connect(filename)
+    try:
+        assert db.execute('PRAGMA application_id').fetchone()[0] == 0x47504B47
+        table,srsId=db.execute('SELECT table_name, srs_id FROM gpkg_contents').fetchone()
+        assert srsId == 28355
+        geomType=db.execute('SELECT geometry_type_name FROM gpkg_geometry_columns').fetchone()[0]
+        assert geomType == ('MULTILINESTRING' if classifyType == ClassifyType.line else 'MULTIPOLYGON')
+        rows=db.execute('SELECT fid, geom FROM "{0}" ORDER BY fid'.format(table)).fetchall()
+    finally:
+        db.close()
+    assert [fid for fid,blob in rows] == list(range(1,len(features)+1))
+    for (fid,blob),feature in zip(rows,features):
+        flags,blobSrsId,envelope,wkb=_parseGpkgBlob(blob)
+        assert blobSrsId == srsId
+        assert wkb == feature.geometry.wkb()
+        bounds=feature.geometry.bounds()
+        if bounds is None:
+            assert flags & 0x10, 'empty geometry not flagged as empty'
+            assert envelope is None
+            continue
+        assert not flags & 0x10
+        # The envelope is minx, maxx, miny, maxy
+        xmin,ymin,xmax,ymax=bounds
+        assert envelope == (xmin,xmax,ymin,ymax)
+        assert shapely.from_wkb(wkb).bounds == bounds
+        assert shapely.equals_exact(shapely.from_wkb(wkb),shapelyGeometry(feature.geometry),tolerance=0.0)
+
+def test_geopackage_extent_and_rtree( tmp_path ):
+    filename,features=_writeGeoPackage(tmp_path,ClassifyType.filled)
+    bounds={fid: f.geometry.bounds() for fid,f in enumerate(features,1)}
+    bounds={fid: b for fid,b in bounds.items() if b is not None}
+    db=sqlite3.connect(filename)
+    try:
+        table,column=db.execute('SELECT table_name, column_name FROM gpkg_geometry_columns').fetchone()
+        extent=db.execute('SELECT min_x, min_y, max_x, max_y FROM gpkg_contents').fetchone()
+        rtree=db.execute('SELECT id, minx, maxx, miny, maxy FROM "rtree_{0}_{1}"'.format(table,column)).fetchall()
+        extension=db.execute('SELECT extension_name FROM gpkg_extensions WHERE table_name=?',(table,)).fetchone()
+        triggers={row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type='trigger'")}
+    finally:
+        db.close()
+    values=np.array(list(bounds.values()))
+    assert extent == (values[:,0].min(),values[:,1].min(),values[:,2].max(),values[:,3].max())
+    assert extension == ('gpkg_rtree_index',)
+    assert triggers == {'rtree_{0}_{1}_{2}'.format(table,column,name)
+                        for name in ('insert','update1','update2','update3','update4','delete')}
+    # One entry for each non-empty geometry.  R-tree boxes are stored as
+    # 32 bit floats rounded outwards, so they contain the exact bounds.
+    assert sorted(row[0] for row in rtree) == sorted(bounds)
+    for fid,minx,maxx,miny,maxy in rtree:
+        xmin,ymin,xmax,ymax=bounds[fid]
+        assert minx <= xmin and maxx >= xmax and miny <= ymin and maxy >= ymax
+        for exact,stored in ((xmin,minx),(xmax,maxx),(ymin,miny),(ymax,maxy)):
+            assert abs(exact-stored) <= 1e-6*max(1.0,abs(exact))
+
+def test_geopackage_rtree_triggers( tmp_path ):
+    # The triggers keep the index up to date when the file is edited,
+    # using the GeoPackage SQL functions which a GeoPackage reader
+    # provides - defined here from the blob header
+    filename,features=_writeGeoPackage(tmp_path,ClassifyType.line)
+    db=sqlite3.connect(filename)
+    try:
+        def envelope( blob, i ):
+            return _parseGpkgBlob(blob)[2][i]
+        db.create_function('ST_IsEmpty',1,lambda blob: int(_parseGpkgBlob(blob)[2] is None))
+        db.create_function('ST_MinX',1,lambda blob: envelope(blob,0))
+        db.create_function('ST_MaxX',1,lambda blob: envelope(blob,1))
+        db.create_function('ST_MinY',1,lambda blob: envelope(blob,2))
+        db.create_function('ST_MaxY',1,lambda blob: envelope(blob,3))
+        table,column=db.execute('SELECT table_name, column_name FROM gpkg_geometry_columns').fetchone()
+        rtree='"rtree_{0}_{1}"'.format(table,column)
+        fid,blob=db.execute('SELECT fid, "{0}" FROM "{1}" WHERE NOT ST_IsEmpty("{0}") LIMIT 1'
+                            .format(column,table)).fetchone()
+        # Insert a copy moved by (1000, 2000)
+        flags,srsId,(xmin,xmax,ymin,ymax),wkb=_parseGpkgBlob(blob)
+        moved=shapely.transform(shapely.from_wkb(wkb),lambda c: c+[1000.0,2000.0])
+        header=struct.pack('<2sBBi4d',b'GP',0,flags,srsId,xmin+1000,xmax+1000,ymin+2000,ymax+2000)
+        with db:
+            newFid=db.execute('INSERT INTO "{0}" ("{1}") VALUES (?)'
+                              .format(table,column),(header+shapely.to_wkb(moved),)).lastrowid
+        box=db.execute('SELECT minx, maxx, miny, maxy FROM {0} WHERE id=?'.format(rtree),(newFid,)).fetchone()
+        assert box == pytest.approx((xmin+1000,xmax+1000,ymin+2000,ymax+2000),rel=1e-6)
+        with db:
+            db.execute('DELETE FROM "{0}" WHERE fid=?'.format(table),(fid,))
+        assert db.execute('SELECT COUNT(*) FROM {0} WHERE id=?'.format(rtree),(fid,)).fetchone()[0] == 0
+    finally:
+        db.close()
+
+def test_geotiff_north_up( tmp_path ):
+    gdal=pytest.importorskip('osgeo.gdal')
+    gx,gy=np.meshgrid(np.arange(12)*10.0+1000.0,np.arange(9)*10.0+5000.0)
+    x,y=gx.ravel(),gy.ravel()
+    engine=makeEngine(x,y,x+2.0*y,ClassifyType.raster,ncontour=5)
+    raster=engine.rasterDefinition()
+    filename=str(tmp_path/'output.tif')
+    labels=engine.classLabels()
+    count=ClassifyWriters.writeGeoTiff(filename,raster,engine.rasterBlocks(raster,blockRows=4),
+                                       labels,'EPSG:28355')
+    assert count == 9
+    ds=gdal.Open(filename)
+    try:
+        assert ds.GetGeoTransform() == pytest.approx((995.0,10.0,0.0,5085.0,0.0,-10.0))
+        band=ds.GetRasterBand(1)
+        assert band.GetNoDataValue() == -1
+        assert band.GetCategoryNames() == labels
+        array=band.ReadAsArray()
+    finally:
+        ds=None
+    assert array.shape == (9,12)
+    # The north west and south east corners and a pixel between
+    for row,col in ((0,0),(8,11),(4,6)):
+        value=(1000.0+10.0*col)+2.0*(5080.0-10.0*row)
+        assert array[row,col] == engine.classIndex(np.array([value]))[0]
+    assert array[0,11] == len(labels)-1 and array[8,0] == 0